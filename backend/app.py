@@ -1,16 +1,27 @@
 from __future__ import annotations
 
+import json
 import sqlite3
+from concurrent.futures import FIRST_COMPLETED, wait
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, Literal, Optional
 
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 
-from .config import DEFAULT_TOK_NAME, default_db_path
-from .db import DB
+from .config import (
+    DB_PRUNE_STRINGS_ON_STARTUP,
+    DB_VACUUM_AFTER_MIGRATION,
+    DEFAULT_TOK_NAME,
+    ROOM_SCAN_CONCURRENCY,
+    SYNC_RESUME_ON_STARTUP,
+    default_db_path,
+)
+from .db import DB, GroupLessonsSnapshot, LessonDiff, LessonFilter
+from .http_cache import CompressionMiddleware, make_etag, matching_etag
 from .student_workflow import (
     discover_groups_for_tok_names,
     local_iso_to_api_iso,
@@ -20,12 +31,14 @@ from .student_workflow import (
     week_range_local,
     weeks_ceil_between_local,
 )
+from .lesson_refresh import LessonRefresher, fetch_group_range, stale_ranges
 from .syncer import SyncRunner
-from .zut_client import fetch_group_schedule
+from .zut_client import PRIORITY_INTERACTIVE, get_scheduler, get_transport
 
 
 db = DB(default_db_path())
 runner = SyncRunner(db)
+lesson_refresher = LessonRefresher(db)
 
 app = FastAPI(title="Plan ZUT Sync Backend", version="0.1.0")
 
@@ -35,7 +48,9 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+app.add_middleware(CompressionMiddleware)
 
 
 @app.exception_handler(sqlite3.Error)
@@ -44,9 +59,24 @@ def _sqlite_error_handler(_: Request, exc: sqlite3.Error) -> JSONResponse:
     return JSONResponse(status_code=500, content={"detail": f"DB error: {exc}"})
 
 
+def _not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """
+    Ustawia ETag odpowiedzi; gdy klient ma juz te wersje (If-None-Match), zwraca gotowa odpowiedz 304.
+    """
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        return Response(status_code=304, headers={"ETag": matched, "Cache-Control": "no-cache"})
+    response.headers.update({"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
 @app.on_event("startup")
 def _startup() -> None:
-    db.init()
+    db.init(vacuum_after_migration=DB_VACUUM_AFTER_MIGRATION)
+    if DB_PRUNE_STRINGS_ON_STARTUP:
+        db.prune_lesson_strings()
+    if SYNC_RESUME_ON_STARTUP:
+        runner.resume_unfinished()
 
 
 class SyncRequest(BaseModel):
@@ -55,7 +85,12 @@ class SyncRequest(BaseModel):
     # ISO datetime albo YYYY-MM-DD; jesli puste -> ostatnie 3 miesiace
     start: str | None = None
     end: str | None = None
-    max_workers: int = Field(default=10, ge=1, le=32)
+    # Limit zapytan skanu sal w locie; bez wartosci skan dostaje caly budzet ROOM_SCAN_CONCURRENCY.
+    max_workers: int | None = Field(default=None, ge=1, le=ROOM_SCAN_CONCURRENCY)
+    # "incremental": ponownie skanujemy tylko tygodnie okna bez swiezego skanu sali (patrz syncer.week_slices).
+    mode: Literal["full", "incremental"] = "full"
+    # Kolejka syncow: wyzszy priorytet jest obslugiwany pierwszy.
+    priority: int = Field(default=0, ge=-10, le=10)
 
 
 @app.get("/api/health")
@@ -63,18 +98,39 @@ def health() -> dict:
     return {"ok": True}
 
 
+@app.get("/api/upstream/stats")
+def upstream_stats() -> dict:
+    # Statystyki puli polaczen do plan.zut.edu.pl (reuse keep-alive, gzip) i kolejki schedulera (wg klas priorytetu).
+    return {"transport": get_transport().stats(), "scheduler": get_scheduler().stats()}
+
+
 @app.post("/api/sync")
 def start_sync(req: SyncRequest) -> dict:
-    try:
-        run_id = runner.start(
-            tok_name=req.tok_name,
-            start_iso=req.start,
-            end_iso=req.end,
-            max_workers=req.max_workers,
-        )
-        return {"run_id": run_id}
-    except RuntimeError as e:
-        raise HTTPException(status_code=409, detail=str(e)) from e
+    # Run trafia do kolejki; ten sam (tok_name, okno), ktory juz czeka albo trwa, zwraca istniejacy run_id.
+    run_id, deduplicated = runner.enqueue(
+        tok_name=req.tok_name,
+        start_iso=req.start,
+        end_iso=req.end,
+        max_workers=req.max_workers,
+        mode=req.mode,
+        priority=req.priority,
+    )
+    return {"run_id": run_id, "deduplicated": deduplicated}
+
+
+@app.post("/api/sync/cancel")
+def cancel_sync(run_id: int | None = Query(default=None)) -> dict:
+    run_ids = runner.cancel(run_id)
+    if not run_ids:
+        raise HTTPException(status_code=409, detail="no sync running")
+    return {"run_id": run_ids[0], "run_ids": run_ids, "cancelling": True}
+
+
+@app.get("/api/runs/active")
+def active_run() -> dict:
+    # Partia runow obslugiwana jednym skanem sal; run_id = pierwszy z nich (zgodnosc z frontendem).
+    run_ids = runner.active_run_ids()
+    return {"run_id": run_ids[0] if run_ids else None, "run_ids": run_ids, "queued": db.count_queued_runs()}
 
 
 @app.get("/api/runs/{run_id}")
@@ -85,30 +141,26 @@ def get_run(run_id: int) -> dict:
     return run.__dict__
 
 
-@app.get("/api/runs/active")
-def active_run() -> dict:
-    run_id = runner.active_run_id()
-    return {"run_id": run_id}
-
-
-@app.get("/api/groups")
+@app.get("/api/groups", response_model=None)
 def list_groups(
+    request: Request,
+    response: Response,
     tok_name: str = Query(default=DEFAULT_TOK_NAME),
     run_id: int | None = Query(default=None),
-) -> dict:
+) -> dict | Response:
     if run_id is None:
         latest = db.get_latest_successful_run(tok_name)
-        if not latest:
-            return {"tok_name": tok_name, "run_id": None, "groups": []}
-        run_id = latest.id
+        run_id = latest.id if latest else None
 
-    groups = db.list_groups_for_run(run_id, tok_name)
-    return {"tok_name": tok_name, "run_id": run_id, "groups": groups}
+    groups = db.list_groups_for_run(run_id, tok_name) if run_id is not None else []
+    out = {"tok_name": tok_name, "run_id": run_id, "groups": groups}
+    return _not_modified(request, response, make_etag("groups", out)) or out
 
 
-@app.get("/api/rooms")
-def list_rooms() -> dict:
-    return {"rooms": db.list_rooms()}
+@app.get("/api/rooms", response_model=None)
+def list_rooms(request: Request, response: Response) -> dict | Response:
+    out = {"rooms": db.list_rooms()}
+    return _not_modified(request, response, make_etag("rooms", out)) or out
 
 
 class StudentEnsureRequest(BaseModel):
@@ -118,8 +170,11 @@ class StudentEnsureRequest(BaseModel):
     range_start: str | None = None  # YYYY-MM-DD lub ISO; zakres do pobrania/przetworzenia
     range_end: str | None = None
     force_refresh: bool = False
-    max_workers: int = Field(default=10, ge=1, le=32)
+    # Limit zapytan skanu sal (discovery) w locie; bez wartosci caly budzet ROOM_SCAN_CONCURRENCY.
+    max_workers: int | None = Field(default=None, ge=1, le=ROOM_SCAN_CONCURRENCY)
     weeks_search_limit: int = Field(default=8, ge=1, le=26)
+    # True: pelna (canonical) lista grup kierunku ze skanu sal zamiast grup z planu studenta.
+    exhaustive_groups: bool = False
 
 
 @app.post("/api/student/ensure")
@@ -203,6 +258,7 @@ def student_ensure(req: StudentEnsureRequest) -> dict:
         db.clear_student_groups(album)
 
     groups_by_tok_out: dict[str, list[str]] = {}
+    groups_source: dict[str, str] = {}
     to_discover: set[str] = set()
 
     existing_groups_by_tok = db.list_student_groups(album)
@@ -212,14 +268,29 @@ def student_ensure(req: StudentEnsureRequest) -> dict:
             existing = existing_groups_by_tok.get(t)
             if existing:
                 groups_by_tok_out[t] = existing
+                groups_source[t] = "cache"
                 continue
 
+        # Szybka sciezka: grupy z planu studenta (juz pobranego przy szukaniu tok_name), bez skanu sal.
+        if not req.exhaustive_groups:
+            student_gs = sorted(tok_res.groups_by_tok.get(t, set()))
+            if student_gs:
+                db.upsert_canonical_groups(t, student_gs)
+                db.replace_student_groups(album, t, student_gs)
+                groups_by_tok_out[t] = student_gs
+                groups_source[t] = "student_schedule"
+                continue
+
+        # Tabela `groups` jest tez zasilana grupami z planow studentow (moze byc niepelna),
+        # wiec przy exhaustive_groups zawsze idziemy do discovery (ktore korzysta z room_index).
         canon = db.list_canonical_groups(t)
-        if canon and not req.force_refresh:
+        if canon and not req.force_refresh and not req.exhaustive_groups:
             db.replace_student_groups(album, t, canon)
             groups_by_tok_out[t] = canon
+            groups_source[t] = "canonical"
         else:
             to_discover.add(t)
+            groups_source[t] = "discovery"
 
     discovery_meta: dict = {"performed": False}
     if to_discover:
@@ -234,6 +305,7 @@ def student_ensure(req: StudentEnsureRequest) -> dict:
                 start_api=start_api,
                 end_api=end_api,
                 max_workers=req.max_workers,
+                db=db,
             )
         except Exception as e:  # noqa: BLE001
             raise HTTPException(status_code=502, detail=str(e)) from e
@@ -241,6 +313,7 @@ def student_ensure(req: StudentEnsureRequest) -> dict:
             {
                 "rooms_total": disc.rooms_total,
                 "rooms_processed": disc.rooms_processed,
+                "rooms_from_index": disc.rooms_from_index,
                 "errors": disc.errors,
                 "last_error": disc.last_error,
             }
@@ -270,21 +343,168 @@ def student_ensure(req: StudentEnsureRequest) -> dict:
         "groups_by_tok": groups_by_tok_out,
         "cached": False,
         "tok_name_weeks_used": tok_res.weeks_used,
+        "tok_name_windows_fetched": tok_res.windows_fetched,
+        "tok_name_resolve_ms": tok_res.wall_ms,
+        "groups_source": groups_source,
         "group_discovery": discovery_meta,
     }
 
 
+class FilterItem(BaseModel):
+    # Pola klucza filtra jak we froncie: title or "Bez nazwy", group_name, worker/worker_title or "Brak prowadzącego".
+    title: str
+    group_name: str
+    lecturer: str
+    # Klucz filtra frontendu (tylko do odtworzenia zaznaczenia po wczytaniu profilu).
+    key: str | None = None
+
+
+class InlineFilter(BaseModel):
+    selected_tok: str | None = None
+    items: list[FilterItem] = Field(default_factory=list)
+
+
 class StudentWeekRequest(BaseModel):
     album_number: str = Field(min_length=1)
     week_start: str | None = None
     range_start: str | None = None
     range_end: str | None = None
-    force_refresh: bool = False  # tylko dla zajec (group schedule)
+    force_refresh: bool = False  # tylko dla zajec (group schedule); pomija zakresy swiezsze niz kilka minut
     max_workers: int = Field(default=10, ge=1, le=32)
+    # True: zajecia z calego range_start..range_end zamiast tylko z wybranego tygodnia.
+    whole_range: bool = False
+    # True: odpowiedz strumieniowana (ten sam JSON), zajecia wysylane paczkami prosto z kursora DB.
+    stream: bool = False
+    # "columnar": lessons jako kolumny indeksow do slownika tekstow (patrz _columnar_lessons).
+    format: Literal["objects", "columnar"] = "objects"
+    # True: te same zajecia wielu grup (start, end, title, worker, room) jako jedno zdarzenie z group_names.
+    merge: bool = False
+    # Filtr po stronie serwera: zapisany profil albo filtr podany wprost (nie oba naraz).
+    # filter_items w odpowiedzi zostaja niefiltrowane (sidebar pokazuje wszystkie pozycje).
+    filter_profile_id: int | None = None
+    filter: InlineFilter | None = None
+
+
+class FilterProfileRequest(BaseModel):
+    album_number: str = Field(min_length=1)
+    name: str = Field(default="domyslny", min_length=1, max_length=100)
+    selected_tok: str | None = None
+    items: list[FilterItem] = Field(default_factory=list)
+
+
+def _lesson_filter(items: Iterable[dict], selected_tok: str | None) -> LessonFilter:
+    return LessonFilter(
+        items=frozenset(
+            (str(it.get("title") or ""), str(it.get("group_name") or "").strip(), str(it.get("lecturer") or ""))
+            for it in items
+        ),
+        selected_tok=selected_tok,
+    )
+
+
+# Ile zajec laczymy w jeden kawalek odpowiedzi strumieniowej.
+STREAM_CHUNK_LESSONS = 256
+
+
+def _stream_week_json(head: dict, lessons: Iterator[dict], tail: Callable[[], dict]) -> Iterator[bytes]:
+    """
+    Sklada {**head, "lessons": [...], **tail()} kawalkami: naglowek od razu, potem paczki zajec.
+    Pamiec nie rosnie z rozmiarem zakresu (trzymamy co najwyzej jedna paczke).
+    """
+
+    def _dumps(value: object) -> str:
+        # Jak JSONResponse Starlette.
+        return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+    yield (_dumps(head)[:-1] + ',"lessons":[').encode("utf-8")
+    first = True
+    buf: list[str] = []
+    for ev in lessons:
+        buf.append(_dumps(ev))
+        if len(buf) >= STREAM_CHUNK_LESSONS:
+            yield (("" if first else ",") + ",".join(buf)).encode("utf-8")
+            first = False
+            buf = []
+    if buf:
+        yield (("" if first else ",") + ",".join(buf)).encode("utf-8")
+    yield ("]," + _dumps(tail())[1:]).encode("utf-8")
+
+
+# Pola, ktore musza byc rowne, zeby polaczyc zajecia kilku grup w jeden wpis; reszte pol bierzemy
+# z pierwszego wiersza, wiec trafia tu wszystko, co frontend pokazuje per zajecia (kolor, status).
+_MERGE_KEY_FIELDS = (
+    "end",
+    "title",
+    "worker",
+    "room",
+    "color",
+    "border_color",
+    "lesson_status",
+    "lesson_status_short",
+    "status_item",
+)
 
 
-@app.post("/api/student/week")
-def student_week(req: StudentWeekRequest) -> dict:
+def _merge_shared_lessons(lessons: Iterable[dict]) -> Iterator[dict]:
+    """
+    Jeden przebieg po zajeciach posortowanych po start: w obrebie tego samego startu laczy wiersze
+    o tym samym (end, title, worker, room) i tym samym kolorze/statusie (np. zajecia odwolane tylko
+    dla jednej grupy zostaja osobno). Wynik to pierwszy wiersz + group_names i tok_names
+    (rownolegle listy, po jednej pozycji na grupe). Kolejnosc zachowana (start, pierwsza grupa).
+    """
+    bucket_start: Optional[str] = None
+    bucket: dict[tuple, dict] = {}
+    for ev in lessons:
+        if ev.get("start") != bucket_start:
+            yield from bucket.values()
+            bucket_start = ev.get("start")
+            bucket = {}
+        key = tuple(ev.get(k) for k in _MERGE_KEY_FIELDS)
+        merged = bucket.get(key)
+        if merged is None:
+            bucket[key] = {**ev, "group_names": [ev.get("group_name")], "tok_names": [ev.get("tok_name")]}
+        else:
+            merged["group_names"].append(ev.get("group_name"))
+            merged["tok_names"].append(ev.get("tok_name"))
+    yield from bucket.values()
+
+
+def _columnar_lessons(lessons: Iterable[dict]) -> dict:
+    """
+    Zwarta postac listy zajec: {"format": "columnar", "count": n, "strings": [...], "columns": {klucz: [...]}}.
+    Kazda kolumna ma n pozycji: indeks do strings albo null (dla list, np. group_names: lista indeksow).
+    Nazwy kluczy i powtarzajace sie teksty (kolory, prowadzacy, sale, daty) sa w odpowiedzi tylko raz.
+    """
+
+    def _ix(value: object) -> Optional[int]:
+        if value is None:
+            return None
+        value = str(value)
+        ix = index.get(value)
+        if ix is None:
+            ix = index[value] = len(strings)
+            strings.append(value)
+        return ix
+
+    strings: list[str] = []
+    index: dict[str, int] = {}
+    columns: dict[str, list] = {}
+    count = 0
+    for ev in lessons:
+        for key, value in ev.items():
+            col = columns.get(key)
+            if col is None:
+                col = columns[key] = [None] * count
+            col.append([_ix(v) for v in value] if isinstance(value, list) else _ix(value))
+        count += 1
+        for col in columns.values():
+            if len(col) < count:
+                col.append(None)
+    return {"format": "columnar", "count": count, "strings": strings, "columns": columns}
+
+
+@app.post("/api/student/week", response_model=None)
+def student_week(req: StudentWeekRequest, request: Request, response: Response) -> dict | Response:
     album = req.album_number.strip()
     if not db.student_exists(album):
         raise HTTPException(status_code=404, detail="student not found; call /api/student/ensure first")
@@ -295,61 +515,113 @@ def student_week(req: StudentWeekRequest) -> dict:
         range_start_local, range_end_local = range_bounds_local(req.range_start, req.range_end, monday_fallback=monday)
     except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e)) from e
-    range_start_api = local_iso_to_api_iso(range_start_local)
-    range_end_api = local_iso_to_api_iso(range_end_local)
+    if req.stream and req.format != "objects":
+        raise HTTPException(status_code=422, detail="stream supports only format=objects")
+    if req.filter_profile_id is not None and req.filter is not None:
+        raise HTTPException(status_code=422, detail="use either filter_profile_id or filter")
+    lesson_filter: LessonFilter | None = None
+    if req.filter_profile_id is not None:
+        profile = db.get_filter_profile(req.filter_profile_id)
+        if profile is None or profile["album_number"] != album:
+            raise HTTPException(status_code=404, detail="filter profile not found")
+        lesson_filter = _lesson_filter(profile["items"], profile["selected_tok"])
+    elif req.filter is not None:
+        lesson_filter = _lesson_filter((it.model_dump() for it in req.filter.items), req.filter.selected_tok)
 
     groups = db.list_student_groups_flat(album)
     if not groups:
         raise HTTPException(status_code=404, detail="no groups for student; call /api/student/ensure first")
 
-    # Fetch/refresh lessons per-group (cache w group_fetches).
-    to_fetch: list[str] = []
+    # Fetch/refresh lessons per-group (cache w group_fetches jako pokrycie przedzialami).
+    # Brakujace podprzedzialy pobieramy od razu; nieaktualne (TTL) serwujemy z cache i odswiezamy w tle.
+    # force_refresh pobiera od razu wszystko, co nie bylo odswiezane w ciagu FORCE_REFRESH_MIN_AGE_S.
+    to_fetch: list[tuple[str, str, str]] = []
+    to_revalidate: list[tuple[str, str, str]] = []
     skipped = 0
+    coverage_by_group = db.get_group_coverage_bulk(groups, range_start_local, range_end_local)
     for g in groups:
-        st = db.get_group_fetch_status(g, range_start_local, range_end_local)
-        if (not req.force_refresh) and st == "success":
+        coverage = coverage_by_group.get(g, [])
+        gaps = db.coverage_gaps([(s, e) for s, e, _ in coverage], range_start_local, range_end_local)
+        stale = stale_ranges(coverage, range_start_local, range_end_local, force=req.force_refresh)
+        if req.force_refresh:
+            to_fetch.extend((g, s, e) for s, e in sorted([*gaps, *stale]))
+        else:
+            to_fetch.extend((g, s, e) for s, e in gaps)
+            to_revalidate.extend((g, s, e) for s, e in stale)
+        if not gaps and not (req.force_refresh and stale):
             skipped += 1
-            continue
-        to_fetch.append(g)
+
+    # Domyslnie wyswietlamy tylko wybrany tydzien, nawet jesli dane pobieralismy w szerszym zakresie.
+    lessons_start, lessons_end = (
+        (range_start_local, range_end_local) if req.whole_range else (week_start_local, week_end_local)
+    )
+
+    def _etag(seq: int) -> str:
+        # Wersja danych (seq zmian zajec grup studenta) i wszystko, od czego zalezy tresc odpowiedzi;
+        # bez licznikow pobierania z tego zapytania, zeby powtorny widok bez zmian dal ten sam ETag.
+        return make_etag(
+            "week",
+            seq,
+            album,
+            monday.isoformat(),
+            range_start_local,
+            range_end_local,
+            groups,
+            lessons_start,
+            lessons_end,
+            req.stream,
+            req.format,
+            req.merge,
+            req.filter_profile_id,
+            (sorted(lesson_filter.items), lesson_filter.selected_tok) if lesson_filter is not None else None,
+        )
+
+    if not to_fetch:
+        # Pokrycie pelne: sprawdzamy wersje klienta przed jakakolwiek praca (nieaktualne zakresy i tak
+        # odswiezamy w tle, jak przy pelnej odpowiedzi).
+        not_modified = _not_modified(request, response, _etag(db.latest_lesson_change_seq_for_groups(groups)))
+        if not_modified is not None:
+            if to_revalidate:
+                lesson_refresher.submit(to_revalidate)
+            return not_modified
 
     errors = 0
     last_error: str | None = None
-    fetched = 0
-
-    def _fetch_one(group_name: str) -> tuple[str, list[dict]]:
-        evs = fetch_group_schedule(group_name, start_iso=range_start_api, end_iso=range_end_api)
-        return group_name, evs
+    snapshots: list[GroupLessonsSnapshot] = []
+    failures: list[tuple[str, str, str, str]] = []
+    diff = LessonDiff()
 
     if to_fetch:
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-
-        with ThreadPoolExecutor(max_workers=max(1, int(req.max_workers))) as ex:
-            futures = {ex.submit(_fetch_one, g): g for g in to_fetch}
-            for fut in as_completed(futures):
-                g = futures[fut]
+        # Zakresy ida przez wspolny scheduler zapytan do ZUT (klasa interaktywna: przed discovery i syncem w tle);
+        # max_workers ogranicza, ile zakresow tego zapytania jest naraz w kolejce / w locie.
+        scheduler = get_scheduler()
+        queued = list(reversed(to_fetch))
+        futures: dict = {}
+        while True:
+            while queued and len(futures) < max(1, int(req.max_workers)):
+                task = queued.pop()
+                futures[scheduler.submit(fetch_group_range, *task, priority=PRIORITY_INTERACTIVE)] = task
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                g, gap_start, gap_end = futures.pop(fut)
                 try:
-                    group_name, evs = fut.result()
-                    # Zeby nie trzymac starych zajec gdy plan sie zmieni: kasujemy zakres i zapisujemy aktualny snapshot.
-                    db.delete_lessons_for_group_in_range(group_name, range_start_local, range_end_local)
-                    db.upsert_lessons(evs)
-                    db.upsert_group_fetch(
-                        group_name,
-                        range_start_local,
-                        range_end_local,
-                        status="success",
-                        last_error=None,
-                    )
-                    fetched += 1
+                    snapshots.append(fut.result())
                 except Exception as e:  # noqa: BLE001
                     errors += 1
                     last_error = f"{g}: {e}"
-                    db.upsert_group_fetch(g, range_start_local, range_end_local, status="failed", last_error=str(e))
+                    failures.append((g, gap_start, gap_end, str(e)))
+        # Wszystkie pobrane snapshoty (i bledy) zapisujemy jedna transakcja.
+        diff = db.replace_group_lessons_bulk(snapshots, failures=failures)
+    fetched_groups = {snap.group_name for snap in snapshots}
 
-    # Wyswietlamy tylko wybrany tydzien, nawet jesli dane pobieralismy w szerszym zakresie.
-    lessons = db.list_lessons_for_groups(groups, week_start_local, week_end_local)
-    # Filtry budujemy z calego zakresu, a nie tylko z biezacego tygodnia.
-    filter_items = db.list_filter_items_for_groups(groups, range_start_local, range_end_local)
-    return {
+    revalidating = lesson_refresher.submit(to_revalidate) if to_revalidate else 0
+
+    # seq czytamy przed zajeciami: zmiany zapisane w miedzyczasie klient dostanie z /api/student/changes.
+    # To tez wersja danych dla ETag: kazda zmiana zajec grup studenta dopisuje wpis do lesson_changes.
+    change_seq = db.latest_lesson_change_seq_for_groups(groups)
+    head = {
         "album_number": album,
         "week_start": monday.isoformat(),
         "start": week_start_local,
@@ -358,13 +630,100 @@ def student_week(req: StudentWeekRequest) -> dict:
         "range_end": range_end_local,
         "groups_total": len(groups),
         "groups_skipped": skipped,
-        "groups_fetched": fetched,
+        "groups_fetched": len(fetched_groups),
+        "ranges_fetched": len(to_fetch),
+        "ranges_stale": len(to_revalidate),
+        "ranges_revalidating": revalidating,
+        "lessons_inserted": diff.inserted,
+        "lessons_updated": diff.updated,
+        "lessons_deleted": diff.deleted,
+        "lessons_unchanged": diff.unchanged,
         "errors": errors,
         "last_error": last_error,
-        "lessons": lessons,
-        "filter_items": filter_items,
+        "change_seq": change_seq,
+        "filter_applied": lesson_filter is not None,
+        "filter_profile_id": req.filter_profile_id,
     }
 
+    # Po pobraniu brakujacych zakresow: jesli nic sie nie zmienilo, klient dalej ma aktualna wersje.
+    etag = _etag(change_seq)
+    not_modified = _not_modified(request, response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    def _filter_items() -> dict:
+        # Filtry budujemy z calego zakresu, a nie tylko z biezacego tygodnia.
+        return {"filter_items": db.list_filter_items_for_groups(groups, range_start_local, range_end_local)}
+
+    if req.stream:
+        lessons_iter = db.iter_lessons_for_groups(groups, lessons_start, lessons_end, lesson_filter=lesson_filter)
+        if req.merge:
+            lessons_iter = _merge_shared_lessons(lessons_iter)
+        return StreamingResponse(
+            _stream_week_json(head, lessons_iter, _filter_items),
+            media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": "no-cache"},
+        )
+
+    lessons = db.list_lessons_for_groups(groups, lessons_start, lessons_end, lesson_filter=lesson_filter)
+    if req.merge:
+        lessons = list(_merge_shared_lessons(lessons))
+    if req.format == "columnar":
+        return {**head, "lessons": _columnar_lessons(lessons), **_filter_items()}
+    return {**head, "lessons": lessons, **_filter_items()}
+
+
+@app.get("/api/student/changes")
+def student_changes(
+    album_number: str = Query(min_length=1),
+    since: int = Query(default=0, ge=0),
+    limit: int = Query(default=500, ge=1, le=5000),
+) -> dict:
+    # Zmiany zajec grup studenta od `since` (change_seq z /api/student/week albo latest_seq z poprzedniej odpowiedzi).
+    album = album_number.strip()
+    if not db.student_exists(album):
+        raise HTTPException(status_code=404, detail="student not found; call /api/student/ensure first")
+    groups = db.list_student_groups_flat(album)
+    latest_seq = db.latest_lesson_change_seq()
+    changes = db.list_lesson_changes(groups, since, limit)
+    has_more = len(changes) >= limit
+    return {
+        "album_number": album,
+        "since": since,
+        # Przy has_more kolejna strona zaczyna sie od seq ostatniej zmiany, inaczej od latest_seq.
+        "latest_seq": changes[-1]["seq"] if has_more else max(latest_seq, since),
+        "has_more": has_more,
+        "changes": changes,
+    }
+
+
+@app.get("/api/student/filter-profiles")
+def list_filter_profiles(album_number: str = Query(min_length=1)) -> dict:
+    album = album_number.strip()
+    return {"album_number": album, "profiles": db.list_filter_profiles(album)}
+
+
+@app.post("/api/student/filter-profiles")
+def save_filter_profile(req: FilterProfileRequest) -> dict:
+    # Zapis (upsert po album_number + name); id profilu mozna potem podac w /api/student/week.
+    album = req.album_number.strip()
+    if not db.student_exists(album):
+        raise HTTPException(status_code=404, detail="student not found; call /api/student/ensure first")
+    return db.upsert_filter_profile(
+        album,
+        req.name,
+        selected_tok=req.selected_tok,
+        items=[it.model_dump() for it in req.items],
+    )
+
+
+@app.delete("/api/student/filter-profiles/{profile_id}")
+def delete_filter_profile(profile_id: int, album_number: str = Query(min_length=1)) -> dict:
+    profile = db.get_filter_profile(profile_id)
+    if profile is None or profile["album_number"] != album_number.strip():
+        raise HTTPException(status_code=404, detail="filter profile not found")
+    return {"deleted": db.delete_filter_profile(profile_id)}
+
 
 # Serve the UI (frontend/) at /, without impacting /api routes.
 FRONTEND_DIR = (Path(__file__).resolve().parent.parent / "frontend").resolve()
@@ -8,6 +8,61 @@ BASE_URL = "https://plan.zut.edu.pl"
 # Ustalony z gory TOK name (mozna nadpisac w API parametrem tok_name).
 DEFAULT_TOK_NAME = "I_1A_S_2023_2024_1"
 
+# Globalny budzet zapytan do plan.zut.edu.pl jednoczesnie w locie (caly proces: sync, discovery, tydzien studenta).
+# Czesc budzetu jest zarezerwowana dla zapytan interaktywnych, zeby sync w tle nie blokowal uzytkownikow.
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("PLAN_UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_RESERVED_INTERACTIVE = int(os.getenv("PLAN_UPSTREAM_RESERVED_INTERACTIVE", "8"))
+
+# Maksymalna liczba trwalych (keep-alive) polaczen do jednego hosta w puli zut_client. Nie mniej niz budzet
+# schedulera: zapytanie z przydzielonym slotem nie moze potem czekac na polaczenie (tego czekania scheduler nie widzi).
+HTTP_POOL_MAX_PER_HOST = max(
+    int(os.getenv("PLAN_HTTP_POOL_MAX_PER_HOST", str(UPSTREAM_MAX_CONCURRENCY))), UPSTREAM_MAX_CONCURRENCY
+)
+
+# Ile zapytan o plan sali moze byc jednoczesnie "w locie" przy skanie wszystkich sal (asyncio, jeden watek).
+ROOM_SCAN_CONCURRENCY = int(os.getenv("PLAN_ROOM_SCAN_CONCURRENCY", "128"))
+
+# Jak dlugo skan sali (room_index) uznajemy za aktualny przy discovery grup (sekundy).
+ROOM_INDEX_MAX_AGE_S = int(os.getenv("PLAN_ROOM_INDEX_MAX_AGE_S", str(3 * 24 * 3600)))
+
+# Szukanie tok_name studenta: dlugosc okna planu (dni) i ile okien pobieramy rownolegle.
+TOK_RESOLVE_WINDOW_DAYS = int(os.getenv("PLAN_TOK_RESOLVE_WINDOW_DAYS", "28"))
+TOK_RESOLVE_MAX_PARALLEL = int(os.getenv("PLAN_TOK_RESOLVE_MAX_PARALLEL", "4"))
+
+# Swiezosc cache zajec grup (sekundy). Przeszle tygodnie traktujemy jako niezmienne.
+# Biezacy tydzien + LESSON_TTL_UPCOMING_DAYS dni do przodu: krotki TTL; dalsza przyszlosc: dluzszy.
+LESSON_TTL_CURRENT_S = int(os.getenv("PLAN_LESSON_TTL_CURRENT_S", str(6 * 3600)))
+LESSON_TTL_FUTURE_S = int(os.getenv("PLAN_LESSON_TTL_FUTURE_S", str(24 * 3600)))
+LESSON_TTL_UPCOMING_DAYS = int(os.getenv("PLAN_LESSON_TTL_UPCOMING_DAYS", "14"))
+# force_refresh nie pobiera ponownie zakresow odswiezonych w ciagu ostatnich N sekund.
+FORCE_REFRESH_MIN_AGE_S = int(os.getenv("PLAN_FORCE_REFRESH_MIN_AGE_S", "300"))
+# Ile watkow odswieza w tle nieaktualne zakresy (stale-while-revalidate).
+LESSON_REFRESH_WORKERS = int(os.getenv("PLAN_LESSON_REFRESH_WORKERS", "4"))
+
+# Kompresja odpowiedzi API: minimalny rozmiar (bajty) i poziomy gzip / brotli (brotli tylko jesli zainstalowane).
+HTTP_COMPRESS_MIN_SIZE = int(os.getenv("PLAN_HTTP_COMPRESS_MIN_SIZE", "1024"))
+HTTP_GZIP_LEVEL = int(os.getenv("PLAN_HTTP_GZIP_LEVEL", "6"))
+HTTP_BROTLI_QUALITY = int(os.getenv("PLAN_HTTP_BROTLI_QUALITY", "5"))
+
+# Sync w trybie incremental: okno dzielimy na tygodnie i ponownie skanujemy sale tylko dla tygodni starszych niz TTL.
+# Biezacy i przyszle tygodnie: krotki TTL; tygodnie juz zakonczone zmieniaja sie rzadko.
+SYNC_SLICE_TTL_CURRENT_S = int(os.getenv("PLAN_SYNC_SLICE_TTL_CURRENT_S", str(12 * 3600)))
+SYNC_SLICE_TTL_PAST_S = int(os.getenv("PLAN_SYNC_SLICE_TTL_PAST_S", str(14 * 24 * 3600)))
+
+# Czy przy starcie procesu wznawiac runy sync przerwane restartem (status queued/running).
+SYNC_RESUME_ON_STARTUP = os.getenv("PLAN_SYNC_RESUME_ON_STARTUP", "1") != "0"
+
+# Wyniki syncu (skany sal, grupy, checkpointy, postep) buforujemy i zapisujemy jedna transakcja,
+# gdy bufor ma tyle wierszy albo najstarszy wpis czeka dluzej niz interwal.
+SYNC_FLUSH_ROWS = int(os.getenv("PLAN_SYNC_FLUSH_ROWS", "5000"))
+SYNC_FLUSH_INTERVAL_S = float(os.getenv("PLAN_SYNC_FLUSH_INTERVAL_S", "2.0"))
+
+# Po migracji starego ukladu bazy (TEXT -> slownik) mozna odzyskac miejsce VACUUM-em; przepisuje caly plik
+# i blokuje baze na czas trwania, wiec domyslnie wylaczone.
+DB_VACUUM_AFTER_MIGRATION = os.getenv("PLAN_DB_VACUUM_AFTER_MIGRATION", "0") == "1"
+# Sprzatanie nieuzywanych tekstow z lesson_strings przy starcie.
+DB_PRUNE_STRINGS_ON_STARTUP = os.getenv("PLAN_DB_PRUNE_STRINGS_ON_STARTUP", "1") != "0"
+
 
 def default_db_path() -> Path:
     env = os.getenv("PLAN_DB_PATH")
@@ -15,4 +70,3 @@ def default_db_path() -> Path:
         return Path(env).expanduser().resolve()
     # repo_root/data/plan.sqlite3
     return (Path(__file__).resolve().parent.parent / "data" / "plan.sqlite3").resolve()
-
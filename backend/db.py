@@ -1,10 +1,23 @@
 from __future__ import annotations
 
+import calendar
 import datetime as dt
+import functools
+import hashlib
+import json
+import queue
 import sqlite3
+import threading
+import weakref
+from concurrent.futures import Future
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from zoneinfo import ZoneInfo
+
+
+WARSAW = ZoneInfo("Europe/Warsaw")
 
 
 @dataclass(frozen=True)
@@ -23,23 +36,421 @@ class SyncRun:
     groups_added: int
     errors: int
     last_error: Optional[str]
+    # "full": skan calego okna; "incremental": tylko tygodnie bez swiezego skanu (room_scans)
+    mode: str = "full"
+    # Kolejka: wyzszy priorytet pierwszy, przy rownym - starszy run.
+    priority: int = 0
+    # Jawny limit zapytan skanu w locie; 0 = caly budzet (ROOM_SCAN_CONCURRENCY).
+    max_workers: int = 0
+
+
+@dataclass(frozen=True)
+class GroupLessonsSnapshot:
+    # Aktualny stan zajec grupy w zakresie [start, end) (lokalne ISO bez offsetu), prosto z ZUT.
+    group_name: str
+    start: str
+    end: str
+    lessons: list[dict]
+
+
+@dataclass(frozen=True)
+class LessonFilter:
+    # Filtr jak w sidebarze frontendu: pozycja = (title, group_name, lecturer), gdzie
+    # title = title or "Bez nazwy", lecturer = (worker or worker_title).strip() or "Brak prowadzącego".
+    items: frozenset[tuple[str, str, str]]
+    # None / "__all__" = wszystkie tok_name
+    selected_tok: Optional[str] = None
+
+
+@dataclass
+class LessonDiff:
+    # Dokladne liczniki zastosowania snapshotu do tabeli lessons.
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+    def __add__(self, other: "LessonDiff") -> "LessonDiff":
+        return LessonDiff(
+            inserted=self.inserted + other.inserted,
+            updated=self.updated + other.updated,
+            deleted=self.deleted + other.deleted,
+            unchanged=self.unchanged + other.unchanged,
+        )
+
+
+# Kolumny tresci zajec (bez klucza group_name/start/end); z nich liczymy content_hash.
+_LESSON_CONTENT_COLUMNS = (
+    "title",
+    "description",
+    "worker_title",
+    "worker",
+    "worker_cover",
+    "lesson_form",
+    "lesson_form_short",
+    "tok_name",
+    "room",
+    "lesson_status",
+    "lesson_status_short",
+    "status_item",
+    "subject",
+    "hours",
+    "color",
+    "border_color",
+)
+
+
+_EPOCH = dt.datetime(1970, 1, 1)
+
+
+def _iso_to_min(value: str) -> int:
+    """
+    Lokalne ISO z API (czas scienny, bez offsetu) -> minuty od 1970-01-01T00:00 tego samego zegara.
+    Porzadek i roznice minut odpowiadaja porownywaniu stringow ISO, wiec zakresy [start, end) dzialaja jak wczesniej.
+    """
+    d = dt.datetime.fromisoformat(str(value).strip()).replace(tzinfo=None)
+    return calendar.timegm(d.timetuple()) // 60
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _min_to_iso(value: int) -> str:
+    return (_EPOCH + dt.timedelta(minutes=int(value))).isoformat()
+
+
+def _lesson_row(ev: dict) -> Optional[tuple]:
+    """
+    Event z ZUT -> (group_name, start, end, *kolumny tresci). None gdy brak klucza.
+    start/end sa normalizowane (przez minuty) do postaci zapisywanej w DB, tresc do TEXT jak w kolumnach.
+    """
+    if not isinstance(ev, dict):
+        return None
+    group_name = ev.get("group_name")
+    start = ev.get("start")
+    end = ev.get("end")
+    if not group_name or not start or not end:
+        return None
+    try:
+        start = _min_to_iso(_iso_to_min(start))
+        end = _min_to_iso(_iso_to_min(end))
+    except (TypeError, ValueError):
+        return None
+    content = tuple(
+        None if v is None else str(v)
+        for v in (
+            (ev.get("borderColor") if "borderColor" in ev else ev.get("border_color"))
+            if col == "border_color"
+            else ev.get(col)
+            for col in _LESSON_CONTENT_COLUMNS
+        )
+    )
+    return (str(group_name), start, end, *content)
+
+
+def _decode_lesson(strings: dict[int, str], group_id: int, start_min: int, end_min: int, ids: Iterable) -> dict:
+    """
+    Wiersz lessons (id + minuty) -> dict w ksztalcie zwracanym przez API.
+    """
+    d = {"group_name": strings[group_id], "start": _min_to_iso(start_min), "end": _min_to_iso(end_min)}
+    for col, i in zip(_LESSON_CONTENT_COLUMNS, ids):
+        d[col] = None if i is None else strings[i]
+    return d
+
+
+def _lesson_hash(row: tuple) -> int:
+    # 64-bitowy hash tresci (INTEGER w SQLite zajmuje do 8 bajtow).
+    payload = json.dumps(row[3:], ensure_ascii=False, separators=(",", ":"), default=str)
+    return int.from_bytes(hashlib.blake2b(payload.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+# Kolumny lessons z identyfikatorami z lesson_strings, w kolejnosci _LESSON_CONTENT_COLUMNS.
+_LESSON_ID_COLUMNS = tuple(f"{col}_id" for col in _LESSON_CONTENT_COLUMNS)
+
+# Zbior grup jako jeden parametr (tablica JSON rozwijana przez json_each): jedno zapytanie i jeden
+# przygotowany plan niezaleznie od liczby grup, bez limitu parametrow SQLite.
+_GROUP_IDS_SQL = "SELECT id FROM lesson_strings WHERE value IN (SELECT value FROM json_each(?))"
+
+
+# Kolumny lesson_filter_items (poza grupa) - to, z czego frontend buduje filtry.
+_FILTER_ITEM_COLUMNS = ("title_id", "subject_id", "tok_name_id", "worker_id", "worker_title_id")
+
+
+def _filter_item_triggers_sql() -> str:
+    """
+    Triggery utrzymujace lesson_filter_items przy kazdym INSERT/DELETE/UPDATE na lessons.
+    NULL w kolumnach tekstow zapisujemy jako 0 (kolumny klucza musza byc NOT NULL).
+    """
+    cols = ", ".join(("group_id", *_FILTER_ITEM_COLUMNS))
+
+    def key(ref: str) -> str:
+        return " AND ".join(
+            [f"group_id = {ref}.group_id", *(f"{c} = COALESCE({ref}.{c}, 0)" for c in _FILTER_ITEM_COLUMNS)]
+        )
+
+    def add(ref: str) -> str:
+        values = ", ".join((f"{ref}.group_id", *(f"COALESCE({ref}.{c}, 0)" for c in _FILTER_ITEM_COLUMNS)))
+        return f"""
+            INSERT INTO lesson_filter_items({cols}, first_min, last_min, lesson_count)
+            VALUES ({values}, {ref}.start_min, {ref}.start_min, 1)
+            ON CONFLICT({cols}) DO UPDATE SET
+                first_min = MIN(first_min, excluded.first_min),
+                last_min = MAX(last_min, excluded.last_min),
+                lesson_count = lesson_count + 1;
+        """
+
+    def remove(ref: str) -> str:
+        same = " AND ".join(
+            ["l.group_id = lesson_filter_items.group_id"]
+            + [f"COALESCE(l.{c}, 0) = lesson_filter_items.{c}" for c in _FILTER_ITEM_COLUMNS]
+        )
+        # first/last liczymy od nowa tylko, gdy usuwany wiersz byl na brzegu (skan zajec jednej grupy).
+        return f"""
+            UPDATE lesson_filter_items SET lesson_count = lesson_count - 1 WHERE {key(ref)};
+            DELETE FROM lesson_filter_items WHERE {key(ref)} AND lesson_count <= 0;
+            UPDATE lesson_filter_items SET
+                first_min = (SELECT MIN(l.start_min) FROM lessons l WHERE {same}),
+                last_min = (SELECT MAX(l.start_min) FROM lessons l WHERE {same})
+            WHERE {key(ref)} AND (first_min = {ref}.start_min OR last_min = {ref}.start_min);
+        """
+
+    changed = " OR ".join(f"old.{c} IS NOT new.{c}" for c in ("group_id", "start_min", *_FILTER_ITEM_COLUMNS))
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS trg_lessons_filter_insert AFTER INSERT ON lessons BEGIN
+            {add("new")}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_lessons_filter_delete AFTER DELETE ON lessons BEGIN
+            {remove("old")}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_lessons_filter_update AFTER UPDATE ON lessons WHEN {changed} BEGIN
+            {remove("old")}
+            {add("new")}
+        END;
+    """
+
+
+class _PooledConnection(sqlite3.Connection):
+    # Podklasa tylko po to, zeby dalo sie trzymac slabe referencje (WeakSet) do polaczen.
+    pass
+
+
+_STOP = object()
+
+T = TypeVar("T")
+
+
+class _FnJob:
+    def __init__(self, fn: Callable[[sqlite3.Connection], object]):
+        self.fn = fn
+        self.future: Future = Future()
+
+    def run(self, conn: sqlite3.Connection) -> tuple[bool, object]:
+        try:
+            return True, self.fn(conn)
+        except Exception as e:  # noqa: BLE001 - trafia do future
+            return False, e
+
+    def finish(self, ok: bool, value: object) -> None:
+        if ok:
+            self.future.set_result(value)
+        else:
+            self.future.set_exception(value)  # type: ignore[arg-type]
+
+    def fail(self, exc: BaseException) -> None:
+        self.future.set_exception(exc)
 
 
 class DB:
+    # Polaczenia sa trzymane per watek i uzywane ponownie (PRAGMA tylko raz na polaczenie).
+    MMAP_SIZE = 256 * 1024 * 1024
+    CACHE_SIZE_KIB = 16 * 1024
+    CACHED_STATEMENTS = 256
+
     def __init__(self, path: Path):
         self.path = path
+        self._strings: dict[int, str] = {}
+        self._strings_lock = threading.Lock()
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conns: "weakref.WeakSet[_PooledConnection]" = weakref.WeakSet()
+        self._conns_lock = threading.Lock()
+        self._write_queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
 
-    def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.path, timeout=30)
+    def _new_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            factory=_PooledConnection,
+            cached_statements=self.CACHED_STATEMENTS,
+            # Polaczenie uzywa tylko watek-wlasciciel; False pozwala zamknac je z close() w innym watku.
+            check_same_thread=False,
+        )
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA synchronous=NORMAL;")
         conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute(f"PRAGMA mmap_size={int(self.MMAP_SIZE)};")
+        conn.execute(f"PRAGMA cache_size=-{int(self.CACHE_SIZE_KIB)};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        with self._conns_lock:
+            self._conns.add(conn)
         return conn
 
-    def init(self) -> None:
-        with self._connect() as conn:
+    def _thread_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._new_connection()
+            # Polaczenia watkow sa tylko do odczytu; zapisy ida przez watek-writer (patrz _write).
+            conn.execute("PRAGMA query_only=ON;")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Polaczenie do odczytu dla biezacego watku. W watku-writerze (wewnatrz fn przekazanej do
+        _write()/transaction()) zwraca polaczenie writera, zeby odczyt widzial niezatwierdzone zapisy.
+        """
+        conn = getattr(self._local, "writer_conn", None)
+        yield conn if conn is not None else self._thread_connection()
+
+    # ----------------------------
+    # Jeden writer: wszystkie zapisy ida przez jeden watek i jedno polaczenie, a zadania ktore
+    # czekaja w kolejce sa zatwierdzane razem (group commit). Kazde zadanie ma wlasny SAVEPOINT,
+    # wiec blad jednego nie wycofuje pozostalych.
+    # ----------------------------
+
+    WRITE_BATCH_MAX = 256
+
+    def _ensure_writer(self) -> None:
+        with self._writer_lock:
+            if self._writer is not None and self._writer.is_alive():
+                return
+            self._writer = threading.Thread(target=self._writer_main, daemon=True, name="db-writer")
+            self._writer.start()
+
+    def _writer_main(self) -> None:
+        conn = self._new_connection()
+        conn.isolation_level = None  # BEGIN/COMMIT sterujemy recznie
+        self._local.writer_conn = conn
+        stopping = False
+        while not stopping:
+            job = self._write_queue.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            while len(batch) < self.WRITE_BATCH_MAX:
+                try:
+                    nxt = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            self._run_batch(conn, batch)
+        conn.close()
+
+    def _run_batch(self, conn: sqlite3.Connection, batch: list) -> None:
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+        except sqlite3.Error as e:
+            for job in batch:
+                job.fail(e)
+            return
+
+        results: list[tuple[object, bool, object]] = []
+        try:
+            for job in batch:
+                conn.execute("SAVEPOINT write_job;")
+                ok, value = job.run(conn)
+                if ok:
+                    conn.execute("RELEASE write_job;")
+                else:
+                    conn.execute("ROLLBACK TO write_job;")
+                    conn.execute("RELEASE write_job;")
+                results.append((job, ok, value))
+            conn.execute("COMMIT;")
+        except sqlite3.Error as e:
+            try:
+                conn.execute("ROLLBACK;")
+            except sqlite3.Error:
+                pass
+            for job in batch:
+                job.fail(e)
+            return
+        for job, ok, value in results:
+            job.finish(ok, value)
+
+    def submit_write(self, fn: Callable[[sqlite3.Connection], T]) -> "Future[T]":
+        """
+        Kolejkuje fn(conn) do wykonania w watku-writerze. Future konczy sie po commicie batcha.
+        Wywolane w watku-writerze (zagniezdzone) wykonuje fn od razu w tej samej transakcji.
+        """
+        conn = getattr(self._local, "writer_conn", None)
+        if conn is not None:
+            fut: Future = Future()
+            try:
+                fut.set_result(fn(conn))
+            except Exception as e:  # noqa: BLE001
+                fut.set_exception(e)
+            return fut
+        job = _FnJob(fn)
+        self._ensure_writer()
+        self._write_queue.put(job)
+        return job.future
+
+    def _write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Wykonuje fn(conn) w watku-writerze w ramach biezacego batcha i czeka na commit. fn blokuje
+        caly batch, wiec ma zawierac tylko operacje DB (bez I/O sieciowego i dlugich obliczen).
+        Wywolane z fn (zagniezdzone) wykonuje sie od razu w tej samej transakcji.
+        """
+        conn = getattr(self._local, "writer_conn", None)
+        if conn is not None:
+            return fn(conn)
+        return self.submit_write(fn).result()
+
+    def transaction(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Wykonuje fn jako jedna atomowa transakcje writera; metody DB wolane z fn wchodza w nia.
+        Te same zasady co dla _write: w fn tylko operacje DB.
+        """
+        return self._write(fn)
+
+    def close(self) -> None:
+        with self._writer_lock:
+            writer = self._writer
+            self._writer = None
+        if writer is not None and writer.is_alive():
+            self._write_queue.put(_STOP)
+            writer.join()
+        with self._conns_lock:
+            conns = list(self._conns)
+            self._conns.clear()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def init(self, *, vacuum_after_migration: bool = False) -> None:
+        # Schemat/migracje na osobnym polaczeniu (executescript sam zarzadza transakcjami), zanim ruszy writer.
+        with closing(self._new_connection()) as conn, conn:
+            # Stary uklad lessons/lesson_changes (TEXT): przenosimy do nowego ponizej, po utworzeniu schematu.
+            for table, indexes in (
+                ("lessons", ("idx_lessons_start", "idx_lessons_group")),
+                ("lesson_changes", ("idx_lesson_changes_group",)),
+            ):
+                cols = {str(r["name"]) for r in conn.execute(f"PRAGMA table_info({table});").fetchall()}
+                if "group_name" in cols:
+                    conn.executescript(
+                        "".join(f"DROP INDEX IF EXISTS {ix};" for ix in indexes)
+                        + f"ALTER TABLE {table} RENAME TO {table}_legacy;"
+                    )
             conn.executescript(
                 """
                 CREATE TABLE IF NOT EXISTS rooms (
@@ -62,7 +473,21 @@ class DB:
                     groups_found INTEGER NOT NULL DEFAULT 0,
                     groups_added INTEGER NOT NULL DEFAULT 0,
                     errors INTEGER NOT NULL DEFAULT 0,
-                    last_error TEXT
+                    last_error TEXT,
+                    mode TEXT NOT NULL DEFAULT 'full',
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    max_workers INTEGER NOT NULL DEFAULT 0
+                );
+
+                -- Sale runu i postep per sala (checkpoint): po restarcie procesu run jest wznawiany od sal bez 'done'.
+                CREATE TABLE IF NOT EXISTS sync_run_rooms (
+                    run_id INTEGER NOT NULL,
+                    room TEXT NOT NULL,
+                    status TEXT NOT NULL, -- 'pending' | 'done' | 'failed'
+                    last_error TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (run_id, room),
+                    FOREIGN KEY (run_id) REFERENCES sync_runs(id) ON DELETE CASCADE
                 );
 
                 CREATE TABLE IF NOT EXISTS run_groups (
@@ -109,7 +534,8 @@ class DB:
                     FOREIGN KEY (album_number) REFERENCES students(album_number) ON DELETE CASCADE
                 );
 
-                -- Cache pobran zajec dla grup w konkretnym zakresie (start/end jako lokalne ISO bez offsetu).
+                -- Cache pobran zajec dla grup (start/end jako lokalne ISO bez offsetu).
+                -- Wiersze ze status='success' tworza pokrycie grupy: rozlaczne, scalane przedzialy [start_iso, end_iso).
                 CREATE TABLE IF NOT EXISTS group_fetches (
                     group_name TEXT NOT NULL,
                     start_iso TEXT NOT NULL,
@@ -120,35 +546,136 @@ class DB:
                     PRIMARY KEY (group_name, start_iso, end_iso)
                 );
 
+                -- Slownik powtarzajacych sie tekstow zajec (grupy, tytuly, prowadzacy, sale, kolory...).
+                -- Nieuzywane wpisy kasuje prune_lesson_strings(), ale zawsze zostawia wpis z najwiekszym id:
+                -- SQLite nie przydziela wtedy ponownie skasowanych id, wiec id raz przypisane do tekstu sie nie zmienia.
+                CREATE TABLE IF NOT EXISTS lesson_strings (
+                    id INTEGER PRIMARY KEY,
+                    value TEXT NOT NULL UNIQUE
+                );
+
                 -- Zajecia zwracane z ZUT /schedule_student.php?group=...
-                -- start/end przechowujemy w formacie jak w API (lokalne ISO bez offsetu), zeby latwo filtrowac po tygodniach.
+                -- Teksty jako id z lesson_strings; start/end jako minuty od epoki lokalnego czasu sciennego
+                -- (jak w API, bez offsetu), zeby zakresy tygodni byly zwyklym przedzialem liczb.
+                -- first_seen_at/last_seen_at: sekundy od epoki (UTC).
                 CREATE TABLE IF NOT EXISTS lessons (
+                    group_id INTEGER NOT NULL,
+                    start_min INTEGER NOT NULL,
+                    end_min INTEGER NOT NULL,
+                    title_id INTEGER,
+                    description_id INTEGER,
+                    worker_title_id INTEGER,
+                    worker_id INTEGER,
+                    worker_cover_id INTEGER,
+                    lesson_form_id INTEGER,
+                    lesson_form_short_id INTEGER,
+                    tok_name_id INTEGER,
+                    room_id INTEGER,
+                    lesson_status_id INTEGER,
+                    lesson_status_short_id INTEGER,
+                    status_item_id INTEGER,
+                    subject_id INTEGER,
+                    hours_id INTEGER,
+                    color_id INTEGER,
+                    border_color_id INTEGER,
+                    -- hash kolumn tresci; pozwala pominac zapis niezmienionych wierszy przy ponownym pobraniu
+                    content_hash INTEGER,
+                    first_seen_at INTEGER NOT NULL,
+                    last_seen_at INTEGER NOT NULL,
+                    PRIMARY KEY (group_id, start_min, end_min)
+                ) WITHOUT ROWID;
+
+                -- Podglad w starym ksztalcie (do recznych zapytan; kod dekoduje teksty sam, z cache).
+                CREATE VIEW IF NOT EXISTS lessons_decoded AS
+                SELECT
+                    g.value AS group_name,
+                    strftime('%Y-%m-%dT%H:%M:%S', l.start_min * 60, 'unixepoch') AS start,
+                    strftime('%Y-%m-%dT%H:%M:%S', l.end_min * 60, 'unixepoch') AS end,
+                    (SELECT value FROM lesson_strings WHERE id=l.title_id) AS title,
+                    (SELECT value FROM lesson_strings WHERE id=l.description_id) AS description,
+                    (SELECT value FROM lesson_strings WHERE id=l.worker_title_id) AS worker_title,
+                    (SELECT value FROM lesson_strings WHERE id=l.worker_id) AS worker,
+                    (SELECT value FROM lesson_strings WHERE id=l.worker_cover_id) AS worker_cover,
+                    (SELECT value FROM lesson_strings WHERE id=l.lesson_form_id) AS lesson_form,
+                    (SELECT value FROM lesson_strings WHERE id=l.lesson_form_short_id) AS lesson_form_short,
+                    (SELECT value FROM lesson_strings WHERE id=l.tok_name_id) AS tok_name,
+                    (SELECT value FROM lesson_strings WHERE id=l.room_id) AS room,
+                    (SELECT value FROM lesson_strings WHERE id=l.lesson_status_id) AS lesson_status,
+                    (SELECT value FROM lesson_strings WHERE id=l.lesson_status_short_id) AS lesson_status_short,
+                    (SELECT value FROM lesson_strings WHERE id=l.status_item_id) AS status_item,
+                    (SELECT value FROM lesson_strings WHERE id=l.subject_id) AS subject,
+                    (SELECT value FROM lesson_strings WHERE id=l.hours_id) AS hours,
+                    (SELECT value FROM lesson_strings WHERE id=l.color_id) AS color,
+                    (SELECT value FROM lesson_strings WHERE id=l.border_color_id) AS border_color
+                FROM lessons l
+                JOIN lesson_strings g ON g.id = l.group_id;
+
+                -- Zmaterializowane "pozycje do filtra": unikatowe (grupa, tytul, przedmiot, tok, prowadzacy)
+                -- z zakresem wystapien. Utrzymywane triggerami na lessons (0 = NULL).
+                CREATE TABLE IF NOT EXISTS lesson_filter_items (
+                    group_id INTEGER NOT NULL,
+                    title_id INTEGER NOT NULL,
+                    subject_id INTEGER NOT NULL,
+                    tok_name_id INTEGER NOT NULL,
+                    worker_id INTEGER NOT NULL,
+                    worker_title_id INTEGER NOT NULL,
+                    first_min INTEGER NOT NULL,
+                    last_min INTEGER NOT NULL,
+                    lesson_count INTEGER NOT NULL,
+                    PRIMARY KEY (group_id, title_id, subject_id, tok_name_id, worker_id, worker_title_id)
+                ) WITHOUT ROWID;
+
+                -- Dziennik zmian zajec (tylko dopisywany). seq rosnie monotonicznie (AUTOINCREMENT nie uzywa
+                -- ponownie numerow), wiec klient moze pytac o "zmiany od seq".
+                -- kind: added | modified | removed; changed_fields: JSON {kolumna: [stara, nowa]} dla modified.
+                -- Klucz zajec jak w lessons (id grupy + minuty); aktualna tresc bierzemy z lessons przy odczycie.
+                CREATE TABLE IF NOT EXISTS lesson_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id INTEGER NOT NULL,
+                    start_min INTEGER NOT NULL,
+                    end_min INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    changed_fields TEXT,
+                    changed_at TEXT NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_lesson_changes_group ON lesson_changes(group_id, seq);
+
+                -- Indeks sala -> tok_name -> grupa z kazdego skanu sali. Zapisujemy wszystkie tok_name z odpowiedzi
+                -- (nie tylko szukany), zeby jeden skan obslugiwal studentow wszystkich kierunkow.
+                -- window_start/window_end: okno skanu jako ISO w UTC (porownywalne leksykograficznie).
+                CREATE TABLE IF NOT EXISTS room_index (
+                    room TEXT NOT NULL,
+                    window_start TEXT NOT NULL,
+                    window_end TEXT NOT NULL,
+                    tok_name TEXT NOT NULL,
                     group_name TEXT NOT NULL,
-                    start TEXT NOT NULL,
-                    end TEXT NOT NULL,
-                    title TEXT,
-                    description TEXT,
-                    worker_title TEXT,
-                    worker TEXT,
-                    worker_cover TEXT,
-                    lesson_form TEXT,
-                    lesson_form_short TEXT,
-                    tok_name TEXT,
-                    room TEXT,
-                    lesson_status TEXT,
-                    lesson_status_short TEXT,
-                    status_item TEXT,
-                    subject TEXT,
-                    hours TEXT,
-                    color TEXT,
-                    border_color TEXT,
-                    first_seen_at TEXT NOT NULL,
-                    last_seen_at  TEXT NOT NULL,
-                    PRIMARY KEY (group_name, start, end)
+                    seen_at TEXT NOT NULL,
+                    PRIMARY KEY (room, window_start, window_end, tok_name, group_name)
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_room_index_tok ON room_index(tok_name, window_start, window_end);
+
+                -- Zapisane filtry studenta (zamiast pliku JSON). items: JSON [{title, group_name, lecturer, key}].
+                CREATE TABLE IF NOT EXISTS filter_profiles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    album_number TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    selected_tok TEXT,
+                    items TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    UNIQUE (album_number, name)
                 );
 
-                CREATE INDEX IF NOT EXISTS idx_lessons_start ON lessons(start);
-                CREATE INDEX IF NOT EXISTS idx_lessons_group ON lessons(group_name);
+                -- Kiedy sala byla skanowana dla danego okna (rowniez gdy nie bylo w niej zadnych zajec).
+                CREATE TABLE IF NOT EXISTS room_scans (
+                    room TEXT NOT NULL,
+                    window_start TEXT NOT NULL,
+                    window_end TEXT NOT NULL,
+                    scanned_at TEXT NOT NULL,
+                    PRIMARY KEY (room, window_start, window_end)
+                );
                 """
             )
 
@@ -158,6 +685,15 @@ class DB:
                 rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
                 return {str(r["name"]) for r in rows}
 
+            cols = _cols("sync_runs")
+            if "mode" not in cols:
+                conn.execute("ALTER TABLE sync_runs ADD COLUMN mode TEXT NOT NULL DEFAULT 'full';")
+            if "priority" not in cols:
+                conn.execute("ALTER TABLE sync_runs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;")
+            if "max_workers" not in cols:
+                conn.execute("ALTER TABLE sync_runs ADD COLUMN max_workers INTEGER NOT NULL DEFAULT 0;")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_runs_status ON sync_runs(status, priority, id);")
+
             cols = _cols("students")
             if "majors_count" not in cols:
                 conn.execute("ALTER TABLE students ADD COLUMN majors_count INTEGER NOT NULL DEFAULT 1;")
@@ -178,6 +714,196 @@ class DB:
             if "last_seen_at" not in cols:
                 conn.execute("ALTER TABLE student_groups ADD COLUMN last_seen_at TEXT NOT NULL DEFAULT '';")
 
+            legacy = {
+                str(r["name"])
+                for r in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name IN ('lessons_legacy', 'lesson_changes_legacy');"
+                ).fetchall()
+            }
+            if "lessons_legacy" in legacy:
+                self._migrate_legacy_lessons(conn)
+            if "lesson_changes_legacy" in legacy:
+                self._migrate_legacy_lesson_changes(conn)
+            conn.executescript(_filter_item_triggers_sql())
+            if "lessons_legacy" in legacy or (
+                conn.execute("SELECT 1 FROM lessons LIMIT 1;").fetchone() is not None
+                and conn.execute("SELECT 1 FROM lesson_filter_items LIMIT 1;").fetchone() is None
+            ):
+                self._rebuild_filter_items(conn)
+            if legacy and vacuum_after_migration:
+                # VACUUM przepisuje caly plik i blokuje baze na czas trwania, wiec tylko na zyczenie.
+                conn.commit()
+                conn.execute("VACUUM;")
+
+    @classmethod
+    def _migrate_legacy_lessons(cls, conn: sqlite3.Connection) -> None:
+        """
+        lessons_legacy (stary uklad z TEXT) -> lessons (slownik + minuty), w jednej transakcji z DROP starej tabeli.
+        Przerwana migracja zostawia lessons_legacy i jest powtarzana przy nastepnym init().
+        """
+        conn.execute("DELETE FROM lessons;")
+        cols = {str(r["name"]) for r in conn.execute("PRAGMA table_info(lessons_legacy);").fetchall()}
+        seen = [c if c in cols else "''" for c in ("first_seen_at", "last_seen_at")]
+        cur = conn.execute(
+            f"""
+            SELECT group_name, start, end, {", ".join(_LESSON_CONTENT_COLUMNS)}, {seen[0]} AS fs, {seen[1]} AS ls
+            FROM lessons_legacy;
+            """
+        )
+        fallback = int(dt.datetime.now(dt.timezone.utc).timestamp())
+        while True:
+            batch = cur.fetchmany(5000)
+            if not batch:
+                break
+            rows: dict[tuple[str, int, int], tuple] = {}
+            seen_at: dict[tuple[str, int, int], tuple[int, int]] = {}
+            for r in batch:
+                row = _lesson_row(dict(r))
+                if row is None:
+                    continue
+                key = (row[0], _iso_to_min(row[1]), _iso_to_min(row[2]))
+                rows[key] = row
+                seen_at[key] = (cls._epoch_s(r["fs"], fallback), cls._epoch_s(r["ls"], fallback))
+            ids = cls._intern_strings(conn, (v for row in rows.values() for v in (row[0], *row[3:])))
+            conn.executemany(
+                f"""
+                INSERT OR REPLACE INTO lessons(
+                    group_id, start_min, end_min, {", ".join(_LESSON_ID_COLUMNS)},
+                    content_hash, first_seen_at, last_seen_at
+                ) VALUES ({", ".join(["?"] * (len(_LESSON_ID_COLUMNS) + 6))});
+                """,
+                [
+                    (
+                        ids[row[0]],
+                        key[1],
+                        key[2],
+                        *(None if v is None else ids[v] for v in row[3:]),
+                        _lesson_hash(row),
+                        *seen_at[key],
+                    )
+                    for key, row in rows.items()
+                ],
+            )
+        conn.execute("DROP TABLE lessons_legacy;")
+
+    @staticmethod
+    def _rebuild_filter_items(conn: sqlite3.Connection) -> None:
+        cols = ", ".join(_FILTER_ITEM_COLUMNS)
+        conn.execute("DELETE FROM lesson_filter_items;")
+        conn.execute(
+            f"""
+            INSERT INTO lesson_filter_items(group_id, {cols}, first_min, last_min, lesson_count)
+            SELECT group_id, {", ".join(f"COALESCE({c}, 0)" for c in _FILTER_ITEM_COLUMNS)},
+                   MIN(start_min), MAX(start_min), COUNT(*)
+            FROM lessons
+            GROUP BY 1, 2, 3, 4, 5, 6;
+            """
+        )
+
+    @classmethod
+    def _migrate_legacy_lesson_changes(cls, conn: sqlite3.Connection) -> None:
+        # seq przenosimy bez zmian, zeby klienci mogli dalej pytac o "zmiany od seq".
+        conn.execute("DELETE FROM lesson_changes;")
+        rows = conn.execute(
+            "SELECT seq, group_name, start, end, kind, changed_fields, changed_at FROM lesson_changes_legacy;"
+        ).fetchall()
+        ids = cls._intern_strings(conn, (str(r["group_name"]) for r in rows))
+        conn.executemany(
+            """
+            INSERT INTO lesson_changes(seq, group_id, start_min, end_min, kind, changed_fields, changed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            [
+                (
+                    r["seq"],
+                    ids[str(r["group_name"])],
+                    _iso_to_min(r["start"]),
+                    _iso_to_min(r["end"]),
+                    r["kind"],
+                    r["changed_fields"],
+                    r["changed_at"],
+                )
+                for r in rows
+            ],
+        )
+        conn.execute("DROP TABLE lesson_changes_legacy;")
+
+    @staticmethod
+    def _epoch_s(value: object, fallback: int) -> int:
+        try:
+            d = dt.datetime.fromisoformat(str(value))
+        except ValueError:
+            return fallback
+        if d.tzinfo is None:
+            d = d.replace(tzinfo=dt.timezone.utc)
+        return int(d.timestamp())
+
+    @staticmethod
+    def _intern_strings(conn: sqlite3.Connection, values: Iterable[Optional[str]]) -> dict[str, int]:
+        """
+        Zwraca id z lesson_strings dla podanych tekstow, dopisujac brakujace.
+        """
+        vals = list({v for v in values if v is not None})
+        if not vals:
+            return {}
+        conn.executemany("INSERT OR IGNORE INTO lesson_strings(value) VALUES (?);", [(v,) for v in vals])
+        rows = conn.execute(
+            "SELECT id, value FROM lesson_strings WHERE value IN (SELECT value FROM json_each(?));",
+            (json.dumps(vals),),
+        ).fetchall()
+        return {str(r["value"]): int(r["id"]) for r in rows}
+
+    def _decode_strings(self, conn: sqlite3.Connection, ids: Iterable[Optional[int]]) -> dict[int, str]:
+        """
+        id -> tekst z lesson_strings. Cache jest wspolny dla wszystkich watkow: zatwierdzone wpisy sa niezmienne.
+        Odczyty na polaczeniu writera (takze z metod odczytu wolanych wewnatrz transakcji) nie trafiaja
+        do cache, bo moga widziec wpisy z transakcji, ktora zostanie wycofana.
+        """
+        cache = self._strings
+        missing = [i for i in {i for i in ids if i is not None} if i not in cache]
+        if not missing:
+            return cache
+        rows = conn.execute(
+            "SELECT id, value FROM lesson_strings WHERE id IN (SELECT value FROM json_each(?));",
+            (json.dumps(missing),),
+        ).fetchall()
+        found = {int(r["id"]): str(r["value"]) for r in rows}
+        if conn is getattr(self._local, "writer_conn", None):
+            return {**cache, **found}
+        with self._strings_lock:
+            cache.update(found)
+        return cache
+
+    def prune_lesson_strings(self) -> int:
+        """
+        Kasuje z lesson_strings teksty, do ktorych nie odwoluja sie juz lessons ani lesson_changes.
+        Zwraca liczbe skasowanych wpisow.
+        """
+        refs = " UNION ".join(
+            [
+                *(f"SELECT {c} FROM lessons WHERE {c} IS NOT NULL" for c in ("group_id", *_LESSON_ID_COLUMNS)),
+                "SELECT group_id FROM lesson_changes",
+            ]
+        )
+
+        def _tx(conn: sqlite3.Connection) -> int:
+            cur = conn.execute(
+                f"""
+                DELETE FROM lesson_strings
+                WHERE id < (SELECT MAX(id) FROM lesson_strings)
+                  AND id NOT IN ({refs});
+                """
+            )
+            return cur.rowcount
+
+        deleted = self._write(_tx)
+        if deleted:
+            # Skasowane id nie wracaja (patrz lesson_strings), wiec stary cache jest nadal poprawny; podmieniamy
+            # go na pusty zamiast czyscic, bo odczyty w toku moga jeszcze trzymac referencje do starego.
+            with self._strings_lock:
+                self._strings = {}
+        return deleted
+
     @staticmethod
     def _now_iso() -> str:
         return dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
@@ -185,7 +911,8 @@ class DB:
     def upsert_rooms(self, rooms: Iterable[str]) -> None:
         now = self._now_iso()
         rows = [(r, now, now) for r in rooms]
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.executemany(
                 """
                 INSERT INTO rooms(name, first_seen_at, last_seen_at)
@@ -195,34 +922,149 @@ class DB:
                 rows,
             )
 
-    def create_run(self, tok_name: str, start_iso: str, end_iso: str) -> int:
+        self._write(_tx)
+
+    def create_run(self, tok_name: str, start_iso: str, end_iso: str, *, mode: str = "full") -> int:
         now = self._now_iso()
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> int:
             cur = conn.execute(
                 """
-                INSERT INTO sync_runs(tok_name, start_iso, end_iso, created_at, status)
-                VALUES (?, ?, ?, ?, 'queued');
+                INSERT INTO sync_runs(tok_name, start_iso, end_iso, created_at, status, mode)
+                VALUES (?, ?, ?, ?, 'queued', ?);
                 """,
-                (tok_name, start_iso, end_iso, now),
+                (tok_name, start_iso, end_iso, now, mode),
             )
             return int(cur.lastrowid)
 
-    def mark_run_started(self, run_id: int) -> None:
+        return self._write(_tx)
+
+    def enqueue_run(
+        self,
+        tok_name: str,
+        start_iso: str,
+        end_iso: str,
+        *,
+        mode: str = "full",
+        priority: int = 0,
+        max_workers: Optional[int] = None,
+    ) -> tuple[int, bool]:
+        """
+        Dodaje run do kolejki (status 'queued'). Jesli ten sam (tok_name, okno) juz czeka albo trwa
+        (w tym samym trybie albo jako 'full', ktory obejmuje 'incremental'), zwraca istniejacy run
+        (podnoszac mu priorytet, jesli nowy jest wyzszy). Zwraca (run_id, czy_zdeduplikowany).
+        """
         now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> tuple[int, bool]:
+            row = conn.execute(
+                """
+                SELECT id FROM sync_runs
+                WHERE status IN ('queued', 'running')
+                  AND tok_name=? AND start_iso=? AND end_iso=? AND mode IN (?, 'full')
+                ORDER BY id ASC
+                LIMIT 1;
+                """,
+                (tok_name, start_iso, end_iso, mode),
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE sync_runs SET priority=MAX(priority, ?) WHERE id=?;", (int(priority), int(row["id"]))
+                )
+                return int(row["id"]), True
+            cur = conn.execute(
+                """
+                INSERT INTO sync_runs(tok_name, start_iso, end_iso, created_at, status, mode, priority, max_workers)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?);
+                """,
+                (tok_name, start_iso, end_iso, now, mode, int(priority), int(max_workers or 0)),
+            )
+            return int(cur.lastrowid), False
+
+        return self._write(_tx)
+
+    def claim_sync_batch(self) -> list[SyncRun]:
+        """
+        Zabiera z kolejki run o najwyzszym priorytecie razem ze wszystkimi czekajacymi runami z tym samym
+        oknem, trybem i limitem max_workers (inne tok_name): jeden skan sal obsluzy je wszystkie.
+        Run z jawnie nizszym limitem nie spowalnia wiec innych. Oznacza je jako 'running'.
+        """
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> list[SyncRun]:
+            head = conn.execute(
+                "SELECT * FROM sync_runs WHERE status='queued' ORDER BY priority DESC, id ASC LIMIT 1;"
+            ).fetchone()
+            if not head:
+                return []
+            rows = conn.execute(
+                """
+                SELECT id FROM sync_runs
+                WHERE status='queued' AND start_iso=? AND end_iso=? AND mode=? AND max_workers=?
+                ORDER BY priority DESC, id ASC;
+                """,
+                (head["start_iso"], head["end_iso"], head["mode"], head["max_workers"]),
+            ).fetchall()
+            ids = [int(r["id"]) for r in rows]
+            conn.executemany(
+                "UPDATE sync_runs SET started_at=COALESCE(started_at, ?), status='running' WHERE id=?;",
+                [(now, i) for i in ids],
+            )
+            qs = ",".join("?" * len(ids))
+            out = conn.execute(f"SELECT * FROM sync_runs WHERE id IN ({qs}) ORDER BY priority DESC, id ASC;", ids)
+            return [SyncRun(**dict(r)) for r in out.fetchall()]
+
+        return self._write(_tx)
+
+    def requeue_running_runs(self) -> int:
+        """
+        Po starcie procesu: runy 'running' nie maja juz watku (restart w trakcie) - wracaja do kolejki.
+        """
+
+        def _tx(conn: sqlite3.Connection) -> int:
+            return conn.execute("UPDATE sync_runs SET status='queued' WHERE status='running';").rowcount
+
+        return self._write(_tx)
+
+    def cancel_queued_run(self, run_id: int) -> bool:
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> bool:
+            cur = conn.execute(
+                "UPDATE sync_runs SET status='cancelled', finished_at=? WHERE id=? AND status='queued';",
+                (now, int(run_id)),
+            )
+            return bool(cur.rowcount)
+
+        return self._write(_tx)
+
+    def count_queued_runs(self) -> int:
         with self._connect() as conn:
+            return int(conn.execute("SELECT COUNT(*) AS n FROM sync_runs WHERE status='queued';").fetchone()["n"])
+
+    def mark_run_started(self, run_id: int) -> None:
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute(
-                "UPDATE sync_runs SET started_at=?, status='running' WHERE id=?;",
+                # COALESCE: wznowiony run zachowuje pierwotny started_at.
+                "UPDATE sync_runs SET started_at=COALESCE(started_at, ?), status='running' WHERE id=?;",
                 (now, run_id),
             )
 
+        self._write(_tx)
+
     def mark_run_finished(self, run_id: int, status: str, last_error: Optional[str] = None) -> None:
         now = self._now_iso()
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute(
                 "UPDATE sync_runs SET finished_at=?, status=?, last_error=? WHERE id=?;",
                 (now, status, last_error, run_id),
             )
 
+        self._write(_tx)
+
     def update_run_progress(
         self,
         run_id: int,
@@ -260,43 +1102,42 @@ class DB:
 
         params.append(int(run_id))
         sql = f"UPDATE sync_runs SET {', '.join(sets)} WHERE id=?;"
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute(sql, params)
 
+        self._write(_tx)
+
     def add_groups_for_run(self, run_id: int, tok_name: str, groups: Iterable[str]) -> int:
         """
         Zwraca liczbe nowych wpisow dodanych do tabeli `groups` (canonical).
         """
         now = self._now_iso()
-        groups = [g for g in groups if g]
+        groups = sorted({g for g in groups if g})
         if not groups:
             return 0
 
-        run_rows = [(run_id, tok_name, g) for g in groups]
-        canon_rows = [(tok_name, g, now, now) for g in groups]
-        with self._connect() as conn:
+        def _tx(conn: sqlite3.Connection) -> int:
             conn.executemany(
                 "INSERT OR IGNORE INTO run_groups(run_id, tok_name, group_name) VALUES (?, ?, ?);",
-                run_rows,
+                [(run_id, tok_name, g) for g in groups],
             )
 
-            # Liczymy ile nowych grup weszlo do tabeli canonical (INSERT OR IGNORE),
-            # a osobno aktualizujemy last_seen_at dla wszystkich grup.
-            before = conn.total_changes
+            # Jeden upsert: nowe grupy wchodza z first_seen_at, istniejace dostaja tylko last_seen_at.
+            # total_changes liczy tez aktualizacje, wiec nowe wpisy liczymy z roznicy COUNT(*) (po PK).
+            count_sql = "SELECT COUNT(*) AS n FROM groups WHERE tok_name=?;"
+            before = int(conn.execute(count_sql, (tok_name,)).fetchone()["n"])
             conn.executemany(
                 """
-                INSERT OR IGNORE INTO groups(tok_name, group_name, first_seen_at, last_seen_at)
+                INSERT INTO groups(tok_name, group_name, first_seen_at, last_seen_at)
                 VALUES (?, ?, ?, ?)
+                ON CONFLICT(tok_name, group_name) DO UPDATE SET last_seen_at=excluded.last_seen_at;
                 """,
-                canon_rows,
+                [(tok_name, g, now, now) for g in groups],
             )
-            added = conn.total_changes - before
+            return int(conn.execute(count_sql, (tok_name,)).fetchone()["n"]) - before
 
-            conn.executemany(
-                "UPDATE groups SET last_seen_at=? WHERE tok_name=? AND group_name=?;",
-                [(now, tok_name, g) for g in groups],
-            )
-        return int(added)
+        return self._write(_tx)
 
     def get_run(self, run_id: int) -> Optional[SyncRun]:
         with self._connect() as conn:
@@ -320,6 +1161,72 @@ class DB:
                 return None
             return SyncRun(**dict(row))
 
+    def list_unfinished_runs(self) -> list[SyncRun]:
+        """
+        Runy w stanie queued/running (po starcie procesu: osierocone przez restart), od najstarszego.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM sync_runs WHERE status IN ('queued', 'running') ORDER BY id ASC;"
+            ).fetchall()
+            return [SyncRun(**dict(r)) for r in rows]
+
+    def add_run_rooms(self, run_id: int, rooms: Iterable[str]) -> None:
+        """
+        Zapisuje liste sal runu (status 'pending'); przy wznowieniu run skanuje dokladnie te sale.
+        """
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO sync_run_rooms(run_id, room, status, last_error, updated_at)
+                VALUES (?, ?, 'pending', NULL, ?);
+                """,
+                [(run_id, str(r), now) for r in rooms],
+            )
+
+        self._write(_tx)
+
+    def record_run_room(self, run_id: int, room: str, *, error: Optional[str] = None) -> None:
+        self.record_run_rooms(run_id, [(room, error)])
+
+    def record_run_rooms(self, run_id: int, results: Iterable[tuple[str, Optional[str]]]) -> None:
+        """
+        Checkpointy wielu sal naraz: (sala, blad albo None) -> 'failed' / 'done'.
+        """
+        now = self._now_iso()
+        rows = [
+            (run_id, str(room), "failed" if error is not None else "done", error, now) for room, error in results
+        ]
+        if not rows:
+            return
+
+        def _tx(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                INSERT INTO sync_run_rooms(run_id, room, status, last_error, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(run_id, room) DO UPDATE SET
+                    status=excluded.status,
+                    last_error=excluded.last_error,
+                    updated_at=excluded.updated_at;
+                """,
+                rows,
+            )
+
+        self._write(_tx)
+
+    def list_run_rooms(self, run_id: int) -> dict[str, str]:
+        """
+        sala -> status ('pending' / 'done' / 'failed') dla wszystkich sal runu.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT room, status FROM sync_run_rooms WHERE run_id=? ORDER BY room ASC;", (run_id,)
+            ).fetchall()
+            return {str(r["room"]): str(r["status"]) for r in rows}
+
     def list_groups_for_run(self, run_id: int, tok_name: str) -> list[str]:
         with self._connect() as conn:
             rows = conn.execute(
@@ -337,6 +1244,137 @@ class DB:
             rows = conn.execute("SELECT name FROM rooms ORDER BY name ASC;").fetchall()
             return [r["name"] for r in rows]
 
+    def list_rooms_if_fresh(self, *, max_age_s: float) -> list[str]:
+        """
+        Lista sal, o ile byla odswiezana z ZUT w ciagu max_age_s; inaczej pusta lista.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(last_seen_at) AS ts FROM rooms;").fetchone()
+            if not row or not row["ts"] or str(row["ts"]) < self._max_age_cutoff(max_age_s):
+                return []
+            rows = conn.execute("SELECT name FROM rooms ORDER BY name ASC;").fetchall()
+            return [r["name"] for r in rows]
+
+    # ----------------------------
+    # Indeks sala -> tok_name -> grupa (room_index / room_scans)
+    # ----------------------------
+
+    @staticmethod
+    def _utc_iso(value: str) -> str:
+        """
+        Okna skanow normalizujemy do UTC, bo syncer i discovery podaja ISO z roznymi offsetami (+01:00/+02:00).
+        ISO bez offsetu traktujemy jak czas lokalny Europe/Warsaw (tak jak reszta backendu).
+        """
+        dtt = dt.datetime.fromisoformat(str(value).strip())
+        if dtt.tzinfo is None:
+            dtt = dtt.replace(tzinfo=WARSAW)
+        return dtt.astimezone(dt.timezone.utc).isoformat(timespec="seconds")
+
+    @classmethod
+    def _max_age_cutoff(cls, max_age_s: float) -> str:
+        ts = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=float(max_age_s))
+        return ts.isoformat(timespec="seconds")
+
+    def record_room_scan(
+        self, room: str, window_start: str, window_end: str, groups_by_tok: dict[str, Iterable[str]]
+    ) -> None:
+        """
+        Zapisuje wynik skanu jednej sali (wszystkie tok_name z odpowiedzi).
+        Skany tej sali z okien zawartych w nowym oknie sa zastepowane (zeby indeks nie puchl po codziennych syncach).
+        """
+        now = self._now_iso()
+        room = str(room).strip()
+        ws = self._utc_iso(window_start)
+        we = self._utc_iso(window_end)
+        rows = [
+            (room, ws, we, str(t), str(g), now)
+            for t, gs in groups_by_tok.items()
+            if t
+            for g in gs
+            if g
+        ]
+
+        def _tx(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "DELETE FROM room_index WHERE room=? AND window_start>=? AND window_end<=?;",
+                (room, ws, we),
+            )
+            conn.execute(
+                "DELETE FROM room_scans WHERE room=? AND window_start>=? AND window_end<=?;",
+                (room, ws, we),
+            )
+            conn.execute(
+                "INSERT INTO room_scans(room, window_start, window_end, scanned_at) VALUES (?, ?, ?, ?);",
+                (room, ws, we, now),
+            )
+            if rows:
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO room_index(room, window_start, window_end, tok_name, group_name, seen_at)
+                    VALUES (?, ?, ?, ?, ?, ?);
+                    """,
+                    rows,
+                )
+
+        self._write(_tx)
+
+    def list_rooms_with_fresh_scan(self, window_start: str, window_end: str, *, max_age_s: float) -> set[str]:
+        """
+        Sale, ktorych swieze skany (nie starsze niz max_age_s) razem pokrywaja cale okno [window_start, window_end].
+        Okno moze byc zlozone z kilku skanow, np. tygodni z syncu incremental i szerszego okna pelnego syncu.
+        """
+        ws = self._utc_iso(window_start)
+        we = self._utc_iso(window_end)
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT room, window_start, window_end FROM room_scans
+                WHERE window_start<? AND window_end>? AND scanned_at>=?;
+                """,
+                (we, ws, self._max_age_cutoff(max_age_s)),
+            ).fetchall()
+        by_room: dict[str, list[tuple[str, str]]] = {}
+        for r in rows:
+            by_room.setdefault(str(r["room"]), []).append((str(r["window_start"]), str(r["window_end"])))
+        return {room for room, windows in by_room.items() if self._scans_cover(windows, ws, we)}
+
+    @classmethod
+    def _scans_cover(cls, windows: list[tuple[str, str]], ws: str, we: str) -> bool:
+        # Okna syncu koncza sie o 23:59:59, a tygodnie i discovery o 00:00 - sekunda przerwy miedzy skanami
+        # to nie luka.
+        return all(
+            dt.datetime.fromisoformat(e) - dt.datetime.fromisoformat(s) <= dt.timedelta(seconds=1)
+            for s, e in cls.coverage_gaps(windows, ws, we)
+        )
+
+    def list_groups_from_room_index(
+        self, tok_names: Iterable[str], window_start: str, window_end: str, *, max_age_s: float
+    ) -> dict[str, set[str]]:
+        """
+        tok_name -> grupy z indeksu, ze swiezych skanow, ktorych okno nachodzi na [window_start, window_end].
+        """
+        toks = sorted({t for t in (str(x).strip() for x in tok_names) if t})
+        if not toks:
+            return {}
+        ws = self._utc_iso(window_start)
+        we = self._utc_iso(window_end)
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT DISTINCT i.tok_name, i.group_name
+                FROM room_index i
+                JOIN room_scans s
+                  ON s.room=i.room AND s.window_start=i.window_start AND s.window_end=i.window_end
+                WHERE i.tok_name IN (SELECT value FROM json_each(?))
+                  AND i.window_start<? AND i.window_end>? AND s.scanned_at>=?;
+                """,
+                (json.dumps(toks), we, ws, self._max_age_cutoff(max_age_s)),
+            ).fetchall()
+        out: dict[str, set[str]] = {}
+        for r in rows:
+            out.setdefault(str(r["tok_name"]), set()).add(str(r["group_name"]))
+        return out
+
     # ----------------------------
     # Student workflow (album -> tok_name -> grupy -> zajecia)
     # ----------------------------
@@ -344,7 +1382,8 @@ class DB:
     def upsert_student(self, album_number: str, majors_count: int) -> None:
         now = self._now_iso()
         album_number = str(album_number).strip()
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute(
                 """
                 INSERT INTO students(album_number, majors_count, created_at, updated_at)
@@ -356,12 +1395,70 @@ class DB:
                 (album_number, int(majors_count), now, now),
             )
 
+        self._write(_tx)
+
     def student_exists(self, album_number: str) -> bool:
         album_number = str(album_number).strip()
         with self._connect() as conn:
             row = conn.execute("SELECT 1 FROM students WHERE album_number=?;", (album_number,)).fetchone()
             return bool(row)
 
+    def upsert_filter_profile(
+        self, album_number: str, name: str, *, selected_tok: Optional[str], items: list[dict]
+    ) -> dict:
+        """
+        Zapisuje profil filtrow (klucz: album_number + name). Zwraca zapisany profil.
+        """
+        now = self._now_iso()
+        album_number = str(album_number).strip()
+        name = str(name).strip()
+
+        def _tx(conn: sqlite3.Connection) -> dict:
+            conn.execute(
+                """
+                INSERT INTO filter_profiles(album_number, name, selected_tok, items, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(album_number, name) DO UPDATE SET
+                    selected_tok=excluded.selected_tok,
+                    items=excluded.items,
+                    updated_at=excluded.updated_at;
+                """,
+                (album_number, name, selected_tok, json.dumps(items, ensure_ascii=False), now, now),
+            )
+            row = conn.execute(
+                "SELECT * FROM filter_profiles WHERE album_number=? AND name=?;", (album_number, name)
+            ).fetchone()
+            return self._filter_profile_dict(row)
+
+        return self._write(_tx)
+
+    def get_filter_profile(self, profile_id: int) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM filter_profiles WHERE id=?;", (int(profile_id),)).fetchone()
+            return self._filter_profile_dict(row) if row else None
+
+    def list_filter_profiles(self, album_number: str) -> list[dict]:
+        album_number = str(album_number).strip()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM filter_profiles WHERE album_number=? ORDER BY updated_at DESC, id DESC;",
+                (album_number,),
+            ).fetchall()
+            return [self._filter_profile_dict(r) for r in rows]
+
+    def delete_filter_profile(self, profile_id: int) -> bool:
+        def _tx(conn: sqlite3.Connection) -> bool:
+            cur = conn.execute("DELETE FROM filter_profiles WHERE id=?;", (int(profile_id),))
+            return bool(cur.rowcount)
+
+        return self._write(_tx)
+
+    @staticmethod
+    def _filter_profile_dict(row: sqlite3.Row) -> dict:
+        d = dict(row)
+        d["items"] = json.loads(d["items"] or "[]")
+        return d
+
     def replace_student_tok_names(self, album_number: str, tok_names: Iterable[str]) -> None:
         """
         Nadpisuje tok_name dla studenta (uzywane przy force refresh).
@@ -369,7 +1466,8 @@ class DB:
         now = self._now_iso()
         album_number = str(album_number).strip()
         tok_names = [t for t in (str(x).strip() for x in tok_names) if t]
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute("DELETE FROM student_tok_names WHERE album_number=?;", (album_number,))
             if tok_names:
                 conn.executemany(
@@ -380,6 +1478,8 @@ class DB:
                     [(album_number, t, now, now) for t in tok_names],
                 )
 
+        self._write(_tx)
+
     def list_student_tok_names(self, album_number: str) -> list[str]:
         album_number = str(album_number).strip()
         with self._connect() as conn:
@@ -401,7 +1501,8 @@ class DB:
         album_number = str(album_number).strip()
         tok_name = str(tok_name).strip()
         groups = [g for g in (str(x).strip() for x in groups) if g]
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute(
                 "DELETE FROM student_groups WHERE album_number=? AND tok_name=?;",
                 (album_number, tok_name),
@@ -415,11 +1516,16 @@ class DB:
                     [(album_number, tok_name, g, now, now) for g in groups],
                 )
 
+        self._write(_tx)
+
     def clear_student_groups(self, album_number: str) -> None:
         album_number = str(album_number).strip()
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
             conn.execute("DELETE FROM student_groups WHERE album_number=?;", (album_number,))
 
+        self._write(_tx)
+
     def delete_student_groups_not_in_tok_names(self, album_number: str, tok_names: Iterable[str]) -> int:
         """
         Usuwa mapowania grup dla tok_name, ktore nie sa juz przypisane studentowi.
@@ -427,7 +1533,8 @@ class DB:
         """
         album_number = str(album_number).strip()
         toks = [t for t in (str(x).strip() for x in tok_names) if t]
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> int:
             if not toks:
                 cur = conn.execute("DELETE FROM student_groups WHERE album_number=?;", (album_number,))
                 return int(cur.rowcount or 0)
@@ -437,6 +1544,8 @@ class DB:
             cur = conn.execute(sql, [album_number, *toks])
             return int(cur.rowcount or 0)
 
+        return self._write(_tx)
+
     def list_student_groups(self, album_number: str) -> dict[str, list[str]]:
         album_number = str(album_number).strip()
         with self._connect() as conn:
@@ -492,7 +1601,8 @@ class DB:
             return 0
 
         rows = [(tok_name, g, now, now) for g in groups]
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> int:
             before = conn.total_changes
             conn.executemany(
                 """
@@ -506,7 +1616,9 @@ class DB:
                 "UPDATE groups SET last_seen_at=? WHERE tok_name=? AND group_name=?;",
                 [(now, tok_name, g) for g in groups],
             )
-        return int(added)
+            return int(added)
+
+        return self._write(_tx)
 
     def get_group_fetch_status(self, group_name: str, start_iso: str, end_iso: str) -> Optional[str]:
         group_name = str(group_name).strip()
@@ -531,11 +1643,20 @@ class DB:
         status: str,
         last_error: Optional[str] = None,
     ) -> None:
+        """
+        Zapisuje wynik pobrania zakresu dla grupy.
+        status='success' dopisuje przedzial do pokrycia grupy (scalajac nachodzace/sasiednie przedzialy),
+        inne statusy zapisuja sie jako osobny wiersz diagnostyczny.
+        """
         now = self._now_iso()
         group_name = str(group_name).strip()
         start_iso = str(start_iso).strip()
         end_iso = str(end_iso).strip()
-        with self._connect() as conn:
+
+        def _tx(conn: sqlite3.Connection) -> None:
+            if str(status) == "success":
+                self._merge_group_coverage(conn, group_name, start_iso, end_iso, now)
+                return
             conn.execute(
                 """
                 INSERT INTO group_fetches(group_name, start_iso, end_iso, fetched_at, status, last_error)
@@ -548,137 +1669,384 @@ class DB:
                 (group_name, start_iso, end_iso, now, str(status), last_error),
             )
 
-    def upsert_lessons(self, lessons: Iterable[dict]) -> int:
+        return self._write(_tx)
+
+    # Sasiednie przedzialy pokrycia scalamy tylko, gdy pobrano je w podobnym czasie,
+    # inaczej scalenie "odswiezyloby" stary fragment (TTL liczymy od fetched_at przedzialu).
+    COVERAGE_MERGE_SLACK_S = 3600
+
+    @classmethod
+    def _merge_group_coverage(
+        cls, conn: sqlite3.Connection, group_name: str, start_iso: str, end_iso: str, now: str
+    ) -> None:
         """
-        Upsertuje zajecia (key: group_name + start + end). Zwraca liczbe nowych rekordow.
+        Pokrycie grupy = wiersze group_fetches ze status='success' (rozlaczne przedzialy [start_iso, end_iso)).
+
+        Nowy przedzial zastepuje nachodzace fragmenty starszych (czesci poza nim zostaja z wlasnym fetched_at),
+        a potem jest scalany ze stykajacymi sie sasiadami pobranymi w podobnym czasie. Bledy wewnatrz kasujemy.
         """
-        now = self._now_iso()
-        rows: list[tuple] = []
-        for ev in lessons:
-            if not isinstance(ev, dict):
-                continue
-            group_name = ev.get("group_name")
-            start = ev.get("start")
-            end = ev.get("end")
-            if not group_name or not start or not end:
-                continue
+        rows = conn.execute(
+            """
+            SELECT start_iso, end_iso, fetched_at FROM group_fetches
+            WHERE group_name=? AND status='success' AND start_iso<=? AND end_iso>=?;
+            """,
+            (group_name, end_iso, start_iso),
+        ).fetchall()
 
-            rows.append(
-                (
-                    str(group_name),
-                    str(start),
-                    str(end),
-                    ev.get("title"),
-                    ev.get("description"),
-                    ev.get("worker_title"),
-                    ev.get("worker"),
-                    ev.get("worker_cover"),
-                    ev.get("lesson_form"),
-                    ev.get("lesson_form_short"),
-                    ev.get("tok_name"),
-                    ev.get("room"),
-                    ev.get("lesson_status"),
-                    ev.get("lesson_status_short"),
-                    ev.get("status_item"),
-                    ev.get("subject"),
-                    ev.get("hours"),
-                    ev.get("color"),
-                    ev.get("borderColor") if "borderColor" in ev else ev.get("border_color"),
-                    now,
-                    now,
-                )
-            )
+        keep: list[tuple[str, str, str]] = []
+        new_start, new_end, new_fetched = start_iso, end_iso, now
+        for r in rows:
+            s, e, f = str(r["start_iso"]), str(r["end_iso"]), str(r["fetched_at"])
+            pieces = [(s, min(e, start_iso)), (max(s, end_iso), e)]
+            for ps, pe in pieces:
+                if ps >= pe:
+                    continue
+                if (pe == new_start or ps == new_end) and cls._fetched_close(f, now):
+                    new_start, new_end = min(new_start, ps), max(new_end, pe)
+                    new_fetched = min(new_fetched, f)
+                else:
+                    keep.append((ps, pe, f))
 
-        if not rows:
-            return 0
+        lo = min([new_start, *(str(r["start_iso"]) for r in rows)])
+        hi = max([new_end, *(str(r["end_iso"]) for r in rows)])
+        conn.execute(
+            "DELETE FROM group_fetches WHERE group_name=? AND start_iso>=? AND end_iso<=?;",
+            (group_name, lo, hi),
+        )
+        conn.executemany(
+            """
+            INSERT INTO group_fetches(group_name, start_iso, end_iso, fetched_at, status, last_error)
+            VALUES (?, ?, ?, ?, 'success', NULL)
+            ON CONFLICT(group_name, start_iso, end_iso) DO UPDATE SET
+                fetched_at=excluded.fetched_at,
+                status=excluded.status,
+                last_error=NULL;
+            """,
+            [(group_name, ps, pe, f) for ps, pe, f in [*keep, (new_start, new_end, new_fetched)]],
+        )
+
+    @classmethod
+    def _fetched_close(cls, a: str, b: str) -> bool:
+        try:
+            delta = dt.datetime.fromisoformat(a) - dt.datetime.fromisoformat(b)
+        except ValueError:
+            return False
+        return abs(delta.total_seconds()) <= cls.COVERAGE_MERGE_SLACK_S
 
+    def get_group_coverage(self, group_name: str, start_iso: str, end_iso: str) -> list[tuple[str, str, str]]:
+        """
+        Przedzialy pokrycia (start_iso, end_iso, fetched_at) nachodzace na [start_iso, end_iso), rosnaco.
+        """
+        group_name = str(group_name).strip()
+        start_iso = str(start_iso).strip()
+        end_iso = str(end_iso).strip()
         with self._connect() as conn:
-            before = conn.total_changes
-            conn.executemany(
+            rows = conn.execute(
+                """
+                SELECT start_iso, end_iso, fetched_at FROM group_fetches
+                WHERE group_name=? AND status='success' AND start_iso<? AND end_iso>?
+                ORDER BY start_iso ASC;
+                """,
+                (group_name, end_iso, start_iso),
+            ).fetchall()
+        return [(str(r["start_iso"]), str(r["end_iso"]), str(r["fetched_at"])) for r in rows]
+
+    def get_group_coverage_bulk(
+        self, groups: Iterable[str], start_iso: str, end_iso: str
+    ) -> dict[str, list[tuple[str, str, str]]]:
+        """
+        Jak get_group_coverage, ale dla wielu grup jednym zapytaniem: group_name -> przedzialy (rosnaco).
+        Grupy bez pokrycia maja pusta liste.
+        """
+        groups = [g for g in (str(x).strip() for x in groups) if g]
+        start_iso = str(start_iso).strip()
+        end_iso = str(end_iso).strip()
+        out: dict[str, list[tuple[str, str, str]]] = {g: [] for g in groups}
+        with self._connect() as conn:
+            rows = conn.execute(
                 """
+                SELECT group_name, start_iso, end_iso, fetched_at FROM group_fetches
+                WHERE group_name IN (SELECT value FROM json_each(?)) AND status='success' AND start_iso<? AND end_iso>?
+                ORDER BY group_name ASC, start_iso ASC;
+                """,
+                (json.dumps(groups), end_iso, start_iso),
+            ).fetchall()
+        for r in rows:
+            out[str(r["group_name"])].append((str(r["start_iso"]), str(r["end_iso"]), str(r["fetched_at"])))
+        return out
+
+    def get_group_fetch_gaps(self, group_name: str, start_iso: str, end_iso: str) -> list[tuple[str, str]]:
+        """
+        Podprzedzialy [start_iso, end_iso), ktore nie sa pokryte udanymi pobraniami grupy.
+        Pusta lista = caly zakres jest w cache.
+        """
+        coverage = self.get_group_coverage(group_name, start_iso, end_iso)
+        return self.coverage_gaps([(s, e) for s, e, _ in coverage], str(start_iso).strip(), str(end_iso).strip())
+
+    @staticmethod
+    def coverage_gaps(intervals: list[tuple[str, str]], start_iso: str, end_iso: str) -> list[tuple[str, str]]:
+        gaps: list[tuple[str, str]] = []
+        cur = start_iso
+        for s, e in sorted(intervals):
+            if s > cur:
+                gaps.append((cur, min(s, end_iso)))
+            if e > cur:
+                cur = e
+            if cur >= end_iso:
+                break
+        if cur < end_iso:
+            gaps.append((cur, end_iso))
+        return [(s, e) for s, e in gaps if s < e]
+
+    def upsert_lessons(self, lessons: Iterable[dict]) -> LessonDiff:
+        """
+        Upsertuje zajecia (key: group_name + start + end) bez kasowania.
+        Niezmienione wiersze (ten sam content_hash) nie sa zapisywane. Zwraca dokladne liczniki.
+        """
+        by_group: dict[str, dict[tuple[int, int], tuple]] = {}
+        for ev in lessons:
+            row = _lesson_row(ev)
+            if row is not None:
+                by_group.setdefault(row[0], {})[(_iso_to_min(row[1]), _iso_to_min(row[2]))] = row
+        if not by_group:
+            return LessonDiff()
+
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> LessonDiff:
+            diff = LessonDiff()
+            for group_name, rows in by_group.items():
+                lo = min(k[0] for k in rows)
+                hi = max(k[0] for k in rows)
+                existing = self._lesson_hashes(conn, group_name, lo, hi + 1)
+                diff = diff + self._apply_lesson_rows(conn, rows, existing, now)
+            return diff
+
+        return self._write(_tx)
+
+    @staticmethod
+    def _lesson_hashes(
+        conn: sqlite3.Connection, group_name: str, start_min: int, end_min: int
+    ) -> dict[tuple[int, int], Optional[int]]:
+        """
+        (start_min, end_min) -> content_hash dla zajec grupy zaczynajacych sie w [start_min, end_min).
+        """
+        rows = conn.execute(
+            """
+            SELECT start_min, end_min, content_hash FROM lessons
+            WHERE group_id=(SELECT id FROM lesson_strings WHERE value=?)
+              AND start_min >= ? AND start_min < ?;
+            """,
+            (group_name, start_min, end_min),
+        ).fetchall()
+        return {(int(r["start_min"]), int(r["end_min"])): r["content_hash"] for r in rows}
+
+    def _apply_lesson_rows(
+        self,
+        conn: sqlite3.Connection,
+        rows: dict[tuple[int, int], tuple],
+        existing: dict[tuple[int, int], Optional[int]],
+        now: str,
+    ) -> LessonDiff:
+        """
+        Zapisuje tylko nowe i zmienione wiersze. existing: (start_min, end_min) -> content_hash w DB.
+        last_seen_at zmienia sie tylko przy zmianie tresci (swiezosc zakresu trzyma group_fetches.fetched_at).
+        """
+        now_s = self._epoch_s(now, 0)
+        inserts: list[tuple[tuple[int, int], tuple, int]] = []
+        updates: list[tuple[tuple[int, int], tuple, int]] = []
+        unchanged = 0
+        for key, row in rows.items():
+            h = _lesson_hash(row)
+            if key not in existing:
+                inserts.append((key, row, h))
+            elif existing[key] != h:
+                updates.append((key, row, h))
+            else:
+                unchanged += 1
+        if not inserts and not updates:
+            return LessonDiff(unchanged=unchanged)
+
+        ids = self._intern_strings(conn, (v for _, row, _ in (*inserts, *updates) for v in (row[0], *row[3:])))
+
+        def _content_ids(row: tuple) -> tuple:
+            return tuple(None if v is None else ids[v] for v in row[3:])
+
+        changes: list[tuple] = [(row[0], *key, "added", None, now) for key, row, _ in inserts]
+        for key, row, _ in updates:
+            old = conn.execute(
+                f"""
+                SELECT {", ".join(_LESSON_ID_COLUMNS)} FROM lessons
+                WHERE group_id=? AND start_min=? AND end_min=?;
+                """,
+                (ids[row[0]], *key),
+            ).fetchone()
+            old_ids = tuple(old) if old is not None else (None,) * len(_LESSON_ID_COLUMNS)
+            strings = self._decode_strings(conn, old_ids)
+            changed = {
+                col: [None if old_id is None else strings.get(old_id), new]
+                for col, old_id, new in zip(_LESSON_CONTENT_COLUMNS, old_ids, row[3:])
+                if (None if old_id is None else strings.get(old_id)) != new
+            }
+            # Wiersz bez content_hash (sprzed hashy) z ta sama trescia: tylko uzupelniamy hash, bez wpisu w logu.
+            if changed:
+                changes.append((row[0], *key, "modified", json.dumps(changed, ensure_ascii=False), now))
+
+        if inserts:
+            conn.executemany(
+                f"""
                 INSERT INTO lessons(
-                    group_name, start, end,
-                    title, description,
-                    worker_title, worker, worker_cover,
-                    lesson_form, lesson_form_short,
-                    tok_name, room,
-                    lesson_status, lesson_status_short,
-                    status_item, subject, hours,
-                    color, border_color,
-                    first_seen_at, last_seen_at
-                ) VALUES (
-                    ?, ?, ?,
-                    ?, ?,
-                    ?, ?, ?,
-                    ?, ?,
-                    ?, ?,
-                    ?, ?,
-                    ?, ?, ?,
-                    ?, ?,
-                    ?, ?
-                )
-                ON CONFLICT(group_name, start, end) DO UPDATE SET
-                    title=excluded.title,
-                    description=excluded.description,
-                    worker_title=excluded.worker_title,
-                    worker=excluded.worker,
-                    worker_cover=excluded.worker_cover,
-                    lesson_form=excluded.lesson_form,
-                    lesson_form_short=excluded.lesson_form_short,
-                    tok_name=excluded.tok_name,
-                    room=excluded.room,
-                    lesson_status=excluded.lesson_status,
-                    lesson_status_short=excluded.lesson_status_short,
-                    status_item=excluded.status_item,
-                    subject=excluded.subject,
-                    hours=excluded.hours,
-                    color=excluded.color,
-                    border_color=excluded.border_color,
-                    last_seen_at=excluded.last_seen_at;
+                    group_id, start_min, end_min, {", ".join(_LESSON_ID_COLUMNS)},
+                    content_hash, first_seen_at, last_seen_at
+                ) VALUES ({", ".join(["?"] * (len(_LESSON_ID_COLUMNS) + 6))});
                 """,
-                rows,
+                [(ids[row[0]], *key, *_content_ids(row), h, now_s, now_s) for key, row, h in inserts],
+            )
+        if updates:
+            conn.executemany(
+                f"""
+                UPDATE lessons SET
+                    {", ".join(f"{col}=?" for col in _LESSON_ID_COLUMNS)},
+                    content_hash=?,
+                    last_seen_at=?
+                WHERE group_id=? AND start_min=? AND end_min=?;
+                """,
+                [(*_content_ids(row), h, now_s, ids[row[0]], *key) for key, row, h in updates],
             )
-            # conn.total_changes policzy rowniez update; interesuje nas tylko "nowe".
-            # SQLite nie podaje tego latwo, wiec szacujemy po zmianie liczby wierszy (SELECT changes() tez miesza update).
-            # Pragmatycznie: zwracamy ile "insertowalo lub zupsertowalo" (>= nowe).
-            return int(conn.total_changes - before)
+        self._log_lesson_changes(conn, changes)
+        return LessonDiff(inserted=len(inserts), updated=len(updates), unchanged=unchanged)
+
+    @classmethod
+    def _log_lesson_changes(cls, conn: sqlite3.Connection, changes: list[tuple]) -> None:
+        """
+        changes: (group_name, start_min, end_min, kind, changed_fields_json, changed_at).
+        """
+        if not changes:
+            return
+        ids = cls._intern_strings(conn, (c[0] for c in changes))
+        conn.executemany(
+            """
+            INSERT INTO lesson_changes(group_id, start_min, end_min, kind, changed_fields, changed_at)
+            VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            [(ids[c[0]], *c[1:]) for c in changes],
+        )
 
-    def list_lessons_for_groups(self, groups: Iterable[str], start: str, end: str) -> list[dict]:
+    def list_lessons_for_groups(
+        self, groups: Iterable[str], start: str, end: str, *, lesson_filter: Optional[LessonFilter] = None
+    ) -> list[dict]:
         """
         Zwraca zajecia dla podanych grup w zakresie [start, end).
         start/end: lokalne ISO bez offsetu (np. 2026-03-16T00:00:00)
+        lesson_filter: tylko zajecia pasujace do filtra (warunek w SQL, patrz _filter_item_keys).
+        """
+        with self._connect() as conn:
+            return list(self._iter_lessons(conn, groups, start, end, lesson_filter=lesson_filter))
+
+    def iter_lessons_for_groups(
+        self, groups: Iterable[str], start: str, end: str, *, lesson_filter: Optional[LessonFilter] = None
+    ) -> Iterator[dict]:
         """
+        Jak list_lessons_for_groups, ale generator po kursorze (paczkami), bez budowania calej listy.
+        Uzywa wlasnego polaczenia: kolejne next() moga przyjsc z roznych watkow (np. StreamingResponse),
+        a polaczenia z _connect() sa przypisane do watku. Polaczenie zamykamy po wyczerpaniu/zamknieciu generatora.
+        """
+        conn = self._new_connection()
+        try:
+            conn.execute("PRAGMA query_only=ON;")
+            yield from self._iter_lessons(conn, groups, start, end, lesson_filter=lesson_filter)
+        finally:
+            conn.close()
+
+    def _iter_lessons(
+        self,
+        conn: sqlite3.Connection,
+        groups: Iterable[str],
+        start: str,
+        end: str,
+        *,
+        lesson_filter: Optional[LessonFilter] = None,
+        batch_size: int = 500,
+    ) -> Iterator[dict]:
         groups = [g for g in (str(x).strip() for x in groups) if g]
         if not groups:
-            return []
-        start = str(start).strip()
-        end = str(end).strip()
+            return
+        start_min, end_min = _iso_to_min(start), _iso_to_min(end)
+        if lesson_filter is None:
+            cur = conn.execute(
+                f"""
+                SELECT l.group_id, l.start_min, l.end_min, {", ".join(f"l.{col}" for col in _LESSON_ID_COLUMNS)}
+                FROM lessons l
+                JOIN lesson_strings g ON g.id = l.group_id
+                WHERE l.group_id IN ({_GROUP_IDS_SQL})
+                  AND l.start_min >= ?
+                  AND l.start_min < ?
+                ORDER BY l.start_min ASC, g.value ASC;
+                """,
+                (json.dumps(groups), start_min, end_min),
+            )
+        else:
+            keys = self._filter_item_keys(conn, groups, lesson_filter)
+            if not keys:
+                return
+            # Klucze pozycji filtra (jak w lesson_filter_items) -> zajecia: zakres po PK dla kazdej grupy
+            # z dopasowanych pozycji, potem dokladne dopasowanie krotki.
+            cur = conn.execute(
+                f"""
+                SELECT l.group_id, l.start_min, l.end_min, {", ".join(f"l.{col}" for col in _LESSON_ID_COLUMNS)}
+                FROM lessons l
+                JOIN lesson_strings g ON g.id = l.group_id
+                WHERE l.group_id IN (SELECT DISTINCT json_extract(value, '$[0]') FROM json_each(?1))
+                  AND l.start_min >= ?2
+                  AND l.start_min < ?3
+                  AND (l.group_id, {", ".join(f"COALESCE(l.{c}, 0)" for c in _FILTER_ITEM_COLUMNS)}) IN (
+                      SELECT {", ".join(f"json_extract(value, '$[{i}]')" for i in range(len(_FILTER_ITEM_COLUMNS) + 1))}
+                      FROM json_each(?1)
+                  )
+                ORDER BY l.start_min ASC, g.value ASC;
+                """,
+                (json.dumps(keys), start_min, end_min),
+            )
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                strings = self._decode_strings(conn, (i for r in rows for i in (r[0], *r[3:])))
+                for r in rows:
+                    yield _decode_lesson(strings, r[0], r[1], r[2], r[3:])
+        finally:
+            cur.close()
 
-        # SQLite ma limit na liczbe parametrow w IN (...); chunkujemy.
-        out: list[dict] = []
-        chunk_size = 900
-        with self._connect() as conn:
-            for i in range(0, len(groups), chunk_size):
-                chunk = groups[i : i + chunk_size]
-                qs = ",".join(["?"] * len(chunk))
-                sql = f"""
-                SELECT
-                    group_name, start, end,
-                    title, description,
-                    worker_title, worker, worker_cover,
-                    lesson_form, lesson_form_short,
-                    tok_name, room,
-                    lesson_status, lesson_status_short,
-                    status_item, subject, hours,
-                    color, border_color
-                FROM lessons
-                WHERE group_name IN ({qs})
-                  AND start >= ?
-                  AND start < ?
-                ORDER BY start ASC, group_name ASC;
-                """
-                rows = conn.execute(sql, [*chunk, start, end]).fetchall()
-                out.extend([dict(r) for r in rows])
+    def _filter_item_keys(self, conn: sqlite3.Connection, groups: list[str], lesson_filter: LessonFilter) -> list[list[int]]:
+        """
+        Klucze lesson_filter_items (group_id, title_id, subject_id, tok_name_id, worker_id, worker_title_id)
+        grup studenta, ktore przechodza filtr. Pozycji jest malo (rzad setek), wiec porownanie z regulami
+        frontendu (domyslny tytul/prowadzacy, trim) robimy w Pythonie, a zajecia wybiera juz SQL.
+        """
+        rows = conn.execute(
+            f"""
+            SELECT group_id, {", ".join(_FILTER_ITEM_COLUMNS)}
+            FROM lesson_filter_items
+            WHERE group_id IN ({_GROUP_IDS_SQL});
+            """,
+            (json.dumps(groups),),
+        ).fetchall()
+        strings = self._decode_strings(conn, (i for r in rows for i in r if i))
+        tok = (lesson_filter.selected_tok or "").strip()
+        out: list[list[int]] = []
+        for r in rows:
+            group_id, title_id, _subject_id, tok_id, worker_id, worker_title_id = (int(x) for x in r)
+            title = strings.get(title_id) if title_id else None
+            worker = strings.get(worker_id) if worker_id else None
+            worker_title = strings.get(worker_title_id) if worker_title_id else None
+            lecturer = (worker or worker_title or "").strip() or "Brak prowadzącego"
+            key = (title or "Bez nazwy", strings[group_id].strip(), lecturer)
+            if key not in lesson_filter.items:
+                continue
+            if tok and tok != "__all__" and (strings.get(tok_id) if tok_id else "").strip() != tok:
+                continue
+            out.append([int(x) for x in r])
         return out
 
     def list_filter_items_for_groups(self, groups: Iterable[str], start: str, end: str) -> list[dict]:
@@ -695,27 +2063,39 @@ class DB:
         groups = [g for g in (str(x).strip() for x in groups) if g]
         if not groups:
             return []
-        start = str(start).strip()
-        end = str(end).strip()
+        start_min = _iso_to_min(start)
+        end_min = _iso_to_min(end)
 
-        out: list[dict] = []
-        chunk_size = 900
+        # Zakres pozycji [first_min, last_min] nachodzacy na [start, end) to tani wstepny filtr z lesson_filter_items.
+        # Pozycja z zajeciami tylko przed i po zakresie tez go przechodzi, wiec dodatkowo sprawdzamy EXISTS
+        # po kluczu lessons (group_id, start_min) - odczyt zajec jednej grupy z zakresu.
         with self._connect() as conn:
-            for i in range(0, len(groups), chunk_size):
-                chunk = groups[i : i + chunk_size]
-                qs = ",".join(["?"] * len(chunk))
-                sql = f"""
-                SELECT DISTINCT
-                    title,
-                    subject,
-                    group_name,
-                    tok_name,
-                    worker,
-                    worker_title
-                FROM lessons
-                WHERE group_name IN ({qs})
-                  AND start >= ?
-                  AND start < ?
+            rows = conn.execute(
+                f"""
+                SELECT
+                    t.value AS title,
+                    s.value AS subject,
+                    g.value AS group_name,
+                    k.value AS tok_name,
+                    w.value AS worker,
+                    wt.value AS worker_title
+                FROM lesson_filter_items f
+                JOIN lesson_strings g ON g.id = f.group_id
+                LEFT JOIN lesson_strings t ON t.id = f.title_id
+                LEFT JOIN lesson_strings s ON s.id = f.subject_id
+                LEFT JOIN lesson_strings k ON k.id = f.tok_name_id
+                LEFT JOIN lesson_strings w ON w.id = f.worker_id
+                LEFT JOIN lesson_strings wt ON wt.id = f.worker_title_id
+                WHERE f.group_id IN ({_GROUP_IDS_SQL})
+                  AND f.first_min < ?
+                  AND f.last_min >= ?
+                  AND EXISTS (
+                      SELECT 1 FROM lessons l
+                      WHERE l.group_id = f.group_id
+                        AND l.start_min >= ?
+                        AND l.start_min < ?
+                        AND {" AND ".join(f"COALESCE(l.{c}, 0) = f.{c}" for c in _FILTER_ITEM_COLUMNS)}
+                  )
                 ORDER BY
                     COALESCE(tok_name, ''),
                     COALESCE(subject, ''),
@@ -723,10 +2103,146 @@ class DB:
                     group_name ASC,
                     COALESCE(worker, ''),
                     COALESCE(worker_title, '');
-                """
-                rows = conn.execute(sql, [*chunk, start, end]).fetchall()
-                out.extend([dict(r) for r in rows])
-        return out
+                """,
+                (json.dumps(groups), end_min, start_min, start_min, end_min),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def latest_lesson_change_seq(self) -> int:
+        with self._connect() as conn:
+            row = conn.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM lesson_changes;").fetchone()
+            return int(row["seq"])
+
+    def latest_lesson_change_seq_for_groups(self, groups: Iterable[str]) -> int:
+        """
+        Najwyzszy seq zmian zajec podanych grup (wersja danych np. dla ETag). Kazda grupa to jeden
+        odczyt konca indeksu idx_lesson_changes_group.
+        """
+        groups = [g for g in (str(x).strip() for x in groups) if g]
+        if not groups:
+            return 0
+        with self._connect() as conn:
+            row = conn.execute(
+                f"""
+                SELECT COALESCE(MAX((SELECT MAX(c.seq) FROM lesson_changes c WHERE c.group_id = g.id)), 0) AS seq
+                FROM ({_GROUP_IDS_SQL}) g;
+                """,
+                (json.dumps(groups),),
+            ).fetchone()
+            return int(row["seq"])
+
+    def list_lesson_changes(self, groups: Iterable[str], since: int, limit: int) -> list[dict]:
+        """
+        Zmiany zajec podanych grup z seq > since, rosnaco po seq (najwyzej limit).
+        Dla added/modified dolaczamy aktualny stan zajec (lesson; None gdy juz usuniete - bedzie pozniejszy wpis removed).
+        """
+        groups = [g for g in (str(x).strip() for x in groups) if g]
+        if not groups or limit <= 0:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT
+                    c.seq, c.group_id, c.start_min, c.end_min, c.kind, c.changed_fields, c.changed_at,
+                    l.group_id IS NOT NULL AS present, {", ".join(f"l.{col}" for col in _LESSON_ID_COLUMNS)}
+                FROM lesson_changes c
+                LEFT JOIN lessons l
+                  ON c.kind != 'removed'
+                 AND l.group_id = c.group_id AND l.start_min = c.start_min AND l.end_min = c.end_min
+                WHERE c.seq > ? AND c.group_id IN ({_GROUP_IDS_SQL})
+                ORDER BY c.seq ASC
+                LIMIT ?;
+                """,
+                (int(since), json.dumps(groups), int(limit)),
+            ).fetchall()
+            strings = self._decode_strings(conn, (i for r in rows for i in (r["group_id"], *tuple(r)[8:])))
+        return [
+            {
+                "seq": int(r["seq"]),
+                "kind": str(r["kind"]),
+                "group_name": strings[r["group_id"]],
+                "start": _min_to_iso(r["start_min"]),
+                "end": _min_to_iso(r["end_min"]),
+                "changed_fields": json.loads(r["changed_fields"]) if r["changed_fields"] else None,
+                "lesson": (
+                    _decode_lesson(strings, r["group_id"], r["start_min"], r["end_min"], tuple(r)[8:])
+                    if r["present"]
+                    else None
+                ),
+                "changed_at": str(r["changed_at"]),
+            }
+            for r in rows
+        ]
+
+    def replace_group_lessons_bulk(
+        self,
+        snapshots: Iterable[GroupLessonsSnapshot],
+        *,
+        failures: Iterable[tuple[str, str, str, str]] = (),
+    ) -> LessonDiff:
+        """
+        Podmienia zajecia wielu grup naraz, w jednej transakcji:
+        dla kazdego snapshotu naklada roznice na zajecia grupy w [start, end) (nowe/zmienione/zniklych usuwa)
+        i dopisuje zakres do pokrycia. Niezmienione wiersze nie sa zapisywane.
+        failures: (group_name, start, end, error) zapisywane jako status 'failed'.
+        """
+        snapshots = list(snapshots)
+        failures = list(failures)
+        diff = LessonDiff()
+        if not snapshots and not failures:
+            return diff
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> LessonDiff:
+            diff = LessonDiff()
+            for snap in snapshots:
+                snap_start, snap_end = _iso_to_min(snap.start), _iso_to_min(snap.end)
+                rows: dict[tuple[int, int], tuple] = {}
+                other: list[dict] = []
+                for ev in snap.lessons:
+                    row = _lesson_row(ev)
+                    if row is None:
+                        continue
+                    if row[0] == snap.group_name:
+                        rows[(_iso_to_min(row[1]), _iso_to_min(row[2]))] = row
+                    else:
+                        other.append(ev)
+                # ZUT zwraca tez zajecia zaczynajace sie tuz poza zakresem; patrzymy na szerszy przedzial,
+                # ale kasujemy tylko to, co zaczyna sie w [start, end).
+                lo = min([snap_start, *(k[0] for k in rows)])
+                hi = max([snap_end, *(k[0] + 1 for k in rows)])
+                existing = self._lesson_hashes(conn, snap.group_name, lo, hi)
+                gone = [k for k in existing if k not in rows and snap_start <= k[0] < snap_end]
+                if gone:
+                    conn.executemany(
+                        """
+                        DELETE FROM lessons
+                        WHERE group_id=(SELECT id FROM lesson_strings WHERE value=?) AND start_min=? AND end_min=?;
+                        """,
+                        [(snap.group_name, *k) for k in gone],
+                    )
+                    self._log_lesson_changes(conn, [(snap.group_name, *k, "removed", None, now) for k in gone])
+                diff = diff + self._apply_lesson_rows(conn, rows, existing, now)
+                diff.deleted += len(gone)
+                if other:
+                    # Zajecia z inna nazwa grupy niz zapytanie: tylko upsert, bez kasowania.
+                    diff = diff + self.upsert_lessons(other)
+                self._merge_group_coverage(conn, snap.group_name, snap.start, snap.end, now)
+            if failures:
+                conn.executemany(
+                    """
+                    INSERT INTO group_fetches(group_name, start_iso, end_iso, fetched_at, status, last_error)
+                    VALUES (?, ?, ?, ?, 'failed', ?)
+                    ON CONFLICT(group_name, start_iso, end_iso) DO UPDATE SET
+                        fetched_at=excluded.fetched_at,
+                        status=excluded.status,
+                        last_error=excluded.last_error;
+                    """,
+                    [(g, st, en, now, err) for g, st, en, err in failures],
+                )
+            return diff
+
+        return self._write(_tx)
 
     def delete_lessons_for_group_in_range(self, group_name: str, start: str, end: str) -> int:
         """
@@ -735,14 +2251,22 @@ class DB:
         group_name = str(group_name).strip()
         start = str(start).strip()
         end = str(end).strip()
-        with self._connect() as conn:
-            cur = conn.execute(
+        now = self._now_iso()
+
+        def _tx(conn: sqlite3.Connection) -> int:
+            rows = conn.execute(
                 """
                 DELETE FROM lessons
-                WHERE group_name=?
-                  AND start >= ?
-                  AND start < ?;
+                WHERE group_id=(SELECT id FROM lesson_strings WHERE value=?)
+                  AND start_min >= ?
+                  AND start_min < ?
+                RETURNING start_min, end_min;
                 """,
-                (group_name, start, end),
+                (group_name, _iso_to_min(start), _iso_to_min(end)),
+            ).fetchall()
+            self._log_lesson_changes(
+                conn, [(group_name, r["start_min"], r["end_min"], "removed", None, now) for r in rows]
             )
-            return int(cur.rowcount or 0)
+            return len(rows)
+
+        return self._write(_tx)
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import zlib
+from typing import Any, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:  # brotli jest opcjonalne; bez niego kompresujemy tylko gzipem
+    import brotli  # type: ignore[import-not-found]
+except ImportError:  # pragma: no cover - zalezy od srodowiska
+    brotli = None
+
+from .config import HTTP_BROTLI_QUALITY, HTTP_COMPRESS_MIN_SIZE, HTTP_GZIP_LEVEL
+
+
+# Typy tresci, ktore warto kompresowac (reszta, np. obrazki, idzie bez zmian).
+_COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "text/")
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    Silny ETag z wersji danych (np. seq zmian, zakres, opcje zapytania). Czesci musza byc serializowalne do JSON.
+    """
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), sort_keys=True, default=str)
+    return '"' + hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest() + '"'
+
+
+def matching_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """
+    Tag z If-None-Match pasujacy do etag (None gdy brak). Akceptujemy tez tagi z sufiksem kodowania (-gzip/-br),
+    ktory CompressionMiddleware dokleja do skompresowanych odpowiedzi; zwracamy wtedy tag klienta, zeby 304
+    mialo ten sam ETag co pelna odpowiedz w tym kodowaniu.
+    """
+    if not if_none_match:
+        return None
+    base = etag.strip('"')
+    for raw in if_none_match.split(","):
+        raw = raw.strip()
+        if raw == "*":
+            return etag
+        tag = raw[2:] if raw.startswith("W/") else raw
+        tag = tag.strip('"')
+        for suffix in ("-gzip", "-br"):
+            if tag.endswith(suffix):
+                tag = tag[: -len(suffix)]
+                break
+        if tag == base:
+            return raw[2:] if raw.startswith("W/") else raw
+    return None
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    out: set[str] = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for p in params.split(";"):
+            k, _, v = p.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            out.add(name.strip().lower())
+    return out
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=HTTP_BROTLI_QUALITY)
+        else:
+            # wbits=31: naglowek i suma kontrolna gzip
+            self._z = zlib.compressobj(HTTP_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Flush po kazdym kawalku, zeby odpowiedz strumieniowana docierala do klienta na biezaco.
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.flush()
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.finish()
+        return self._z.compress(data) + self._z.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """
+    Kompresja odpowiedzi: br (gdy zainstalowane brotli i klient je akceptuje), inaczej gzip.
+    Odpowiedzi mniejsze niz minimum_size, juz zakodowane i bez tresci (204/304) ida bez zmian.
+    Odpowiedzi strumieniowane kompresujemy kawalkami. Do ETag dokladamy sufiks kodowania,
+    bo skompresowana reprezentacja ma inne bajty niz nieskompresowana.
+    """
+
+    def __init__(self, app: ASGIApp, *, minimum_size: int = HTTP_COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = max(0, int(minimum_size))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accepted = _accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def _send(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = Headers(raw=message["headers"])
+                ctype = headers.get("content-type", "").lower()
+                passthrough = (
+                    message["status"] in (204, 206, 304)
+                    or "content-encoding" in headers
+                    or not ctype.startswith(_COMPRESSIBLE_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                assert start is not None
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = _Compressor(encoding)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and etag.endswith('"'):
+                    headers["etag"] = f'{etag[:-1]}-{encoding}"'
+                if more_body:
+                    del headers["content-length"]
+                    await send(start)
+                else:
+                    data = compressor.finish(body)
+                    headers["content-length"] = str(len(data))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": data})
+                    return
+            data = compressor.chunk(body) if more_body else compressor.finish(body)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, _send)
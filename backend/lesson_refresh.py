@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import datetime as dt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from .config import (
+    FORCE_REFRESH_MIN_AGE_S,
+    LESSON_REFRESH_WORKERS,
+    LESSON_TTL_CURRENT_S,
+    LESSON_TTL_FUTURE_S,
+    LESSON_TTL_UPCOMING_DAYS,
+)
+from .db import DB, GroupLessonsSnapshot, LessonDiff
+from .student_workflow import WARSAW, local_iso_to_api_iso, monday_for_week, week_range_local
+from .zut_client import PRIORITY_BACKGROUND, fetch_group_schedule, upstream_priority
+
+
+def fetch_group_range(group_name: str, start_local: str, end_local: str) -> GroupLessonsSnapshot:
+    evs = fetch_group_schedule(
+        group_name,
+        start_iso=local_iso_to_api_iso(start_local),
+        end_iso=local_iso_to_api_iso(end_local),
+    )
+    return GroupLessonsSnapshot(group_name=group_name, start=start_local, end=end_local, lessons=evs)
+
+
+def fetch_and_store_group_range(
+    db: DB, group_name: str, start_local: str, end_local: str, *, record_failure: bool = True
+) -> LessonDiff:
+    """
+    Pobiera zajecia grupy dla [start_local, end_local) i naklada roznice na DB.
+    Zwraca liczniki insert/update/delete/unchanged. Przy bledzie (record_failure=True) zapisuje status 'failed' i rzuca dalej.
+    """
+    try:
+        snap = fetch_group_range(group_name, start_local, end_local)
+    except Exception as e:  # noqa: BLE001
+        if record_failure:
+            db.upsert_group_fetch(group_name, start_local, end_local, status="failed", last_error=str(e))
+        raise
+    # Roznice + pokrycie w jednej transakcji, zeby rownolegly odczyt nie zobaczyl polowicznego stanu.
+    return db.replace_group_lessons_bulk([snap])
+
+
+def stale_ranges(
+    coverage: Iterable[tuple[str, str, str]],
+    start_local: str,
+    end_local: str,
+    *,
+    now: Optional[dt.datetime] = None,
+    force: bool = False,
+) -> list[tuple[str, str]]:
+    """
+    Ktore fragmenty pokrycia w [start_local, end_local) sa nieaktualne.
+
+    TTL zalezy od polozenia fragmentu wzgledem dzisiaj:
+    - przed biezacym tygodniem: bez TTL (przeszlosc sie nie zmienia),
+    - biezacy tydzien i LESSON_TTL_UPCOMING_DAYS dni do przodu: LESSON_TTL_CURRENT_S,
+    - dalej: LESSON_TTL_FUTURE_S.
+    force=True: nieaktualne jest wszystko starsze niz FORCE_REFRESH_MIN_AGE_S.
+    Stykajace sie nieaktualne fragmenty sklejamy w jeden zakres (jedno zapytanie).
+    """
+    if now is None:
+        now = dt.datetime.now(dt.timezone.utc)
+    now_local = now.astimezone(WARSAW).replace(tzinfo=None)
+    current_start, _ = week_range_local(monday_for_week(now.astimezone(WARSAW).date().isoformat()))
+    upcoming_end = dt.datetime.combine(now_local.date() + dt.timedelta(days=LESSON_TTL_UPCOMING_DAYS), dt.time())
+    bounds = [current_start, upcoming_end.isoformat(timespec="seconds")]
+
+    out: list[tuple[str, str]] = []
+    for cov_start, cov_end, fetched_at in coverage:
+        s, e = max(cov_start, start_local), min(cov_end, end_local)
+        if s >= e:
+            continue
+        try:
+            age_s = (now - dt.datetime.fromisoformat(fetched_at)).total_seconds()
+        except ValueError:
+            age_s = float("inf")
+
+        cuts = [s, *(b for b in bounds if s < b < e), e]
+        for ps, pe in zip(cuts, cuts[1:]):
+            if force:
+                ttl: Optional[float] = FORCE_REFRESH_MIN_AGE_S
+            elif pe <= bounds[0]:
+                ttl = None
+            elif ps >= bounds[1]:
+                ttl = LESSON_TTL_FUTURE_S
+            else:
+                ttl = LESSON_TTL_CURRENT_S
+            if ttl is None or age_s <= ttl:
+                continue
+            if out and out[-1][1] == ps:
+                out[-1] = (out[-1][0], pe)
+            else:
+                out.append((ps, pe))
+    return out
+
+
+class LessonRefresher:
+    """
+    Odswiezanie w tle nieaktualnych zakresow zajec (stale-while-revalidate).
+    Ten sam (grupa, zakres) nie jest kolejkowany drugi raz, dopoki poprzednie odswiezenie trwa.
+    """
+
+    def __init__(self, db: DB, *, max_workers: int = LESSON_REFRESH_WORKERS):
+        self._db = db
+        self._lock = threading.Lock()
+        self._in_flight: set[tuple[str, str, str]] = set()
+        self._ex = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="lesson-refresh")
+
+    def submit(self, tasks: Iterable[tuple[str, str, str]]) -> int:
+        """
+        Kolejkuje (group_name, start_local, end_local). Zwraca liczbe faktycznie dodanych zadan.
+        """
+        added = 0
+        for task in tasks:
+            with self._lock:
+                if task in self._in_flight:
+                    continue
+                self._in_flight.add(task)
+            self._ex.submit(self._run, task)
+            added += 1
+        return added
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def _run(self, task: tuple[str, str, str]) -> None:
+        try:
+            # Bez zapisu 'failed': nieudane odswiezenie nie moze zabrac pokrycia, dalej serwujemy stare dane.
+            with upstream_priority(PRIORITY_BACKGROUND):
+                fetch_and_store_group_range(self._db, *task, record_failure=False)
+        except Exception:  # noqa: BLE001 - kolejne zapytanie o nieaktualny zakres sprobuje ponownie
+            pass
+        finally:
+            with self._lock:
+                self._in_flight.discard(task)
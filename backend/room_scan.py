@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import datetime as dt
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, Iterator, Optional, TypeVar
+from zoneinfo import ZoneInfo
+
+from .config import ROOM_SCAN_CONCURRENCY
+from .zut_client import (
+    PRIORITY_BACKGROUND,
+    AsyncHttpTransport,
+    afetch_room_events,
+    afetch_room_groups_all,
+    upstream_priority,
+)
+
+
+WARSAW = ZoneInfo("Europe/Warsaw")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass(frozen=True)
+class RoomScanResult:
+    room: str
+    # tok_name -> group_name dla wszystkich programow korzystajacych z sali (None przy bledzie)
+    groups_by_tok: Optional[dict[str, set[str]]]
+    error: Optional[Exception] = None
+
+
+@dataclass(frozen=True)
+class RoomSliceScanResult:
+    room: str
+    # (start, end) okna -> tok_name -> group_name (None przy bledzie; wtedy zadne okno sali nie jest zapisane)
+    groups_by_slice: Optional[dict[tuple[str, str], dict[str, set[str]]]]
+    error: Optional[Exception] = None
+
+
+_DONE = object()
+
+# Co ile sekund iteracja skanu bez nowych wynikow sprawdza cancel i wola on_idle.
+_IDLE_POLL_S = 0.5
+
+
+def _scan(
+    items: list[T],
+    fetch: Callable[[AsyncHttpTransport, T], Awaitable[R]],
+    fail: Callable[[T, Exception], R],
+    *,
+    concurrency: int,
+    cancel: Optional[threading.Event],
+    priority: int,
+    on_idle: Optional[Callable[[], None]] = None,
+) -> Iterator[R]:
+    """
+    Wspolna petla skanu: `fetch` dla kazdego elementu na jednej petli asyncio (osobny watek) z semaforem,
+    wyniki (albo `fail(item, e)` przy bledzie) strumieniowane do wolajacego w kolejnosci naplywania.
+    Zapytania czekaja na sloty globalnego schedulera zut_client w klasie `priority`.
+    `on_idle` jest wolane w watku wolajacego, gdy przez _IDLE_POLL_S nie przyszedl zaden wynik
+    (np. zeby zapisac bufor na czas mimo wolnego konca skanu).
+    """
+    out: queue.Queue = queue.Queue()
+    stop = threading.Event()
+    loop_box: dict[str, asyncio.AbstractEventLoop] = {}
+    main_task_box: dict[str, asyncio.Task] = {}
+    concurrency = max(1, int(concurrency))
+
+    async def _one(transport: AsyncHttpTransport, sem: asyncio.Semaphore, item: T) -> None:
+        async with sem:
+            if stop.is_set() or (cancel is not None and cancel.is_set()):
+                return
+            try:
+                res = await fetch(transport, item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                out.put(fail(item, e))
+                return
+            out.put(res)
+
+    async def _main() -> None:
+        transport = AsyncHttpTransport(max_per_host=concurrency)
+        sem = asyncio.Semaphore(concurrency)
+        try:
+            await asyncio.gather(*(_one(transport, sem, it) for it in items))
+        finally:
+            transport.close()
+
+    def _thread_main() -> None:
+        loop = asyncio.new_event_loop()
+        loop_box["loop"] = loop
+        try:
+            # Task (i taski z gather) dziedzicza kontekst z klasa priorytetu.
+            with upstream_priority(priority):
+                task = loop.create_task(_main())
+            main_task_box["task"] = task
+            if stop.is_set():
+                task.cancel()
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:  # noqa: BLE001
+            out.put(e)
+        finally:
+            loop.close()
+            out.put(_DONE)
+
+    def _request_stop() -> None:
+        stop.set()
+        loop = loop_box.get("loop")
+        task = main_task_box.get("task")
+        if loop is not None and task is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass
+
+    t = threading.Thread(target=_thread_main, daemon=True, name="room-scan")
+    t.start()
+    try:
+        while True:
+            try:
+                item = out.get(timeout=_IDLE_POLL_S)
+            except queue.Empty:
+                if cancel is not None and cancel.is_set():
+                    _request_stop()
+                if on_idle is not None:
+                    on_idle()
+                continue
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            if cancel is not None and cancel.is_set():
+                _request_stop()
+    finally:
+        _request_stop()
+        t.join()
+
+
+def scan_concurrency(limit: Optional[int]) -> int:
+    """
+    Ile zapytan skanu naraz: caly budzet ROOM_SCAN_CONCURRENCY, chyba ze wolajacy jawnie podal nizszy limit.
+    """
+    if not limit:
+        return ROOM_SCAN_CONCURRENCY
+    return max(1, min(int(limit), ROOM_SCAN_CONCURRENCY))
+
+
+def scan_rooms(
+    rooms: Iterable[str],
+    *,
+    start_iso: str,
+    end_iso: str,
+    concurrency: int = ROOM_SCAN_CONCURRENCY,
+    cancel: Optional[threading.Event] = None,
+    priority: int = PRIORITY_BACKGROUND,
+    on_idle: Optional[Callable[[], None]] = None,
+) -> Iterator[RoomScanResult]:
+    """
+    Skanuje sale na jednej petli asyncio (osobny watek) z semaforem `concurrency`.
+
+    Wyniki sa strumieniowane do wolajacego w kolejnosci naplywania, wiec zapis do DB
+    moze isc rownolegle z pobieraniem. Przerwanie:
+    - ustawienie `cancel` (sprawdzane przed kazdym zapytaniem i w trakcie iteracji),
+    - zamkniecie generatora (break / wyjatek u wolajacego).
+    W obu przypadkach oczekujace zapytania sa anulowane.
+    `on_idle`: wolane w watku wolajacego, gdy przez chwile nie ma nowych wynikow (patrz _scan).
+    """
+
+    async def _fetch(transport: AsyncHttpTransport, room: str) -> RoomScanResult:
+        m = await afetch_room_groups_all(transport, room, start_iso=start_iso, end_iso=end_iso)
+        return RoomScanResult(room=room, groups_by_tok=m)
+
+    yield from _scan(
+        list(rooms),
+        _fetch,
+        lambda room, e: RoomScanResult(room=room, groups_by_tok=None, error=e),
+        concurrency=concurrency,
+        cancel=cancel,
+        priority=priority,
+        on_idle=on_idle,
+    )
+
+
+def _aware(value: str) -> dt.datetime:
+    d = dt.datetime.fromisoformat(str(value).strip())
+    return d if d.tzinfo is not None else d.replace(tzinfo=WARSAW)
+
+
+def contiguous_ranges(slices: list[tuple[str, str]]) -> list[list[tuple[str, str]]]:
+    """
+    Dzieli posortowane okna na serie stykajacych sie (koniec jednego == poczatek nastepnego).
+    """
+    out: list[list[tuple[str, str]]] = []
+    for sl in slices:
+        if out and _aware(out[-1][-1][1]) == _aware(sl[0]):
+            out[-1].append(sl)
+        else:
+            out.append([sl])
+    return out
+
+
+def bucket_groups_by_slice(
+    events: list[dict], slices: list[tuple[str, str]]
+) -> dict[tuple[str, str], dict[str, set[str]]]:
+    """
+    tok_name -> group_name osobno dla kazdego okna [start, end) (po poczatku zdarzenia).
+    """
+    bounds = [(_aware(s), _aware(e)) for s, e in slices]
+    starts = [b[0] for b in bounds]
+    out: dict[tuple[str, str], dict[str, set[str]]] = {sl: {} for sl in slices}
+    for ev in events:
+        t, g, st = ev.get("tok_name"), ev.get("group_name"), ev.get("start")
+        if not t or not g or not st:
+            continue
+        try:
+            when = _aware(str(st))
+        except ValueError:
+            continue
+        i = bisect.bisect_right(starts, when) - 1
+        if i >= 0 and when < bounds[i][1]:
+            out[slices[i]].setdefault(str(t), set()).add(str(g))
+    return out
+
+
+def scan_room_slices(
+    tasks: Iterable[tuple[str, list[tuple[str, str]]]],
+    *,
+    concurrency: int = ROOM_SCAN_CONCURRENCY,
+    cancel: Optional[threading.Event] = None,
+    priority: int = PRIORITY_BACKGROUND,
+    on_idle: Optional[Callable[[], None]] = None,
+) -> Iterator[RoomSliceScanResult]:
+    """
+    Jak scan_rooms, ale kazda sala ma wlasna liste okien (posortowanych, np. tygodni do odswiezenia).
+    Stykajace sie okna pobieramy jednym zapytaniem i dzielimy odpowiedz na okna po poczatku zdarzenia.
+    Jeden wynik na sale (po pobraniu wszystkich jej okien).
+    """
+
+    async def _fetch(transport: AsyncHttpTransport, task: tuple[str, list[tuple[str, str]]]) -> RoomSliceScanResult:
+        room, slices = task
+        out: dict[tuple[str, str], dict[str, set[str]]] = {}
+        for rng in contiguous_ranges(slices):
+            events = await afetch_room_events(transport, room, start_iso=rng[0][0], end_iso=rng[-1][1])
+            out.update(bucket_groups_by_slice(events, rng))
+        return RoomSliceScanResult(room=room, groups_by_slice=out)
+
+    yield from _scan(
+        list(tasks),
+        _fetch,
+        lambda task, e: RoomSliceScanResult(room=task[0], groups_by_slice=None, error=e),
+        concurrency=concurrency,
+        cancel=cancel,
+        priority=priority,
+        on_idle=on_idle,
+    )
@@ -1,12 +1,21 @@
 from __future__ import annotations
 
 import datetime as dt
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
 from typing import Optional
 from zoneinfo import ZoneInfo
 
-from .zut_client import fetch_room_groups_multi, fetch_rooms, fetch_student_schedule
+from .config import (
+    ROOM_INDEX_MAX_AGE_S,
+    TOK_RESOLVE_MAX_PARALLEL,
+    TOK_RESOLVE_WINDOW_DAYS,
+)
+from .db import DB
+from .room_scan import scan_concurrency, scan_rooms
+from .zut_client import PRIORITY_DISCOVERY, fetch_rooms, fetch_student_schedule, get_scheduler, upstream_priority
 
 
 WARSAW = ZoneInfo("Europe/Warsaw")
@@ -121,6 +130,40 @@ def local_iso_to_api_iso(local_iso: str) -> str:
 class TokResolveResult:
     tok_names: list[str]
     weeks_used: int
+    # tok_name -> group_name z pobranych okien planu studenta (grupy, na ktore student faktycznie chodzi)
+    groups_by_tok: dict[str, set[str]] = field(default_factory=dict)
+    windows_fetched: int = 0
+    wall_ms: int = 0
+
+
+@dataclass
+class _ScheduleWindow:
+    start: dt.date
+    days: int
+    # Okno z przeszukiwania wstecz (od monday w strone backward_start); polowki po bisekcji ida od konca.
+    backward: bool = False
+    state: str = "new"  # new | running | done
+    events: list[dict] = field(default_factory=list)
+
+
+def _split_days(start: dt.date, end: dt.date, window_days: int, *, backward: bool) -> list[_ScheduleWindow]:
+    """
+    Dzieli [start, end) na okna po window_days dni; backward=True: od end w strone start.
+    """
+    out: list[_ScheduleWindow] = []
+    if backward:
+        cur = end
+        while cur > start:
+            w_start = max(start, cur - dt.timedelta(days=window_days))
+            out.append(_ScheduleWindow(start=w_start, days=(cur - w_start).days, backward=True))
+            cur = w_start
+    else:
+        cur = start
+        while cur < end:
+            w_end = min(end, cur + dt.timedelta(days=window_days))
+            out.append(_ScheduleWindow(start=cur, days=(w_end - cur).days))
+            cur = w_end
+    return out
 
 
 def resolve_tok_names_for_student(
@@ -130,56 +173,129 @@ def resolve_tok_names_for_student(
     monday: dt.date,
     weeks_limit: int,
     backward_days_limit: int = 366,
+    window_days: int = TOK_RESOLVE_WINDOW_DAYS,
+    max_parallel: int = TOK_RESOLVE_MAX_PARALLEL,
 ) -> TokResolveResult:
     """
-    Pobiera harmonogram studenta oknami 7-dniowymi.
-    Najpierw idzie do przodu (od wskazanego monday) przez weeks_limit tygodni,
-    a jesli nadal brakuje tok_name, szuka wstecz do granicy backward_days_limit.
+    Pobiera harmonogram studenta szerszymi oknami (domyslnie ~miesiac), kilka naraz.
+    Kolejnosc okien jak wczesniej: najpierw do przodu od monday przez weeks_limit tygodni,
+    potem wstecz do granicy backward_days_limit. tok_name liczymy po kolei z okien w tej kolejnosci,
+    wiec wynik nie zalezy od tego, ktore zapytanie wrocilo pierwsze.
+
+    - okno, ktore sie nie pobralo (np. timeout przy duzej odpowiedzi), dzielimy na pol (do 7 dni),
+    - po znalezieniu majors_count tok_name nie wysylamy kolejnych okien, a oczekujace anulujemy
+      (zapytania juz wyslane koncza sie w tle, ich wynik jest pomijany).
+
+    Przy okazji zbiera pary (tok_name, group_name) ze wszystkich pobranych okien,
+    co pozwala obsadzic grupy studenta bez skanowania wszystkich sal.
     """
+    t0 = time.monotonic()
     majors_count = int(majors_count)
     if majors_count <= 0:
         return TokResolveResult(tok_names=[], weeks_used=0)
 
-    weeks_used = 0
+    window_days = max(7, int(window_days))
+    forward_end = monday + dt.timedelta(days=7 * max(1, int(weeks_limit)))
+    backward_start = monday - dt.timedelta(days=max(0, int(backward_days_limit)))
+    order = _split_days(monday, forward_end, window_days, backward=False)
+    order += _split_days(backward_start, monday, window_days, backward=True)
+
     seen: set[str] = set()
     tok_names: list[str] = []
-
-    def _collect_week(w_monday: dt.date) -> bool:
-        nonlocal weeks_used
-        start_local, end_local = week_range_local(w_monday)
-        start_api = local_iso_to_api_iso(start_local)
-        end_api = local_iso_to_api_iso(end_local)
-        weeks_used += 1
-
-        events = fetch_student_schedule(album_number, start_iso=start_api, end_iso=end_api)
-        for ev in events:
-            t = ev.get("tok_name")
-            if not t:
-                continue
-            t = str(t)
-            if t in seen:
-                continue
-            seen.add(t)
-            tok_names.append(t)
-            if len(tok_names) >= majors_count:
-                return True
-        return False
-
-    forward_weeks_limit = max(1, int(weeks_limit))
-    for i in range(forward_weeks_limit):
-        if _collect_week(monday + dt.timedelta(days=7 * i)):
-            return TokResolveResult(tok_names=tok_names, weeks_used=weeks_used)
-
-    backward_days_limit = max(0, int(backward_days_limit))
-    backward_weeks_limit = 0 if backward_days_limit == 0 else (backward_days_limit + 6) // 7
-    for i in range(1, backward_weeks_limit + 1):
-        w_monday = monday - dt.timedelta(days=7 * i)
-        if (monday - w_monday).days > backward_days_limit:
-            break
-        if _collect_week(w_monday):
-            return TokResolveResult(tok_names=tok_names, weeks_used=weeks_used)
-
-    return TokResolveResult(tok_names=tok_names, weeks_used=weeks_used)
+    groups_by_tok: dict[str, set[str]] = {}
+    windows_fetched = 0
+    days_fetched = 0
+    stop = threading.Event()
+
+    def _fetch(w: _ScheduleWindow) -> list[dict]:
+        # Okno, ktore dostalo slot juz po znalezieniu wyniku, nie wysyla zapytania.
+        if stop.is_set():
+            return []
+        start_dt = dt.datetime(w.start.year, w.start.month, w.start.day, 0, 0, 0)
+        end_dt = start_dt + dt.timedelta(days=w.days)
+        return fetch_student_schedule(
+            album_number,
+            start_iso=local_iso_to_api_iso(start_dt.isoformat(timespec="seconds")),
+            end_iso=local_iso_to_api_iso(end_dt.isoformat(timespec="seconds")),
+        )
+
+    def _result() -> TokResolveResult:
+        return TokResolveResult(
+            tok_names=tok_names,
+            weeks_used=(days_fetched + 6) // 7,
+            groups_by_tok=groups_by_tok,
+            windows_fetched=windows_fetched,
+            wall_ms=int((time.monotonic() - t0) * 1000),
+        )
+
+    in_flight: dict[Future, _ScheduleWindow] = {}
+    prefix = 0
+    # Okna ida przez wspolny scheduler zapytan do ZUT (klasa discovery), max_parallel ogranicza ile naraz w locie.
+    scheduler = get_scheduler()
+    try:
+        while True:
+            for w in order:
+                if len(in_flight) >= max(1, int(max_parallel)):
+                    break
+                if w.state == "new":
+                    w.state = "running"
+                    in_flight[scheduler.submit(_fetch, w, priority=PRIORITY_DISCOVERY)] = w
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                w = in_flight.pop(fut)
+                try:
+                    w.events = fut.result()
+                except Exception:
+                    if w.days <= 7:
+                        raise
+                    # Bisekcja: dwie polowy (wyrownane do tygodni) w miejsce okna, w kolejnosci przeszukiwania
+                    # (wstecz najpierw pozniejsza polowa), zeby kolejnosc tok_name sie nie zmienila.
+                    left_days = max(7, (w.days // 2 + 6) // 7 * 7)
+                    halves = [_ScheduleWindow(start=w.start, days=left_days, backward=w.backward)]
+                    if w.days > left_days:
+                        halves.append(
+                            _ScheduleWindow(
+                                start=w.start + dt.timedelta(days=left_days),
+                                days=w.days - left_days,
+                                backward=w.backward,
+                            )
+                        )
+                    if w.backward:
+                        halves.reverse()
+                    i = order.index(w)
+                    order[i : i + 1] = halves
+                    continue
+                w.state = "done"
+                windows_fetched += 1
+                days_fetched += w.days
+                for ev in w.events:
+                    t, g = ev.get("tok_name"), ev.get("group_name")
+                    if t and g:
+                        groups_by_tok.setdefault(str(t), set()).add(str(g))
+
+            # tok_name tylko z ciaglego prefiksu gotowych okien (deterministyczna kolejnosc).
+            while prefix < len(order) and order[prefix].state == "done":
+                for ev in order[prefix].events:
+                    t = ev.get("tok_name")
+                    if not t or str(t) in seen:
+                        continue
+                    seen.add(str(t))
+                    tok_names.append(str(t))
+                prefix += 1
+                if len(tok_names) >= majors_count:
+                    return _result()
+    finally:
+        # Nie czekamy na zapytania, ktorych wynik nie jest juz potrzebny. cancel() dziala tylko na okna
+        # czekajace na slot; okno juz uruchomione konczy sie w tle (wynik jest pomijany), a stop sprawia,
+        # ze okno, ktore wystartowalo po znalezieniu wyniku, wraca od razu bez zapytania do ZUT.
+        stop.set()
+        for fut in in_flight:
+            fut.cancel()
+
+    return _result()
 
 
 @dataclass(frozen=True)
@@ -189,6 +305,23 @@ class GroupDiscoveryResult:
     rooms_processed: int
     errors: int
     last_error: Optional[str]
+    # ile sal obsluzono z indeksu room_index (bez zapytania do ZUT)
+    rooms_from_index: int = 0
+
+
+def _rooms_for_discovery(db: Optional[DB], max_age_s: float) -> list[str]:
+    """
+    Lista sal: z DB, jesli byla niedawno odswiezana; inaczej z ZUT (i zapis do DB).
+    """
+    if db is not None:
+        rooms = db.list_rooms_if_fresh(max_age_s=max_age_s)
+        if rooms:
+            return rooms
+    with upstream_priority(PRIORITY_DISCOVERY):
+        rooms = fetch_rooms()
+    if db is not None:
+        db.upsert_rooms(rooms)
+    return rooms
 
 
 def discover_groups_for_tok_names(
@@ -196,40 +329,56 @@ def discover_groups_for_tok_names(
     tok_names: set[str],
     start_api: str,
     end_api: str,
-    max_workers: int,
+    max_workers: Optional[int] = None,
+    cancel: Optional[threading.Event] = None,
+    db: Optional[DB] = None,
+    max_age_s: float = ROOM_INDEX_MAX_AGE_S,
 ) -> GroupDiscoveryResult:
     """
-    Skanuje wszystkie sale i wyciaga group_name dla wskazanych tok_name w zadanym zakresie.
+    Skanuje sale i wyciaga group_name dla wskazanych tok_name w zadanym zakresie.
+    Skan idzie przez room_scan.scan_rooms (asyncio); `cancel` pozwala przerwac go z zewnatrz.
+
+    Z `db`: sale ze swiezym skanem (room_index, nie starszym niz max_age_s) sa brane z indeksu,
+    a ponownie pobierane sa tylko sale nieaktualne. Kazdy nowy skan zapisuje do indeksu wszystkie
+    tok_name z odpowiedzi, wiec kolejne discovery (tez dla innych kierunkow) nie skanuje od nowa.
     """
     tok_names = {str(t).strip() for t in tok_names if str(t).strip()}
     if not tok_names:
         return GroupDiscoveryResult(groups_by_tok={}, rooms_total=0, rooms_processed=0, errors=0, last_error=None)
 
-    rooms = fetch_rooms()
+    rooms = _rooms_for_discovery(db, max_age_s)
     groups_by_tok: dict[str, set[str]] = {t: set() for t in tok_names}
 
+    fresh_rooms: set[str] = set()
+    if db is not None:
+        fresh_rooms = db.list_rooms_with_fresh_scan(start_api, end_api, max_age_s=max_age_s) & set(rooms)
+        for t, gs in db.list_groups_from_room_index(tok_names, start_api, end_api, max_age_s=max_age_s).items():
+            groups_by_tok[t].update(gs)
+    stale_rooms = [r for r in rooms if r not in fresh_rooms]
+
     errors = 0
     last_error: Optional[str] = None
-    rooms_processed = 0
-
-    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as ex:
-        futures = {
-            ex.submit(fetch_room_groups_multi, room, tok_names=tok_names, start_iso=start_api, end_iso=end_api): room
-            for room in rooms
-        }
-        for fut in as_completed(futures):
-            room = futures[fut]
-            rooms_processed += 1
-            try:
-                m = fut.result()
-            except Exception as e:  # noqa: BLE001
-                errors += 1
-                last_error = f"{room}: {e}"
-                continue
-
-            for t, gs in m.items():
-                if t in groups_by_tok and gs:
-                    groups_by_tok[t].update(gs)
+    rooms_processed = len(fresh_rooms)
+
+    for res in scan_rooms(
+        stale_rooms,
+        start_iso=start_api,
+        end_iso=end_api,
+        concurrency=scan_concurrency(max_workers),
+        cancel=cancel,
+        priority=PRIORITY_DISCOVERY,
+    ):
+        rooms_processed += 1
+        if res.error is not None:
+            errors += 1
+            last_error = f"{res.room}: {res.error}"
+            continue
+
+        if db is not None:
+            db.record_room_scan(res.room, start_api, end_api, res.groups_by_tok or {})
+        for t, gs in (res.groups_by_tok or {}).items():
+            if t in groups_by_tok and gs:
+                groups_by_tok[t].update(gs)
 
     # Usuwamy puste sety, zeby response byl mniejszy.
     groups_by_tok = {t: gs for t, gs in groups_by_tok.items() if gs}
@@ -239,4 +388,5 @@ def discover_groups_for_tok_names(
         rooms_processed=rooms_processed,
         errors=errors,
         last_error=last_error,
+        rooms_from_index=len(fresh_rooms),
     )
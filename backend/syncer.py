@@ -2,14 +2,21 @@ from __future__ import annotations
 
 import datetime as dt
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
-from typing import Optional
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Optional
 from zoneinfo import ZoneInfo
 
-from .config import DEFAULT_TOK_NAME
-from .db import DB
-from .zut_client import fetch_room_groups, fetch_rooms
+from .config import (
+    DEFAULT_TOK_NAME,
+    SYNC_FLUSH_INTERVAL_S,
+    SYNC_FLUSH_ROWS,
+    SYNC_SLICE_TTL_CURRENT_S,
+    SYNC_SLICE_TTL_PAST_S,
+)
+from .db import DB, SyncRun
+from .room_scan import scan_concurrency, scan_room_slices, scan_rooms
+from .zut_client import PRIORITY_BACKGROUND, fetch_rooms, upstream_priority
 
 
 WARSAW = ZoneInfo("Europe/Warsaw")
@@ -57,28 +64,204 @@ def _parse_iso_or_date(value: str, *, is_end: bool) -> str:
     return dtt.isoformat(timespec="seconds")
 
 
+def week_slices(start_iso: str, end_iso: str) -> list[tuple[str, str]]:
+    """
+    Tygodnie [poniedzialek 00:00, nastepny poniedzialek 00:00) (Europe/Warsaw) pokrywajace [start_iso, end_iso].
+    Granice sa stale niezaleznie od okna runu, wiec kolejne runy trafiaja w te same wpisy room_scans.
+    """
+    start = dt.datetime.fromisoformat(start_iso).astimezone(WARSAW).date()
+    end = dt.datetime.fromisoformat(end_iso).astimezone(WARSAW).date()
+    monday = start - dt.timedelta(days=start.weekday())
+    out: list[tuple[str, str]] = []
+    while monday <= end:
+        nxt = monday + dt.timedelta(days=7)
+        out.append(
+            (
+                dt.datetime(monday.year, monday.month, monday.day, tzinfo=WARSAW).isoformat(timespec="seconds"),
+                dt.datetime(nxt.year, nxt.month, nxt.day, tzinfo=WARSAW).isoformat(timespec="seconds"),
+            )
+        )
+        monday = nxt
+    return out
+
+
+def slice_ttl_s(slice_end_iso: str, now: Optional[dt.datetime] = None) -> int:
+    # Tydzien zakonczony przed biezacym -> dlugi TTL; biezacy i przyszle -> krotki.
+    if now is None:
+        now = dt.datetime.now(WARSAW)
+    today = now.astimezone(WARSAW).date()
+    current_monday = today - dt.timedelta(days=today.weekday())
+    if dt.datetime.fromisoformat(slice_end_iso).astimezone(WARSAW).date() <= current_monday:
+        return SYNC_SLICE_TTL_PAST_S
+    return SYNC_SLICE_TTL_CURRENT_S
+
+
 @dataclass
 class SyncParams:
     tok_name: str = DEFAULT_TOK_NAME
     start_iso: Optional[str] = None
     end_iso: Optional[str] = None
-    max_workers: int = 10
+    # None: caly budzet skanu (ROOM_SCAN_CONCURRENCY); liczba: jawny nizszy limit.
+    max_workers: Optional[int] = None
+    mode: str = "full"
+
+
+@dataclass
+class _RunState:
+    # Stan jednego runu w partii: wyniki wspolnego skanu sal sa rozdzielane na wszystkie runy partii.
+    run: SyncRun
+    rooms: list[str]
+    pending: set[str]
+    groups_found: set[str] = field(default_factory=set)
+    rooms_processed: int = 0
+    groups_added: int = 0
+    errors: int = 0
+    last_error: Optional[str] = None
+
+    def save_progress(self, db: DB, *, groups_added: Optional[int] = None) -> None:
+        db.update_run_progress(
+            self.run.id,
+            rooms_processed=self.rooms_processed,
+            groups_found=len(self.groups_found),
+            groups_added=self.groups_added if groups_added is None else groups_added,
+            errors=self.errors,
+            last_error=self.last_error,
+        )
+
+
+# Wynik skanu sali: (sala, blad, tok_name -> grupy, okna do zapisania w room_scans: (od, do, tok_name -> grupy)).
+_RoomResult = tuple[str, Optional[Exception], dict[str, set[str]], list[tuple[str, str, dict[str, set[str]]]]]
+
+
+class _WriteBuffer:
+    """
+    Bufor zapisow partii runow. Zamiast kilku commitow na sale (room_scans, grupy, checkpoint, postep)
+    zbieramy wyniki w pamieci i zapisujemy je jedna transakcja, gdy uzbiera sie max_rows wierszy
+    albo najstarszy wpis czeka dluzej niz max_age_s. Postep runow idzie w tym samym commicie,
+    wiec checkpointy sal, grupy i liczniki sa zawsze spojne.
+    """
+
+    def __init__(self, db: DB, *, max_rows: int = SYNC_FLUSH_ROWS, max_age_s: float = SYNC_FLUSH_INTERVAL_S):
+        self._db = db
+        self._max_rows = max(1, int(max_rows))
+        self._max_age_s = float(max_age_s)
+        self._scans: list[tuple[str, str, str, dict[str, set[str]]]] = []
+        self._groups: dict[int, set[str]] = {}
+        self._rooms: dict[int, list[tuple[str, Optional[str]]]] = {}
+        self._rows = 0
+        self._since: Optional[float] = None
+
+    def _touch(self, rows: int) -> None:
+        self._rows += rows
+        if self._since is None:
+            self._since = time.monotonic()
+
+    def add_scan(self, room: str, window_start: str, window_end: str, groups_by_tok: dict[str, set[str]]) -> None:
+        self._scans.append((room, window_start, window_end, groups_by_tok))
+        self._touch(1 + sum(len(gs) for gs in groups_by_tok.values()))
+
+    def add_groups(self, st: _RunState, groups: set[str]) -> None:
+        # Grupy juz znane runowi (z wczesniejszych sal) nie trafiaja do bazy drugi raz.
+        new = {g for g in groups if g} - st.groups_found
+        if new:
+            st.groups_found |= new
+            self._groups.setdefault(st.run.id, set()).update(new)
+            self._touch(len(new))
+
+    def add_room(self, st: _RunState, room: str, error: Optional[str]) -> None:
+        self._rooms.setdefault(st.run.id, []).append((room, error))
+        self._touch(1)
+
+    def due(self) -> bool:
+        if self._since is None:
+            return False
+        return self._rows >= self._max_rows or time.monotonic() - self._since >= self._max_age_s
+
+    def flush(self, states: list[_RunState], *, finish_status: Optional[str] = None) -> None:
+        """
+        Zapisuje bufor i postep wszystkich runow partii jedna transakcja;
+        z finish_status w tej samej transakcji konczy runy.
+        """
+        def _tx(conn) -> dict[int, int]:
+            # Wykonywane w watku-writerze: tylko operacje DB na gotowych danych z bufora. Stanu runow
+            # nie zmieniamy tutaj (transakcja moze zostac wycofana) - liczniki wracaja jako wynik.
+            added: dict[int, int] = {}
+            for room, ws, we, groups_by_tok in self._scans:
+                self._db.record_room_scan(room, ws, we, groups_by_tok)
+            for st in states:
+                groups = self._groups.get(st.run.id)
+                if groups:
+                    added[st.run.id] = self._db.add_groups_for_run(st.run.id, st.run.tok_name, groups)
+                self._db.record_run_rooms(st.run.id, self._rooms.get(st.run.id, []))
+                st.save_progress(self._db, groups_added=st.groups_added + added.get(st.run.id, 0))
+                if finish_status is not None:
+                    self._db.mark_run_finished(st.run.id, status=finish_status, last_error=st.last_error)
+            return added
+
+        added = self._db.transaction(_tx)
+        for st in states:
+            st.groups_added += added.get(st.run.id, 0)
+        self._scans.clear()
+        self._groups.clear()
+        self._rooms.clear()
+        self._rows = 0
+        self._since = None
 
 
 class SyncRunner:
+    """
+    Kolejka syncow: runy czekaja w sync_runs (status 'queued', z priorytetem), wiec przezywaja restart.
+    Jeden watek roboczy zabiera z kolejki partie runow z tym samym oknem i trybem (rozne tok_name)
+    i obsluguje je jednym skanem sal - odpowiedz sali zawiera grupy wszystkich programow.
+    """
+
     def __init__(self, db: DB):
         self._db = db
         self._lock = threading.Lock()
         self._thread: Optional[threading.Thread] = None
-        self._active_run_id: Optional[int] = None
+        self._active_run_ids: list[int] = []
+        self._cancel = threading.Event()
+        self._wake = threading.Event()
 
-    def active_run_id(self) -> Optional[int]:
+    def cancel(self, run_id: Optional[int] = None) -> list[int]:
+        """
+        Bez run_id: prosi aktywna partie o zakonczenie (kooperacyjnie: oczekujace zapytania o sale sa anulowane).
+        Z run_id: anuluje run z kolejki albo - gdy juz trwa - cala partie, w ktorej jest.
+        Zwraca id runow, ktore zostaly poproszone o przerwanie.
+        """
+        with self._lock:
+            active = list(self._active_run_ids) if self._thread and self._thread.is_alive() else []
+            if active and (run_id is None or run_id in active):
+                self._cancel.set()
+                return active
+        if run_id is not None and self._db.cancel_queued_run(run_id):
+            return [run_id]
+        return []
+
+    def active_run_ids(self) -> list[int]:
         with self._lock:
             if self._thread and self._thread.is_alive():
-                return self._active_run_id
-            return None
+                return list(self._active_run_ids)
+            return []
 
-    def start(self, *, tok_name: str, start_iso: Optional[str], end_iso: Optional[str], max_workers: int) -> int:
+    def active_run_id(self) -> Optional[int]:
+        ids = self.active_run_ids()
+        return ids[0] if ids else None
+
+    def enqueue(
+        self,
+        *,
+        tok_name: str,
+        start_iso: Optional[str],
+        end_iso: Optional[str],
+        max_workers: Optional[int] = None,
+        mode: str = "full",
+        priority: int = 0,
+    ) -> tuple[int, bool]:
+        """
+        Dodaje run do kolejki i budzi watek roboczy. Ten sam (tok_name, okno), ktory juz czeka albo trwa,
+        nie tworzy nowego runu. Zwraca (run_id, czy_zdeduplikowany).
+        """
         if not tok_name:
             tok_name = DEFAULT_TOK_NAME
 
@@ -87,81 +270,241 @@ class SyncRunner:
             start_iso = start_iso or start_default
             end_iso = end_iso or end_default
 
-        # normalizacja formatow
+        # normalizacja formatow (identyczne okna musza dac identyczne stringi, inaczej nie zdeduplikujemy)
         start_iso = _parse_iso_or_date(start_iso, is_end=False)
         end_iso = _parse_iso_or_date(end_iso, is_end=True)
 
+        run_id, deduplicated = self._db.enqueue_run(
+            tok_name, start_iso, end_iso, mode=mode, priority=priority, max_workers=max_workers
+        )
+        self._ensure_worker()
+        return run_id, deduplicated
+
+    def start(
+        self,
+        *,
+        tok_name: str,
+        start_iso: Optional[str],
+        end_iso: Optional[str],
+        max_workers: Optional[int] = None,
+        mode: str = "full",
+    ) -> int:
+        return self.enqueue(
+            tok_name=tok_name, start_iso=start_iso, end_iso=end_iso, max_workers=max_workers, mode=mode
+        )[0]
+
+    def resume_unfinished(self) -> list[int]:
+        """
+        Po starcie procesu runy 'running' nie maja juz watku (restart w trakcie runu): wracaja do kolejki
+        razem z czekajacymi. Kazdy pobiera potem tylko sale bez checkpointu 'done' (sale 'failed' sa ponawiane).
+        Zwraca id runow w kolejce.
+        """
+        self._db.requeue_running_runs()
+        runs = self._db.list_unfinished_runs()
+        if runs:
+            self._ensure_worker()
+        return [r.id for r in runs]
+
+    def _ensure_worker(self) -> None:
         with self._lock:
+            self._wake.set()
             if self._thread and self._thread.is_alive():
-                raise RuntimeError("sync already running")
-
-            run_id = self._db.create_run(tok_name, start_iso, end_iso)
-            t = threading.Thread(
-                target=self._run,
-                args=(run_id, tok_name, start_iso, end_iso, max_workers),
-                daemon=True,
-                name=f"sync-run-{run_id}",
-            )
+                return
+            t = threading.Thread(target=self._worker, daemon=True, name="sync-worker")
             self._thread = t
-            self._active_run_id = run_id
             t.start()
-            return run_id
 
-    def _run(self, run_id: int, tok_name: str, start_iso: str, end_iso: str, max_workers: int) -> None:
-        errors = 0
-        last_error: Optional[str] = None
-        groups_found: set[str] = set()
-        rooms_processed = 0
-        groups_added_total = 0
+    def _worker(self) -> None:
+        # Sync to praca w tle: zapytania do ZUT ustepuja w kolejce schedulera interaktywnym i discovery.
+        with upstream_priority(PRIORITY_BACKGROUND):
+            self._work()
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                self._wake.clear()
+            batch = self._db.claim_sync_batch()
+            if not batch:
+                with self._lock:
+                    # enqueue miedzy claim a tym miejscem ustawil _wake: jeszcze jedno podejscie
+                    if not self._wake.is_set():
+                        self._thread = None
+                        return
+                continue
+            with self._lock:
+                self._active_run_ids = [r.id for r in batch]
+                self._cancel = threading.Event()
+            try:
+                self._run_batch(batch)
+            finally:
+                with self._lock:
+                    self._active_run_ids = []
+
+    def _scan_full(
+        self,
+        rooms: list[str],
+        start_iso: str,
+        end_iso: str,
+        max_workers: Optional[int],
+        on_idle: Optional[Callable[[], None]] = None,
+    ) -> Iterator[_RoomResult]:
+        """
+        Skan wszystkich sal dla calego okna. Zwraca _RoomResult w kolejnosci naplywania.
+        """
+        # Pobieramy asynchronicznie (jedna petla, wiele zapytan w locie), zapis do DB w tym watku (jeden writer).
+        for res in scan_rooms(
+            rooms,
+            start_iso=start_iso,
+            end_iso=end_iso,
+            concurrency=scan_concurrency(max_workers),
+            cancel=self._cancel,
+            on_idle=on_idle,
+        ):
+            if res.error is not None:
+                yield res.room, res.error, {}, []
+                continue
+            # Indeks sala -> tok_name -> grupa dostaje wszystkie programy z odpowiedzi, nie tylko te z partii.
+            groups_by_tok = res.groups_by_tok or {}
+            yield res.room, None, groups_by_tok, [(start_iso, end_iso, groups_by_tok)]
 
+    def _scan_incremental(
+        self,
+        rooms: list[str],
+        tok_names: list[str],
+        start_iso: str,
+        end_iso: str,
+        max_workers: Optional[int],
+        on_idle: Optional[Callable[[], None]] = None,
+    ) -> tuple[set[str], dict[str, set[str]], Iterator[_RoomResult]]:
+        """
+        Okno dzielimy na tygodnie (week_slices). Tydzien sali jest aktualny, jesli room_scans ma jego skan
+        mlodszy niz slice_ttl_s (z dowolnego runu albo discovery; moze to byc suma kilku skanow).
+        Grupy z aktualnych tygodni bierzemy z room_index; pobieramy tylko nieaktualne tygodnie,
+        stykajace sie jednym zapytaniem na sale.
+
+        Zwraca (sale bez nic do pobrania, tok_name -> grupy z indeksu, wyniki pobierania jak _scan_full).
+        """
+        slices = week_slices(start_iso, end_iso)
+        known: dict[str, set[str]] = {tok: set() for tok in tok_names}
+        fresh_by_slice: dict[tuple[str, str], set[str]] = {}
+        for sl in slices:
+            ttl = slice_ttl_s(sl[1])
+            fresh_by_slice[sl] = self._db.list_rooms_with_fresh_scan(*sl, max_age_s=ttl)
+            for tok, groups in self._db.list_groups_from_room_index(tok_names, *sl, max_age_s=ttl).items():
+                known.setdefault(tok, set()).update(groups)
+
+        tasks = [(room, [sl for sl in slices if room not in fresh_by_slice[sl]]) for room in rooms]
+        tasks = [(room, stale) for room, stale in tasks if stale]
+        stale_rooms = {room for room, _ in tasks}
+
+        def _results() -> Iterator[_RoomResult]:
+            for res in scan_room_slices(
+                tasks,
+                concurrency=scan_concurrency(max_workers),
+                cancel=self._cancel,
+                on_idle=on_idle,
+            ):
+                if res.error is not None:
+                    yield res.room, res.error, {}, []
+                    continue
+                groups: dict[str, set[str]] = {}
+                windows = []
+                for (ws, we), groups_by_tok in (res.groups_by_slice or {}).items():
+                    windows.append((ws, we, groups_by_tok))
+                    for tok, gs in groups_by_tok.items():
+                        groups.setdefault(tok, set()).update(gs)
+                yield res.room, None, groups, windows
+
+        return {room for room in rooms if room not in stale_rooms}, known, _results()
+
+    def _prepare(self, run: SyncRun, fetched: list[list[str]]) -> _RunState:
+        # Sale runu z sync_run_rooms (zapisane przy pierwszym starcie), bez ponownego pytania ZUT.
+        run_rooms = self._db.list_run_rooms(run.id)
+        if run_rooms:
+            rooms = list(run_rooms)
+        else:
+            # Lista sal jest wspolna dla partii: pobieramy ja najwyzej raz.
+            if not fetched:
+                fetched.append(fetch_rooms())
+                self._db.upsert_rooms(fetched[0])
+            rooms = fetched[0]
+            self._db.add_run_rooms(run.id, rooms)
+        self._db.update_run_progress(run.id, rooms_total=len(rooms))
+
+        st = _RunState(run=run, rooms=rooms, pending={r for r in rooms if run_rooms.get(r) != "done"})
+        if run_rooms:
+            # Wznowienie: licznik i grupy z poprzedniego przebiegu.
+            st.rooms_processed = len(rooms) - len(st.pending)
+            st.groups_found = set(self._db.list_groups_for_run(run.id, run.tok_name))
+            st.groups_added = run.groups_added
+            st.errors = run.errors
+        return st
+
+    def _run_batch(self, runs: list[SyncRun]) -> None:
+        head = runs[0]
+        states: list[_RunState] = []
         try:
-            self._db.mark_run_started(run_id)
-
-            rooms = fetch_rooms()
-            self._db.upsert_rooms(rooms)
-            self._db.update_run_progress(run_id, rooms_total=len(rooms))
-
-            # Pobieramy w watkach, zapis do DB w tym watku (jeden writer).
-            with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as ex:
-                futures = {
-                    ex.submit(fetch_room_groups, room, tok_name=tok_name, start_iso=start_iso, end_iso=end_iso): room
-                    for room in rooms
-                }
-                for fut in as_completed(futures):
-                    room = futures[fut]
-                    rooms_processed += 1
-                    try:
-                        groups = fut.result()
-                    except Exception as e:  # noqa: BLE001
-                        errors += 1
-                        last_error = f"{room}: {e}"
-                        self._db.update_run_progress(run_id, errors=errors, last_error=last_error)
-                        groups = set()
-
-                    if groups:
-                        groups_found.update(groups)
-                        groups_added_total += self._db.add_groups_for_run(run_id, tok_name, groups)
-
-                    if rooms_processed % 25 == 0 or rooms_processed == len(rooms):
-                        self._db.update_run_progress(
-                            run_id,
-                            rooms_processed=rooms_processed,
-                            groups_found=len(groups_found),
-                            groups_added=groups_added_total,
-                            errors=errors,
-                            last_error=last_error,
-                        )
-
-            self._db.mark_run_finished(run_id, status="success", last_error=last_error)
+            fetched: list[list[str]] = []
+            states = [self._prepare(run, fetched) for run in runs]
+
+            # Suma sal oczekujacych w kolejnosci pierwszego runu, ktory je ma.
+            pending: list[str] = []
+            seen: set[str] = set()
+            for st in states:
+                for room in st.rooms:
+                    if room in st.pending and room not in seen:
+                        seen.add(room)
+                        pending.append(room)
+            # Partia ma wspolny limit (claim_sync_batch laczy tylko runy z tym samym max_workers).
+            max_workers = head.max_workers or None
+            buf = _WriteBuffer(self._db)
+
+            def _flush_if_due() -> None:
+                # Takze gdy nie przychodza nowe wyniki (wolny koniec skanu): limit czasu bufora ma dzialac zawsze.
+                if buf.due():
+                    buf.flush(states)
+
+            if head.mode == "incremental":
+                # Sale bez nieaktualnych tygodni nie dostaja checkpointu; po restarcie znow wyjda jako aktualne.
+                fresh, known, results = self._scan_incremental(
+                    pending,
+                    sorted({r.tok_name for r in runs}),
+                    head.start_iso,
+                    head.end_iso,
+                    max_workers,
+                    on_idle=_flush_if_due,
+                )
+                for st in states:
+                    st.rooms_processed += len(fresh & st.pending)
+                    buf.add_groups(st, known.get(st.run.tok_name, set()))
+                buf.flush(states)
+            else:
+                results = self._scan_full(pending, head.start_iso, head.end_iso, max_workers, on_idle=_flush_if_due)
+
+            for room, error, groups_by_tok, windows in results:
+                for ws, we, groups in windows:
+                    buf.add_scan(room, ws, we, groups)
+                for st in states:
+                    if room not in st.pending:
+                        continue
+                    st.pending.discard(room)
+                    st.rooms_processed += 1
+                    if error is not None:
+                        st.errors += 1
+                        st.last_error = f"{room}: {error}"
+                    buf.add_groups(st, groups_by_tok.get(st.run.tok_name, set()))
+                    # Checkpoint w tym samym commicie co wyniki sali: przerwanie najwyzej powtorzy sale z bufora.
+                    buf.add_room(st, room, None if error is None else str(error))
+                _flush_if_due()
+
+            buf.flush(states, finish_status="cancelled" if self._cancel.is_set() else "success")
         except Exception as e:  # noqa: BLE001
             last_error = str(e)
-            try:
-                self._db.update_run_progress(run_id, errors=errors + 1, last_error=last_error)
-                self._db.mark_run_finished(run_id, status="failed", last_error=last_error)
-            except Exception:
-                pass
-        finally:
-            with self._lock:
-                if self._active_run_id == run_id:
-                    self._active_run_id = None
-
+            by_id = {st.run.id: st for st in states}
+            for run in runs:
+                try:
+                    errors = by_id[run.id].errors if run.id in by_id else run.errors
+                    self._db.update_run_progress(run.id, errors=errors + 1, last_error=last_error)
+                    self._db.mark_run_finished(run.id, status="failed", last_error=last_error)
+                except Exception:
+                    pass
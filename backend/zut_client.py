@@ -1,41 +1,783 @@
 from __future__ import annotations
 
+import asyncio
+import contextvars
+import gzip
+import heapq
+import http.client
+import itertools
 import json
+import ssl
+import threading
 import time
 import urllib.parse
-import urllib.request
-from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, Protocol, TypeVar
 
-from .config import BASE_URL
+from .config import BASE_URL, HTTP_POOL_MAX_PER_HOST, UPSTREAM_MAX_CONCURRENCY, UPSTREAM_RESERVED_INTERACTIVE
+
+
+T = TypeVar("T")
 
 
 class ZutClientError(RuntimeError):
     pass
 
 
+class Transport(Protocol):
+    """
+    Minimalny interfejs transportu HTTP uzywany przez _fetch_json (GET -> surowe, zdekodowane body).
+    """
+
+    def get(self, url: str, *, headers: dict[str, str], timeout_s: float) -> bytes: ...
+
+    def stats(self) -> dict[str, Any]: ...
+
+
+class HttpTransport:
+    """
+    Pula trwalych polaczen HTTP/1.1 (keep-alive) per host, wspoldzielona miedzy watkami.
+
+    - max_per_host ogranicza liczbe jednoczesnie otwartych polaczen do jednego hosta
+      (wolne polaczenia wracaja do puli i sa uzywane ponownie zamiast nowego TCP+TLS),
+    - wysylamy Accept-Encoding: gzip i transparentnie dekompresujemy odpowiedz,
+    - stats() zwraca liczniki reuse/otwartych polaczen (do diagnostyki przez API).
+    """
+
+    _MAX_REDIRECTS = 3
+
+    def __init__(self, *, max_per_host: int = HTTP_POOL_MAX_PER_HOST):
+        self._max_per_host = max(1, int(max_per_host))
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str, int], list[http.client.HTTPConnection]] = {}
+        self._slots: dict[tuple[str, str, int], threading.BoundedSemaphore] = {}
+        self._ssl_ctx = ssl.create_default_context()
+        self._stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "stale_reconnects": 0,
+            "gzip_responses": 0,
+            "bytes_wire": 0,
+            "bytes_decoded": 0,
+        }
+
+    def _bump(self, **deltas: int) -> None:
+        with self._lock:
+            for k, v in deltas.items():
+                self._stats[k] += v
+
+    def _slot(self, key: tuple[str, str, int]) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._slots.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self._max_per_host)
+                self._slots[key] = sem
+            return sem
+
+    def _take_idle(self, key: tuple[str, str, int]) -> Optional[http.client.HTTPConnection]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def _put_idle(self, key: tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _open(self, key: tuple[str, str, int], timeout_s: float) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        self._bump(connections_opened=1)
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout_s, context=self._ssl_ctx)
+        return http.client.HTTPConnection(host, port, timeout=timeout_s)
+
+    @staticmethod
+    def _key(url: str) -> tuple[tuple[str, str, int], str]:
+        u = urllib.parse.urlsplit(url)
+        scheme = (u.scheme or "http").lower()
+        if scheme not in ("http", "https"):
+            raise ZutClientError(f"unsupported url scheme: {url}")
+        port = u.port or (443 if scheme == "https" else 80)
+        path = u.path or "/"
+        if u.query:
+            path = f"{path}?{u.query}"
+        return (scheme, u.hostname or "", port), path
+
+    def _request_once(
+        self, key: tuple[str, str, int], path: str, headers: dict[str, str], timeout_s: float
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        sem = self._slot(key)
+        if not sem.acquire(timeout=timeout_s):
+            raise ZutClientError(f"connection pool exhausted for {key[1]}")
+        try:
+            conn = self._take_idle(key)
+            reused = conn is not None
+            # Polaczenie z puli moglo zostac zamkniete przez serwer (idle timeout) - wtedy jeden retry na swiezym.
+            for fresh_attempt in (False, True):
+                if conn is None:
+                    conn = self._open(key, timeout_s)
+                    reused = False
+                conn.timeout = timeout_s
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout_s)
+                try:
+                    conn.request("GET", path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                    conn.close()
+                    conn = None
+                    if reused and not fresh_attempt:
+                        self._bump(stale_reconnects=1)
+                        continue
+                    raise ZutClientError(f"connection error ({key[1]}): {e}") from e
+                except Exception:
+                    conn.close()
+                    raise
+
+                self._bump(requests=1, connections_reused=1 if reused else 0, bytes_wire=len(body))
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._put_idle(key, conn)
+                return resp.status, resp.msg, body
+            raise ZutClientError(f"connection error ({key[1]})")
+        finally:
+            sem.release()
+
+    def get(self, url: str, *, headers: dict[str, str], timeout_s: float) -> bytes:
+        headers = {**headers, "Accept-Encoding": "gzip", "Connection": "keep-alive"}
+        for _ in range(self._MAX_REDIRECTS + 1):
+            key, path = self._key(url)
+            headers["Host"] = key[1] if key[2] in (80, 443) else f"{key[1]}:{key[2]}"
+            status, msg, body = self._request_once(key, path, headers, timeout_s)
+            if status in (301, 302, 303, 307, 308) and msg.get("Location"):
+                url = urllib.parse.urljoin(url, msg["Location"])
+                continue
+            if status >= 400:
+                raise ZutClientError(f"HTTP {status} ({url})")
+            if (msg.get("Content-Encoding") or "").strip().lower() == "gzip":
+                body = gzip.decompress(body)
+                self._bump(gzip_responses=1)
+            self._bump(bytes_decoded=len(body))
+            return body
+        raise ZutClientError(f"too many redirects ({url})")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            out: dict[str, Any] = dict(self._stats)
+            out["idle_connections"] = sum(len(v) for v in self._idle.values())
+        out["max_per_host"] = self._max_per_host
+        out["reuse_ratio"] = round(out["connections_reused"] / out["requests"], 4) if out["requests"] else 0.0
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            self._idle.clear()
+        for c in idle:
+            c.close()
+
+
+_transport: Transport = HttpTransport()
+
+
+def get_transport() -> Transport:
+    return _transport
+
+
+def set_transport(transport: Transport) -> Transport:
+    """
+    Podmienia transport uzywany przez wszystkie fetch_* (np. w testach). Zwraca poprzedni.
+    """
+    global _transport
+    prev = _transport
+    _transport = transport
+    return prev
+
+
+# Klasy priorytetu zapytan do ZUT (mniejsza liczba = wczesniej): tydzien studenta, discovery
+# (tok_name / grupy studenta), sync i odswiezanie w tle.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DISCOVERY = 1
+PRIORITY_BACKGROUND = 2
+_PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_DISCOVERY: "discovery",
+    PRIORITY_BACKGROUND: "background",
+}
+
+# Klasa biezacego kodu (watek / task asyncio) i klasa trzymanego slotu (None: bez slotu);
+# zagniezdzone wywolania nie biora drugiego slotu.
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("upstream_priority", default=PRIORITY_INTERACTIVE)
+_holding: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("upstream_holding", default=None)
+
+
+@contextmanager
+def upstream_priority(priority: int) -> Iterator[None]:
+    """
+    Ustawia klase priorytetu dla zapytan do ZUT wykonywanych w tym bloku (tez w taskach asyncio z niego tworzonych).
+    """
+    token = _priority.set(int(priority))
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Retry(BaseException):
+    # Zadanie z submit() chce ponowic zapytanie po przerwie. BaseException, zeby nie zlapal go
+    # ogolny `except Exception` w kodzie zadania.
+    def __init__(self, delay_s: float, attempt: int):
+        super().__init__(delay_s, attempt)
+        self.delay_s = delay_s
+        self.attempt = attempt
+
+
+class _Task:
+    __slots__ = ("priority", "future", "fn", "args", "attempt")
+
+    def __init__(self, priority: int, future: Future, fn: Callable[..., Any], args: tuple):
+        self.priority = priority
+        self.future = future
+        self.fn = fn
+        self.args = args
+        # Numer proby zapytania przy ponowieniu (czyta go _fetch_json).
+        self.attempt = 1
+
+
+# Zadanie z submit() wykonywane w biezacym watku (None: kod poza submit()).
+_task: contextvars.ContextVar[Optional[_Task]] = contextvars.ContextVar("upstream_task", default=None)
+
+
+class _Waiter:
+    __slots__ = ("priority", "wake", "granted", "cancelled", "since")
+
+    def __init__(self, priority: int, wake: Callable[[], None]):
+        self.priority = priority
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+        self.since = time.monotonic()
+
+
+class UpstreamScheduler:
+    """
+    Jeden na proces limit zapytan do ZUT jednoczesnie w locie, z kolejka wg klasy priorytetu.
+
+    - zwolniony slot dostaje najpierw czekajacy z najwyzsza klasa (przy rownej - najstarszy),
+      wiec zapytania interaktywne wyprzedzaja w kolejce sync w tle,
+    - klasy inne niz interaktywna moga zajac najwyzej max_concurrency - reserved_interactive slotow,
+    - slot() / aslot() obejmuja jedno zapytanie (watek / asyncio), submit() cale zadanie w puli watkow
+      o rozmiarze budzetu: zadanie startuje dopiero z przydzielonym slotem, wiec zawsze ma wolny watek,
+      a przed retry oddaje i slot, i watek - wraca do kolejki po przerwie (jeden watek-timer na proces).
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrency: int = UPSTREAM_MAX_CONCURRENCY,
+        reserved_interactive: int = UPSTREAM_RESERVED_INTERACTIVE,
+    ):
+        self._limit = max(1, int(max_concurrency))
+        self._reserved = min(max(0, int(reserved_interactive)), self._limit - 1)
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiters: list[tuple[int, int, _Waiter]] = []
+        self._in_use: dict[int, int] = {}
+        self._stats: dict[int, dict[str, float]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._timers: list[tuple[float, int, _Task]] = []
+        self._timer_cv = threading.Condition()
+        self._timer_thread: Optional[threading.Thread] = None
+
+    def _cap(self, priority: int) -> int:
+        return self._limit if priority <= PRIORITY_INTERACTIVE else self._limit - self._reserved
+
+    def _grant_locked(self, priority: int, waited_s: float) -> None:
+        self._in_use[priority] = self._in_use.get(priority, 0) + 1
+        st = self._stats.setdefault(priority, {"granted": 0, "queued": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0})
+        st["granted"] += 1
+        if waited_s > 0:
+            st["queued"] += 1
+            st["wait_ms_total"] += waited_s * 1000
+            st["wait_ms_max"] = max(st["wait_ms_max"], waited_s * 1000)
+
+    def _enqueue(self, priority: int, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """
+        Przydziela slot od razu (None) albo kolejkuje czekajacego; wake() zostanie wywolane po przydziale.
+        """
+        with self._lock:
+            while self._waiters and self._waiters[0][2].cancelled:
+                heapq.heappop(self._waiters)
+            in_use = sum(self._in_use.values())
+            # Nie wyprzedzamy czekajacych z ta sama albo wyzsza klasa.
+            ahead = bool(self._waiters) and self._waiters[0][0] <= priority
+            if not ahead and in_use < self._cap(priority):
+                self._grant_locked(priority, 0.0)
+                return None
+            w = _Waiter(priority, wake)
+            heapq.heappush(self._waiters, (priority, next(self._seq), w))
+            return w
+
+    def _release(self, priority: int) -> None:
+        wakes: list[tuple[int, Callable[[], None]]] = []
+        with self._lock:
+            self._in_use[priority] -= 1
+            in_use = sum(self._in_use.values())
+            while self._waiters:
+                prio, _, w = self._waiters[0]
+                if w.cancelled:
+                    heapq.heappop(self._waiters)
+                    continue
+                if in_use >= self._cap(prio):
+                    break
+                heapq.heappop(self._waiters)
+                w.granted = True
+                self._grant_locked(prio, time.monotonic() - w.since)
+                in_use += 1
+                wakes.append((prio, w.wake))
+        for prio, wake in wakes:
+            try:
+                wake()
+            except Exception:  # noqa: BLE001
+                # Np. petla waitera aslot() juz zamknieta (anulowany skan): nikt nie odbierze slotu,
+                # wiec oddajemy go kolejnemu czekajacemu zamiast rzucac w obcym watku.
+                self._release(prio)
+
+    def _acquire(self, priority: int) -> None:
+        ev = threading.Event()
+        if self._enqueue(priority, ev.set) is not None:
+            ev.wait()
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        Oddaje slot trzymany w tym kontekscie (np. w bloku slot() obejmujacym kilka zapytan) na czas bloku,
+        np. przerwy przed retry, i czeka na niego ponownie w tej samej klasie. Bez trzymanego slotu nic nie robi.
+        Zadania z submit() nie czekaja w paused(): przed retry wracaja do kolejki (patrz _fetch_json).
+        """
+        prio = _holding.get()
+        if prio is None:
+            yield
+            return
+        self._release(prio)
+        try:
+            yield
+        finally:
+            self._acquire(prio)
+
+    @contextmanager
+    def slot(self, priority: Optional[int] = None) -> Iterator[None]:
+        """
+        Blokujaco czeka na slot dla jednego zapytania (domyslnie w klasie z upstream_priority).
+        """
+        if _holding.get() is not None:
+            yield
+            return
+        prio = _priority.get() if priority is None else int(priority)
+        self._acquire(prio)
+        token = _holding.set(prio)
+        try:
+            yield
+        finally:
+            _holding.reset(token)
+            self._release(prio)
+
+    @asynccontextmanager
+    async def aslot(self, priority: Optional[int] = None) -> AsyncIterator[None]:
+        """
+        Async odpowiednik slot(): czekanie nie blokuje petli, anulowanie taska zwalnia miejsce w kolejce.
+        """
+        if _holding.get() is not None:
+            yield
+            return
+        prio = _priority.get() if priority is None else int(priority)
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+
+        def _wake() -> None:
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+
+        w = self._enqueue(prio, _wake)
+        if w is not None:
+            try:
+                await fut
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted = w.granted
+                    w.cancelled = True
+                if granted:
+                    self._release(prio)
+                raise
+        token = _holding.set(prio)
+        try:
+            yield
+        finally:
+            _holding.reset(token)
+            self._release(prio)
+
+    def submit(self, fn: Callable[..., T], *args: Any, priority: int = PRIORITY_INTERACTIVE) -> "Future[T]":
+        """
+        Kolejkuje fn(*args) w klasie priority; zadanie trzyma jeden slot przez caly czas wykonania
+        (zapytania w srodku nie biora drugiego). Anulowane przed startem Future zwalnia slot bez wykonania.
+        Przy bledzie zapytania (_fetch_json) fn jest po przerwie wykonywane od poczatku, wiec ma byc
+        powtarzalne - w praktyce jedno pobranie.
+        """
+        task = _Task(int(priority), Future(), fn, args)
+        self._schedule(task)
+        return task.future
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Zadanie dostaje watek dopiero ze slotem, a zadan ze slotem jest najwyzej tyle, ile budzetu.
+                self._executor = ThreadPoolExecutor(max_workers=self._limit, thread_name_prefix="upstream-task")
+            return self._executor
+
+    def _schedule(self, task: _Task) -> None:
+        def _start() -> None:
+            try:
+                self._pool().submit(self._run_task, task)
+            except Exception as e:  # noqa: BLE001
+                if not task.future.done():
+                    try:
+                        task.future.set_exception(e)
+                    except Exception:  # noqa: BLE001 - rownolegle anulowane
+                        pass
+                raise
+
+        if self._enqueue(task.priority, _start) is None:
+            try:
+                _start()
+            except Exception:  # noqa: BLE001 - blad jest w Future
+                self._release(task.priority)
+
+    def _run_task(self, task: _Task) -> None:
+        retry: Optional[_Retry] = None
+        try:
+            # Ponowienie dziala na Future juz w stanie running (nie da sie go wtedy anulowac).
+            if task.attempt == 1 and not task.future.set_running_or_notify_cancel():
+                return
+            prio_token = _priority.set(task.priority)
+            hold_token = _holding.set(task.priority)
+            task_token = _task.set(task)
+            try:
+                task.future.set_result(task.fn(*task.args))
+            except _Retry as r:
+                retry = r
+            except BaseException as e:  # noqa: BLE001 - wyjatek trafia do Future
+                task.future.set_exception(e)
+            finally:
+                _task.reset(task_token)
+                _holding.reset(hold_token)
+                _priority.reset(prio_token)
+        finally:
+            self._release(task.priority)
+        if retry is not None:
+            task.attempt = retry.attempt
+            self._later(retry.delay_s, task)
+
+    def _later(self, delay_s: float, task: _Task) -> None:
+        # Przerwa przed retry bez slotu i bez watku z puli: zadanie czeka w kolejce timera.
+        with self._timer_cv:
+            heapq.heappush(self._timers, (time.monotonic() + delay_s, next(self._seq), task))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._timer_main, daemon=True, name="upstream-retry")
+                self._timer_thread.start()
+            self._timer_cv.notify()
+
+    def _timer_main(self) -> None:
+        while True:
+            with self._timer_cv:
+                while not self._timers:
+                    self._timer_cv.wait()
+                due, _, task = self._timers[0]
+                now = time.monotonic()
+                if due > now:
+                    self._timer_cv.wait(due - now)
+                    continue
+                heapq.heappop(self._timers)
+            self._schedule(task)
+
+    def stats(self) -> dict[str, Any]:
+        with self._timer_cv:
+            retrying = len(self._timers)
+        with self._lock:
+            queued: dict[str, int] = {}
+            for prio, _, w in self._waiters:
+                if not w.cancelled:
+                    name = _PRIORITY_NAMES.get(prio, str(prio))
+                    queued[name] = queued.get(name, 0) + 1
+            classes = {
+                _PRIORITY_NAMES.get(prio, str(prio)): {
+                    "in_use": self._in_use.get(prio, 0),
+                    "granted": int(st["granted"]),
+                    "queued": int(st["queued"]),
+                    "wait_ms_avg": round(st["wait_ms_total"] / st["queued"], 1) if st["queued"] else 0.0,
+                    "wait_ms_max": round(st["wait_ms_max"], 1),
+                }
+                for prio, st in sorted(self._stats.items())
+            }
+            return {
+                "max_concurrency": self._limit,
+                "reserved_interactive": self._reserved,
+                "in_use": sum(self._in_use.values()),
+                "waiting": queued,
+                "retrying": retrying,
+                "classes": classes,
+            }
+
+
+_scheduler = UpstreamScheduler()
+
+
+def get_scheduler() -> UpstreamScheduler:
+    return _scheduler
+
+
 def _fetch_json(url: str, *, timeout_s: int = 30, retries: int = 3) -> Any:
     last_err: Exception | None = None
-    for attempt in range(1, retries + 1):
+    task = _task.get()
+    for attempt in range(task.attempt if task is not None else 1, retries + 1):
         try:
-            req = urllib.request.Request(
-                url,
-                headers={
-                    "User-Agent": "plan-sync/1.0",
-                    "Accept": "application/json,text/plain,*/*",
-                },
-            )
-            with urllib.request.urlopen(req, timeout=timeout_s) as r:
-                data = r.read()
+            # Slot tylko na czas zapytania: przerwa przed retry nie zajmuje budzetu.
+            with _scheduler.slot():
+                data = _transport.get(
+                    url,
+                    headers={
+                        "User-Agent": "plan-sync/1.0",
+                        "Accept": "application/json,text/plain,*/*",
+                    },
+                    timeout_s=timeout_s,
+                )
             return json.loads(data)
         except Exception as e:  # noqa: BLE001 - pragmatycznie: retry na wszystko
             last_err = e
             if attempt < retries:
-                time.sleep(0.4 * attempt)
+                if task is not None:
+                    # Zadanie z submit(): zamiast spac na watku puli oddaje slot i watek, a scheduler
+                    # uruchomi je ponownie po przerwie (od tej proby).
+                    raise _Retry(0.4 * attempt, attempt + 1) from e
+                with _scheduler.paused():
+                    time.sleep(0.4 * attempt)
+                continue
+            raise ZutClientError(f"fetch_json failed ({url}): {e}") from e
+    raise ZutClientError(f"fetch_json failed ({url}): {last_err}")
+
+
+class AsyncHttpTransport:
+    """
+    Asynchroniczny odpowiednik HttpTransport (asyncio streams, HTTP/1.1 keep-alive, gzip).
+
+    Obiekt jest zwiazany z jedna petla zdarzen (tworzymy go w srodku skanu); dzieki temu
+    setki zapytan moga czekac na odpowiedz z jednego watku zamiast blokowac pule watkow.
+    """
+
+    def __init__(self, *, max_per_host: int = HTTP_POOL_MAX_PER_HOST):
+        self._max_per_host = max(1, int(max_per_host))
+        self._idle: dict[tuple[str, str, int], list[tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        self._slots: dict[tuple[str, str, int], asyncio.Semaphore] = {}
+        self._ssl_ctx = ssl.create_default_context()
+        self._stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "stale_reconnects": 0,
+            "gzip_responses": 0,
+        }
+
+    def _slot(self, key: tuple[str, str, int]) -> asyncio.Semaphore:
+        sem = self._slots.get(key)
+        if sem is None:
+            sem = asyncio.Semaphore(self._max_per_host)
+            self._slots[key] = sem
+        return sem
+
+    async def _open(self, key: tuple[str, str, int]) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        scheme, host, port = key
+        self._stats["connections_opened"] += 1
+        return await asyncio.open_connection(
+            host, port, ssl=self._ssl_ctx if scheme == "https" else None, limit=2**20
+        )
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str], bytes, bool]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        parts = status_line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ZutClientError(f"bad status line: {status_line!r}")
+        version, status = parts[0], int(parts[1])
+
+        headers: dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version != "HTTP/1.0" and headers.get("connection", "").lower() != "close"
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            chunks: list[bytes] = []
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # trailer (zwykle pusty) konczy sie pusta linia
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, headers, body, keep_alive
+
+    async def _request_once(
+        self, key: tuple[str, str, int], path: str, headers: dict[str, str]
+    ) -> tuple[int, dict[str, str], bytes]:
+        async with self._slot(key):
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+            reused = conn is not None
+            for fresh_attempt in (False, True):
+                if conn is None:
+                    conn = await self._open(key)
+                    reused = False
+                reader, writer = conn
+                head = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+                try:
+                    writer.write(f"GET {path} HTTP/1.1\r\n{head}\r\n".encode("latin-1"))
+                    await writer.drain()
+                    status, resp_headers, body, keep_alive = await self._read_response(reader)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    conn = None
+                    if reused and not fresh_attempt:
+                        self._stats["stale_reconnects"] += 1
+                        continue
+                    raise ZutClientError(f"connection error ({key[1]}): {e}") from e
+                except BaseException:
+                    # w tym CancelledError - polaczenie jest w nieznanym stanie, nie wraca do puli
+                    writer.close()
+                    raise
+
+                self._stats["requests"] += 1
+                if reused:
+                    self._stats["connections_reused"] += 1
+                if keep_alive:
+                    self._idle.setdefault(key, []).append(conn)
+                else:
+                    writer.close()
+                return status, resp_headers, body
+            raise ZutClientError(f"connection error ({key[1]})")
+
+    async def get(self, url: str, *, headers: dict[str, str], timeout_s: float) -> bytes:
+        headers = {**headers, "Accept-Encoding": "gzip", "Connection": "keep-alive"}
+        for _ in range(HttpTransport._MAX_REDIRECTS + 1):
+            key, path = HttpTransport._key(url)
+            headers["Host"] = key[1] if key[2] in (80, 443) else f"{key[1]}:{key[2]}"
+            status, resp_headers, body = await asyncio.wait_for(self._request_once(key, path, headers), timeout_s)
+            if status in (301, 302, 303, 307, 308) and resp_headers.get("location"):
+                url = urllib.parse.urljoin(url, resp_headers["location"])
+                continue
+            if status >= 400:
+                raise ZutClientError(f"HTTP {status} ({url})")
+            if resp_headers.get("content-encoding", "").lower() == "gzip":
+                body = gzip.decompress(body)
+                self._stats["gzip_responses"] += 1
+            return body
+        raise ZutClientError(f"too many redirects ({url})")
+
+    def stats(self) -> dict[str, Any]:
+        out: dict[str, Any] = dict(self._stats)
+        out["idle_connections"] = sum(len(v) for v in self._idle.values())
+        return out
+
+    def close(self) -> None:
+        for conns in self._idle.values():
+            for _, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+
+async def _afetch_json(transport: AsyncHttpTransport, url: str, *, timeout_s: int = 30, retries: int = 3) -> Any:
+    last_err: Exception | None = None
+    for attempt in range(1, retries + 1):
+        try:
+            async with _scheduler.aslot():
+                data = await transport.get(
+                    url,
+                    headers={
+                        "User-Agent": "plan-sync/1.0",
+                        "Accept": "application/json,text/plain,*/*",
+                    },
+                    timeout_s=timeout_s,
+                )
+            return json.loads(data)
+        except Exception as e:  # noqa: BLE001 - jak w _fetch_json
+            last_err = e
+            if attempt < retries:
+                await asyncio.sleep(0.4 * attempt)
                 continue
             raise ZutClientError(f"fetch_json failed ({url}): {e}") from e
     raise ZutClientError(f"fetch_json failed ({url}): {last_err}")
 
 
+def _room_schedule_url(room: str, *, start_iso: str, end_iso: str) -> str:
+    params = {"room": room, "start": start_iso, "end": end_iso}
+    q = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+    return f"{BASE_URL}/schedule_student.php?{q}"
+
+
+def groups_by_tok_from_events(events: Any, *, room: str) -> dict[str, set[str]]:
+    """
+    tok_name -> group_name dla wszystkich zdarzen z odpowiedzi /schedule_student.php?room=...
+    """
+    if not isinstance(events, list):
+        raise ZutClientError(f"schedule response is not a list (room={room}): {type(events)}")
+    out: dict[str, set[str]] = {}
+    for ev in events:
+        if not isinstance(ev, dict):
+            continue
+        t = ev.get("tok_name")
+        g = ev.get("group_name")
+        if not t or not g:
+            continue
+        out.setdefault(str(t), set()).add(str(g))
+    return out
+
+
+async def afetch_room_events(transport: AsyncHttpTransport, room: str, *, start_iso: str, end_iso: str) -> list[dict[str, Any]]:
+    """
+    Async: surowe zdarzenia z planu sali (np. do podzialu na tygodnie po `start`).
+    """
+    j = await _afetch_json(transport, _room_schedule_url(room, start_iso=start_iso, end_iso=end_iso), timeout_s=60, retries=2)
+    if not isinstance(j, list):
+        raise ZutClientError(f"schedule response is not a list (room={room}): {type(j)}")
+    return [ev for ev in j if isinstance(ev, dict)]
+
+
+async def afetch_room_groups_all(
+    transport: AsyncHttpTransport, room: str, *, start_iso: str, end_iso: str
+) -> dict[str, set[str]]:
+    """
+    Async: jedno pobranie planu sali, grupy dla wszystkich tok_name wystepujacych w odpowiedzi.
+    """
+    j = await _afetch_json(transport, _room_schedule_url(room, start_iso=start_iso, end_iso=end_iso), timeout_s=60, retries=2)
+    return groups_by_tok_from_events(j, room=room)
+
+
 def fetch_rooms() -> list[str]:
     url = f"{BASE_URL}/schedule.php?kind=room&query="
     j = _fetch_json(url, timeout_s=60, retries=3)
@@ -52,23 +794,8 @@ def fetch_rooms() -> list[str]:
 
 
 def fetch_room_groups(room: str, *, tok_name: str, start_iso: str, end_iso: str) -> set[str]:
-    params = {"room": room, "start": start_iso, "end": end_iso}
-    q = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
-    url = f"{BASE_URL}/schedule_student.php?{q}"
-    j = _fetch_json(url, timeout_s=60, retries=2)
-    if not isinstance(j, list):
-        raise ZutClientError(f"schedule response is not a list (room={room}): {type(j)}")
-
-    groups: set[str] = set()
-    for ev in j:
-        if not isinstance(ev, dict):
-            continue
-        if ev.get("tok_name") != tok_name:
-            continue
-        g = ev.get("group_name")
-        if g:
-            groups.add(str(g))
-    return groups
+    j = _fetch_json(_room_schedule_url(room, start_iso=start_iso, end_iso=end_iso), timeout_s=60, retries=2)
+    return groups_by_tok_from_events(j, room=room).get(tok_name, set())
 
 
 def fetch_room_groups_multi(room: str, *, tok_names: set[str], start_iso: str, end_iso: str) -> dict[str, set[str]]:
@@ -79,25 +806,8 @@ def fetch_room_groups_multi(room: str, *, tok_names: set[str], start_iso: str, e
     if not tok_names:
         return {}
 
-    params = {"room": room, "start": start_iso, "end": end_iso}
-    q = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
-    url = f"{BASE_URL}/schedule_student.php?{q}"
-    j = _fetch_json(url, timeout_s=60, retries=2)
-    if not isinstance(j, list):
-        raise ZutClientError(f"schedule response is not a list (room={room}): {type(j)}")
-
-    out: dict[str, set[str]] = {}
-    for ev in j:
-        if not isinstance(ev, dict):
-            continue
-        t = ev.get("tok_name")
-        if not t or t not in tok_names:
-            continue
-        g = ev.get("group_name")
-        if not g:
-            continue
-        out.setdefault(str(t), set()).add(str(g))
-    return out
+    j = _fetch_json(_room_schedule_url(room, start_iso=start_iso, end_iso=end_iso), timeout_s=60, retries=2)
+    return {t: gs for t, gs in groups_by_tok_from_events(j, room=room).items() if t in tok_names}
 
 
 def fetch_student_schedule(number: str, *, start_iso: str, end_iso: str) -> list[dict[str, Any]]:
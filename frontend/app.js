@@ -155,7 +155,8 @@ function setGroups(groups, { markNew = false } = {}) {
 
 function getPayloadFromForm() {
   const tokName = (tokNameEl.value || "").trim();
-  const maxWorkers = Number(maxWorkersEl.value || 10);
+  // Puste pole: backend skanuje z pelnym budzetem (ROOM_SCAN_CONCURRENCY).
+  const maxWorkers = maxWorkersEl.value ? Number(maxWorkersEl.value) : null;
 
   if (useLast3El.checked) {
     return { tok_name: tokName, max_workers: maxWorkers };
@@ -267,7 +268,7 @@ syncFormEl.addEventListener("submit", async (e) => {
       timeoutMs: 20000,
     });
     state.currentRunId = res.run_id;
-    setNote(`Started run_id=${res.run_id}`);
+    setNote(res.deduplicated ? `Attached to queued run_id=${res.run_id}` : `Queued run_id=${res.run_id}`);
     startPolling();
   } catch (err) {
     const msg = String(err || "");
@@ -4,6 +4,7 @@ const $ = (sel) => document.querySelector(sel);
 
 const START_HOUR = 7;
 const END_HOUR = 21;
+const FILTER_PROFILE_NAME = "domyslny";
 
 const apiBaseEl = $("#apiBase");
 const apiStatusEl = $("#apiStatus");
@@ -51,6 +52,10 @@ const state = {
   working: false,
   selectedTok: "__all__",
   tokNames: [],
+  // Profil filtrow na serwerze: dopoki filtry sie nie zmienia, /api/student/week filtruje zajecia po stronie serwera.
+  filterProfileId: null,
+  filterProfileAlbum: null,
+  serverFiltered: false, // ostatnia odpowiedz zawiera tylko zajecia przechodzace filtr
 };
 
 function setStatus(msg) {
@@ -82,18 +87,32 @@ function setWorking(working, label = null) {
   if (workTextEl) workTextEl.textContent = label || (working ? "working" : "idle");
 }
 
+// Odpowiedzi z ETag (POST /api/student/week): cacheKey -> { etag, body }. Przegladarka nie cache'uje POST,
+// wiec If-None-Match wysylamy sami, a przy 304 oddajemy zapamietane body.
+const etagCache = new Map();
+const ETAG_CACHE_MAX = 16;
+
+function rememberEtag(key, etag, body) {
+  etagCache.delete(key);
+  etagCache.set(key, { etag, body });
+  while (etagCache.size > ETAG_CACHE_MAX) etagCache.delete(etagCache.keys().next().value);
+}
+
 async function fetchJson(path, opts = {}) {
   const ctrl = new AbortController();
   const t = setTimeout(() => ctrl.abort(), opts.timeoutMs || 12000);
+  const cached = opts.etagKey ? etagCache.get(opts.etagKey) : null;
   try {
     const res = await fetch(path, {
       ...opts,
       headers: {
         "content-type": "application/json",
+        ...(cached ? { "if-none-match": cached.etag } : {}),
         ...(opts.headers || {}),
       },
       signal: ctrl.signal,
     });
+    if (cached && res.status === 304) return cached.body;
     if (!res.ok) {
       const ct = (res.headers.get("content-type") || "").toLowerCase();
       let detail = "";
@@ -114,7 +133,10 @@ async function fetchJson(path, opts = {}) {
       }
       throw new Error(`HTTP ${res.status}: ${detail}`);
     }
-    return await res.json();
+    const body = await res.json();
+    const etag = opts.etagKey ? res.headers.get("etag") : null;
+    if (etag) rememberEtag(opts.etagKey, etag, body);
+    return body;
   } finally {
     clearTimeout(t);
   }
@@ -219,9 +241,35 @@ function formatTime(decimalTime) {
   return `${hrs}:${mins < 10 ? "0" + mins : mins}`;
 }
 
+// Backend moze zwrocic lessons w formacie "columnar":
+// { format: "columnar", count, strings: [...], columns: { klucz: [indeks do strings | null, ...] } }.
+function decodeLessons(lessons) {
+  if (!lessons || Array.isArray(lessons) || lessons.format !== "columnar") return lessons || [];
+  const strings = lessons.strings || [];
+  const columns = Object.entries(lessons.columns || {});
+  const out = new Array(lessons.count || 0);
+  for (let i = 0; i < out.length; i++) {
+    const ev = {};
+    for (const [key, values] of columns) {
+      const ix = values[i];
+      if (Array.isArray(ix)) ev[key] = ix.map((k) => (k === null ? null : strings[k]));
+      else ev[key] = ix === null || ix === undefined ? null : strings[ix];
+    }
+    out[i] = ev;
+  }
+  return out;
+}
+
+// Zdarzenie scalone przez backend (merge) ma group_names/tok_names; rozwijamy je do wierszy per grupa.
+function expandMergedLesson(ev) {
+  if (!ev || !Array.isArray(ev.group_names)) return [ev];
+  const toks = Array.isArray(ev.tok_names) ? ev.tok_names : [];
+  return ev.group_names.map((g, i) => ({ ...ev, group_name: g, tok_name: toks[i] ?? ev.tok_name }));
+}
+
 function buildRawEventsFromLessons(lessons) {
   const out = [];
-  for (const ev of lessons || []) {
+  for (const ev of decodeLessons(lessons)) {
     const title = String(ev.title || "Bez nazwy");
     const base = stripLastParen(title) || String(ev.subject || "").trim() || title;
     const formTitle = title;
@@ -240,6 +288,11 @@ function buildRawEventsFromLessons(lessons) {
     const durationMetric = endMetric - startMetric;
 
     const filterKey = `${base}|${formTitle}|${group}|${lecturer}`;
+    // Grupy zdarzenia: jedna dla zwyklego wiersza, kilka dla zdarzenia scalonego przez backend.
+    const members = expandMergedLesson(ev).map((m) => {
+      const g = String(m.group_name || "").trim();
+      return { group: g, tok_name: String(m.tok_name || "").trim(), filterKey: `${base}|${formTitle}|${g}|${lecturer}` };
+    });
 
     out.push({
       base,
@@ -256,6 +309,7 @@ function buildRawEventsFromLessons(lessons) {
       durationMetric,
       color: String(ev.color || "").trim() || null,
       filterKey,
+      members,
       raw: ev,
     });
   }
@@ -409,7 +463,7 @@ function renderSidebar(tree, optionToKey) {
     subjectCb.indeterminate = !subjectCb.checked && isAnySelected(subjKeys);
     subjectCb.title = "Zaznacz/Odznacz wszystkie formy tego przedmiotu";
     subjectCb.addEventListener("change", () => {
-      state.filtersTouched = true;
+      markFiltersChanged();
       const on = subjectCb.checked;
       for (const k of subjKeys) {
         if (on) state.activeFilters.add(k);
@@ -441,7 +495,7 @@ function renderSidebar(tree, optionToKey) {
       formCb.indeterminate = !formCb.checked && isAnySelected(formKeys);
       formCb.title = "Zaznacz/Odznacz wszystkie grupy dla tej formy";
       formCb.addEventListener("change", () => {
-        state.filtersTouched = true;
+        markFiltersChanged();
         const on = formCb.checked;
         for (const k of formKeys) {
           if (on) state.activeFilters.add(k);
@@ -470,7 +524,7 @@ function renderSidebar(tree, optionToKey) {
         cb.value = filterKey;
         cb.checked = state.activeFilters.has(filterKey);
         cb.addEventListener("change", () => {
-          state.filtersTouched = true;
+          markFiltersChanged();
           if (cb.checked) state.activeFilters.add(filterKey);
           else state.activeFilters.delete(filterKey);
           renderEverything();
@@ -499,11 +553,16 @@ function clearEvents() {
 function renderEventsOnGrid() {
   clearEvents();
 
-  const visible = state.rawEvents.filter((e) => {
-    if (!state.activeFilters.has(e.filterKey)) return false;
-    if (state.selectedTok && state.selectedTok !== "__all__") return String(e.tok_name || "").trim() === state.selectedTok;
+  const memberVisible = (m) => {
+    if (!state.activeFilters.has(m.filterKey)) return false;
+    if (state.selectedTok && state.selectedTok !== "__all__") return m.tok_name === state.selectedTok;
     return true;
-  });
+  };
+  const visible = [];
+  for (const e of state.rawEvents) {
+    const groups = (e.members || [e]).filter(memberVisible).map((m) => m.group);
+    if (groups.length) visible.push({ ...e, visibleGroups: groups });
+  }
 
   // Merge duplicates (lecture shared across multiple groups etc.)
   const mergedMap = new Map();
@@ -511,9 +570,9 @@ function renderEventsOnGrid() {
     const uniqueKey = `${row.day}-${row.startMetric}-${row.endMetric}-${row.room}-${row.title}-${row.lecturer}`;
     if (mergedMap.has(uniqueKey)) {
       const existing = mergedMap.get(uniqueKey);
-      existing.groupsSet.add(row.group);
+      for (const g of row.visibleGroups) existing.groupsSet.add(g);
     } else {
-      mergedMap.set(uniqueKey, { ...row, groupsSet: new Set([row.group]) });
+      mergedMap.set(uniqueKey, { ...row, groupsSet: new Set(row.visibleGroups) });
     }
   }
 
@@ -664,7 +723,8 @@ async function ensureStudent({ force }) {
   const weekStart = weekStartEl.value || null;
   const rangeStart = rangeStartEl.value || null;
   const rangeEnd = rangeEndEl.value || null;
-  const maxWorkers = Number(maxWorkersEl.value || 10);
+  // Puste pole: discovery skanuje sale z pelnym budzetem backendu.
+  const maxWorkers = maxWorkersEl.value ? Number(maxWorkersEl.value) : null;
 
   if (!album) throw new Error("Podaj numer albumu.");
   if (!Number.isFinite(majorsCount) || majorsCount < 1) throw new Error("Nieprawidłowa liczba kierunków.");
@@ -717,19 +777,25 @@ async function loadWeek({ forceLessons }) {
     range_end: rangeEnd,
     force_refresh: !!forceLessons,
     max_workers: maxWorkers,
+    format: "columnar",
+    merge: true,
   };
+  if (state.filterProfileId != null && state.filterProfileAlbum === album) payload.filter_profile_id = state.filterProfileId;
 
+  const body = JSON.stringify(payload);
   const j = await fetchJson("/api/student/week", {
     method: "POST",
-    body: JSON.stringify(payload),
+    body,
     timeoutMs: 180000,
+    etagKey: body,
   });
 
+  state.serverFiltered = !!j.filter_applied;
   state.rawEvents = buildRawEventsFromLessons(j.lessons || []);
   // Filtry maja obejmowac caly okres (range), a nie tylko biezacy tydzien.
   // Backend zwraca filter_items (unikatowe pola) z calego zakresu.
   const fr = buildFilterRowsFromItems(j.filter_items || []);
-  state.filterRows = fr.length ? fr : buildFilterRowsFromItems(j.lessons || []);
+  state.filterRows = fr.length ? fr : buildFilterRowsFromItems(decodeLessons(j.lessons).flatMap(expandMergedLesson));
   const toksFromData = Array.from(new Set(state.filterRows.map((r) => String(r.tok_name || "").trim()).filter(Boolean)));
   if (toksFromData.length) setTokOptions(toksFromData);
   if (j.week_start) weekStartEl.value = j.week_start;
@@ -746,7 +812,7 @@ async function loadWeek({ forceLessons }) {
   }
 
   const meta = `week: groups=${j.groups_total} fetched=${j.groups_fetched} skipped=${j.groups_skipped} lessons=${
-    (j.lessons || []).length
+    state.rawEvents.length
   } errors=${j.errors || 0}`;
   if (j.last_error) setStatus(`${meta} last_error="${j.last_error}"`);
   else setStatus(meta);
@@ -861,7 +927,7 @@ btnRefreshEl.addEventListener("click", async () => {
 });
 
 $("#btnAllOn").addEventListener("click", () => {
-  state.filtersTouched = true;
+  markFiltersChanged();
   for (const s of state.subjectToKeys.values()) {
     for (const k of s) state.activeFilters.add(k);
   }
@@ -869,7 +935,7 @@ $("#btnAllOn").addEventListener("click", () => {
 });
 
 $("#btnAllOff").addEventListener("click", () => {
-  state.filtersTouched = true;
+  markFiltersChanged();
   // Only for currently visible keys (tak zeby zarzadzac oddzielnie tok_name).
   for (const s of state.subjectToKeys.values()) {
     for (const k of s) state.activeFilters.delete(k);
@@ -877,6 +943,71 @@ $("#btnAllOff").addEventListener("click", () => {
   renderEverything();
 });
 
+// Filtry rozjechaly sie z zapisanym profilem: dalej filtrujemy tylko lokalnie.
+// Jesli ostatnia odpowiedz byla juz przefiltrowana przez serwer, brakuje w niej zajec -> pobieramy tydzien bez filtra.
+function dropServerFilter() {
+  state.filterProfileId = null;
+  if (!state.serverFiltered || state.working) return;
+  state.serverFiltered = false;
+  disableUi(true, "week");
+  loadWeek({ forceLessons: false })
+    .catch((e) => {
+      setStatus(String(e));
+      toast(String(e));
+    })
+    .finally(() => disableUi(false));
+}
+
+function markFiltersChanged() {
+  state.filtersTouched = true;
+  dropServerFilter();
+}
+
+// Pozycje profilu dla serwera: (title, group_name, lecturer) jak w filterKey + sam klucz do odtworzenia zaznaczenia.
+// Klucze spoza biezacego zakresu (brak wiersza w filterRows) nie trafiaja do profilu.
+function activeFilterItems() {
+  const rowByKey = new Map(state.filterRows.map((r) => [r.filterKey, r]));
+  const out = [];
+  for (const k of state.activeFilters) {
+    const r = rowByKey.get(k);
+    if (r) out.push({ title: r.formTitle, group_name: r.group, lecturer: r.lecturer, key: k });
+  }
+  return out;
+}
+
+async function saveFiltersToServer(album) {
+  const j = await fetchJson("/api/student/filter-profiles", {
+    method: "POST",
+    body: JSON.stringify({
+      album_number: album,
+      name: FILTER_PROFILE_NAME,
+      selected_tok: state.selectedTok || "__all__",
+      items: activeFilterItems(),
+    }),
+  });
+  state.filterProfileId = j.id;
+  state.filterProfileAlbum = album;
+  toast("Zapisano filtry na serwerze");
+}
+
+// false: brak zapisanego profilu dla albumu.
+async function loadFiltersFromServer(album) {
+  const j = await fetchJson(`/api/student/filter-profiles?album_number=${encodeURIComponent(album)}`);
+  const p = (j.profiles || []).find((x) => x.name === FILTER_PROFILE_NAME);
+  if (!p) return false;
+  state.activeFilters = new Set((p.items || []).map((it) => it.key).filter((k) => typeof k === "string" && k));
+  state.filtersTouched = true;
+  if (typeof p.selected_tok === "string" && p.selected_tok.trim()) {
+    state.selectedTok = p.selected_tok.trim();
+    if (tokSelectEl) tokSelectEl.value = state.selectedTok;
+  }
+  state.filterProfileId = p.id;
+  state.filterProfileAlbum = album;
+  renderEverything();
+  toast("Wczytano filtry z serwera");
+  return true;
+}
+
 function downloadJson(obj, filename) {
   const blob = new Blob([JSON.stringify(obj, null, 2)], { type: "application/json" });
   const url = URL.createObjectURL(blob);
@@ -926,7 +1057,7 @@ async function importFiltersFromFile(file) {
 
   const cleaned = keys.filter((x) => typeof x === "string" && x.trim());
   state.activeFilters = new Set(cleaned);
-  state.filtersTouched = true;
+  markFiltersChanged();
 
   if (typeof j.selected_tok === "string" && j.selected_tok.trim()) {
     state.selectedTok = j.selected_tok.trim();
@@ -955,14 +1086,18 @@ boot();
 if (tokSelectEl) {
   tokSelectEl.addEventListener("change", () => {
     state.selectedTok = String(tokSelectEl.value || "__all__");
+    dropServerFilter();
     renderEverything();
   });
 }
 
 if (btnSaveFiltersEl) {
-  btnSaveFiltersEl.addEventListener("click", () => {
+  btnSaveFiltersEl.addEventListener("click", async () => {
     try {
-      exportFiltersToFile();
+      // Z numerem albumu zapisujemy profil na serwerze, bez niego zostaje plik.
+      const album = (albumEl.value || "").trim();
+      if (album && state.ready) await saveFiltersToServer(album);
+      else exportFiltersToFile();
     } catch (e) {
       setStatus(String(e));
       toast(String(e));
@@ -971,7 +1106,15 @@ if (btnSaveFiltersEl) {
 }
 
 if (btnLoadFiltersEl && fileLoadFiltersEl) {
-  btnLoadFiltersEl.addEventListener("click", () => fileLoadFiltersEl.click());
+  btnLoadFiltersEl.addEventListener("click", async () => {
+    const album = (albumEl.value || "").trim();
+    try {
+      if (album && state.ready && (await loadFiltersFromServer(album))) return;
+    } catch (e) {
+      setStatus(String(e));
+    }
+    fileLoadFiltersEl.click();
+  });
   fileLoadFiltersEl.addEventListener("change", async () => {
     const file = fileLoadFiltersEl.files && fileLoadFiltersEl.files[0];
     fileLoadFiltersEl.value = "";